@@ -0,0 +1,599 @@
+"""
+Aarhus University - Distributed Storage course - Lab 11
+
+REST API served with asyncio (Quart), many uploads, downloads and updates can wait for
+the storage nodes at the same time. The storage operations run in worker threads, see
+async_storage.py. It serves the same endpoints as rest-server.py and binds the same
+ports, run one of the two controllers.
+"""
+from quart import Quart, Response, make_response, request
+
+import zmq # For ZMQ
+import zmq.asyncio
+import asyncio # For waiting a second for ZMQ connections
+import io # For measuring the size of uploaded files
+import collections # For the locks of the files
+import logging
+
+import utils
+import downloads
+import updates
+import async_storage
+from async_storage import (SEND_TASK_SOCKET, RESPONSE_SOCKET, DATA_REQ_SOCKET,
+                           REPAIR_SOCKET, REPAIR_RESPONSE_SOCKET)
+
+# ZMQ context of the sockets to the storage nodes and of the operations
+context = zmq.asyncio.Context()
+context.set(zmq.MAX_SOCKETS, async_storage.MAX_SOCKETS)
+
+# Create the DB table if it doesn't exist
+utils.init_db()
+
+# Instantiate the Quart app (must be before the endpoint functions)
+app = Quart(__name__)
+# Accept uploads of any size, like Flask
+app.config['MAX_CONTENT_LENGTH'] = None
+
+# Tasks that forward the messages of the storage operations
+forwarding_tasks = []
+
+# Source data of the coding windows of the sliding-window RLNC streams, by file ID.
+# It is read back from the storage nodes when a stream is appended to after a restart.
+stream_windows = {}
+# Updates of the same file are applied one after the other, by file ID
+update_locks = collections.defaultdict(asyncio.Lock)
+# Only one repair runs at a time
+repair_lock = asyncio.Lock()
+
+@app.before_serving
+async def start_storage():
+    # The sockets are used by the event loop of the server
+
+    # Socket to send tasks to Storage Nodes
+    send_task_socket = context.socket(zmq.PUSH)
+    send_task_socket.bind("tcp://*:5557")
+
+    # Socket to receive messages from Storage Nodes
+    response_socket = context.socket(zmq.PULL)
+    response_socket.bind("tcp://*:5558")
+
+    # Publisher socket for data request broadcasts
+    data_req_socket = context.socket(zmq.PUB)
+    data_req_socket.bind("tcp://*:5559")
+
+    # Publisher socket for fragment repair broadcasts
+    repair_socket = context.socket(zmq.PUB)
+    repair_socket.bind("tcp://*:5560")
+
+    # Socket to receive repair messages from Storage Nodes
+    repair_response_socket = context.socket(zmq.PULL)
+    repair_response_socket.bind("tcp://*:5561")
+
+    # Wait for all workers to start and connect.
+    await asyncio.sleep(1)
+    print("Listening to ZMQ messages on tcp://*:5558 and tcp://*:5561")
+
+    forwarding_tasks.extend(async_storage.start(context, send_task_socket, response_socket,
+                                                data_req_socket, repair_socket,
+                                                repair_response_socket))
+#
+
+@app.route('/')
+async def hello():
+    return await make_response({'message': 'Hello World!'})
+
+@app.route('/files',  methods=['GET'])
+async def list_files():
+    db = utils.get_db()
+    cursor = db.execute("SELECT * FROM `file`")
+    if not cursor:
+        return await make_response({"message": "Error connecting to the database"}, 500)
+
+    files = cursor.fetchall()
+    # Convert files from sqlite3.Row object (which is not JSON-encodable) to
+    # a standard Python dictionary simply by casting
+    files = [dict(file) for file in files]
+
+    return await make_response({"files": files})
+#
+
+@app.route('/files/<int:file_id>',  methods=['GET'])
+async def download_file(file_id):
+
+    db = utils.get_db()
+    cursor = db.execute("SELECT * FROM `file` WHERE `id`=?", [file_id])
+    if not cursor:
+        return await make_response({"message": "Error connecting to the database"}, 500)
+
+    f = cursor.fetchone()
+    if not f:
+        return await make_response({"message": "File {} not found".format(file_id)}, 404)
+
+    # Convert to a Python dictionary
+    f = dict(f)
+    print("File requested: {}".format(f['filename']))
+
+    # Parse the storage details JSON string
+    import json
+    storage_details = json.loads(f['storage_details'])
+    # HTTP Range requests: only single ranges are supported, the whole file is sent for
+    # multiple ranges
+    file_range = None
+    if request.range and len(request.range.ranges) == 1:
+        file_range = request.range.range_for_length(f['size'])
+        if file_range is None and request.range.ranges[0][0] < 0 and f['size'] > 0:
+            # A suffix range that is longer than the file selects the whole file
+            file_range = (0, f['size'])
+        if file_range is None:
+            response = await make_response({"message": "Range not satisfiable"}, 416)
+            response.headers['Content-Range'] = "bytes */{}".format(f['size'])
+            return response
+
+    reader = downloads.file_reader(f, storage_details, file_range, DATA_REQ_SOCKET,
+                                   RESPONSE_SOCKET)
+    if reader is None:
+        logging.error("Unexpected storage mode: %s" % f['storage_mode'])
+        return await make_response("Unexpected storage mode: {}".format(f['storage_mode']), 400)
+    function, args = reader
+    chunks = async_storage.iterate(function, *args)
+
+    # Retrieve the first chunk before the response is started, so that errors can still
+    # be reported with an error status. The rest of the file is sent as it is retrieved.
+    try:
+        first_chunk = await chunks.__anext__()
+    except StopAsyncIteration:
+        first_chunk = b''
+    except TimeoutError as e:
+        logging.error("Retrieving file %d timed out: %s" % (file_id, e))
+        return await make_response({"message": str(e)}, 504)
+    except FileNotFoundError as e:
+        # Too many chunks are lost or may have missed an update, the file must be repaired
+        logging.error("Retrieving file %d failed: %s" % (file_id, e))
+        return await make_response({"message": str(e)}, 503)
+
+    async def file_chunks():
+        yield first_chunk
+        async for chunk in chunks:
+            yield chunk
+
+    response = Response(file_chunks(), mimetype=f['content_type'])
+    response.headers['Accept-Ranges'] = 'bytes'
+    if file_range is not None:
+        # Partial content: only the requested byte range is sent
+        response.status_code = 206
+        response.headers['Content-Range'] = "bytes {}-{}/{}".format(
+            file_range[0], file_range[1] - 1, f['size'])
+        response.headers['Content-Length'] = file_range[1] - file_range[0]
+    else:
+        response.headers['Content-Length'] = f['size']
+    return response
+#
+
+
+# HTTP HEAD requests are served by the GET endpoint of the same URL,
+# so we'll introduce a new endpoint URL for requesting file metadata.
+@app.route('/files/<int:file_id>/info',  methods=['GET'])
+async def get_file_metadata(file_id):
+
+    db = utils.get_db()
+    cursor = db.execute("SELECT * FROM `file` WHERE `id`=?", [file_id])
+    if not cursor:
+        return await make_response({"message": "Error connecting to the database"}, 500)
+
+    f = cursor.fetchone()
+    if not f:
+        return await make_response({"message": "File {} not found".format(file_id)}, 404)
+
+    # Convert to a Python dictionary
+    f = dict(f)
+    print("File: %s" % f)
+
+    return await make_response(f)
+#
+
+
+def store_compressed(stream, send_task_socket, response_socket):
+    """
+    Store a file with compressed.store_stream and commit the new block hashes, in the
+    worker thread of the operation (with the DB connection of the thread).
+    """
+    import compressed
+
+    db = utils.get_db()
+    try:
+        hash_ids, new_blocks = compressed.store_stream(stream, send_task_socket,
+                                                       response_socket)
+    except Exception:
+        # The connection of the thread would keep the DB locked
+        db.rollback()
+        raise
+    db.commit()
+    return hash_ids, new_blocks
+#
+
+@app.route('/files_mp', methods=['POST'])
+async def add_files_multipart():
+    # Quart separates files from the other form fields
+    payload = await request.form
+    files = await request.files
+
+    # Make sure there is a file in the request
+    if not files or not files.get('file'):
+        logging.error("No file was uploaded in the request!")
+        return await make_response("File missing!", 400)
+
+    # Reference to the file under 'file' key
+    file = files.get('file')
+    # The sender encodes a the file name and type together with the file contents
+    filename = file.filename
+    content_type = file.mimetype
+    # The upload has been spooled to a temporary file, the storage modes read it from
+    # there in chunks instead of loading the whole file into memory
+    stream = file.stream
+    size = stream.seek(0, io.SEEK_END)
+    stream.seek(0)
+    print("File received: %s, size: %d bytes, type: %s" % (filename, size, content_type))
+
+    # Read the requested storage mode from the form (default value: 'raid1')
+    storage_mode = payload.get('storage', 'raid1')
+    print("Storage mode: %s" % storage_mode)
+
+    if storage_mode == 'raid1':
+        import raid1
+        file_data_1_names, file_data_2_names = await async_storage.run(
+            raid1.store_stream, stream, size, SEND_TASK_SOCKET, RESPONSE_SOCKET)
+
+        storage_details = {
+            "part1_filenames": file_data_1_names,
+            "part2_filenames": file_data_2_names
+        }
+
+    elif storage_mode == 'erasure_coding_rs':
+        # Reed Solomon code
+        import reedsolomon
+
+        max_erasures = utils.form_number(payload, 'max_erasures', 1,
+                                         0, reedsolomon.STORAGE_NODES_NUM - 1)
+        print("Max erasures: %d" % (max_erasures))
+
+        # How many fragments are needed to reconstruct the file, the file is stored on
+        # k+max_erasures nodes (default: all storage nodes)
+        k = utils.form_number(payload, 'k', reedsolomon.STORAGE_NODES_NUM - max_erasures,
+                              1, reedsolomon.STORAGE_NODES_NUM - max_erasures)
+        print("k: %d" % (k))
+
+        # Systematic layout: the data fragments are plain slices of the file (default: off)
+        systematic = payload.get('systematic', 'false').lower() == 'true'
+        print("Systematic: %s" % (systematic))
+
+        # Store the file contents with Reed Solomon erasure coding
+        fragment_names, stripes, symbol_size = await async_storage.run(
+            reedsolomon.store_stream, stream, size, max_erasures, SEND_TASK_SOCKET,
+            RESPONSE_SOCKET, systematic, k)
+
+        storage_details = {
+            "coded_fragments": fragment_names,
+            "max_erasures": max_erasures,
+            "k": k,
+            "m": max_erasures,
+            "systematic": systematic,
+            "stripes": stripes,
+            "symbol_size": symbol_size
+        }
+
+    elif storage_mode == 'erasure_coding_rlnc':
+        # RLNC
+        import rlnc
+
+        max_erasures = utils.form_number(payload, 'max_erasures', 1,
+                                         0, rlnc.STORAGE_NODES_NUM - 1)
+        print("Max erasures: %d" % (max_erasures))
+
+        subfragments_per_node = utils.form_number(payload, 'subfragments_per_node', 3, 1)
+        print("Subfragments per node: %d" % (subfragments_per_node))
+
+        # Maximum size of the generations the file is cut to (default: rlnc.GENERATION_SIZE)
+        generation_size = utils.form_number(payload, 'generation_size',
+                                            rlnc.GENERATION_SIZE, 1)
+        print("Generation size: %d" % (generation_size))
+
+        # 'raw' coefficient vectors (default) or 'seed's they are generated from
+        coefficient_format = payload.get('coefficient_format', 'raw')
+        if coefficient_format not in rlnc.COEFFICIENT_FORMATS:
+            return await make_response({"message": "Unknown coefficient format: {}".format(
+                coefficient_format)}, 400)
+        print("Coefficient format: %s" % (coefficient_format))
+
+        # Systematic layout: the first nodes store the source symbols uncoded (default: off)
+        systematic = payload.get('systematic', 'false').lower() == 'true'
+        print("Systematic: %s" % (systematic))
+
+        # Fraction of non-zero coefficients in the coded subfragments (default: 1, dense)
+        density = utils.form_number(payload, 'density', 1.0, convert=float)
+        if not 0 < density <= 1:
+            return await make_response({"message": "Density must be in (0, 1]: {}".format(
+                density)}, 400)
+        print("Density: %s" % (density))
+
+        # Number of bits of the finite field: 4, 8 or 16 (default: 8)
+        field = utils.form_number(payload, 'field', 8)
+        if field not in rlnc.FIELDS:
+            return await make_response({"message": "Unknown field: GF(2^{})".format(field)},
+                                       400)
+        print("Field: GF(2^%d)" % (field))
+
+        # Store the file contents with Random Linear Network Coding encoding
+        fragment_names, generations, symbol_size = await async_storage.run(
+            rlnc.store_stream, stream, size, max_erasures, subfragments_per_node,
+            SEND_TASK_SOCKET, RESPONSE_SOCKET, generation_size=generation_size,
+            coefficient_format=coefficient_format, systematic=systematic, density=density,
+            field=field)
+
+        storage_details = {
+            "coded_fragments": fragment_names,
+            "max_erasures": max_erasures,
+            "subfragments_per_node": subfragments_per_node,
+            "generation_size": generation_size,
+            "coefficient_format": coefficient_format,
+            "systematic": systematic,
+            "density": density,
+            "field": field,
+            "generations": generations,
+            "symbol_size": symbol_size
+        }
+
+    elif storage_mode == 'erasure_coding_rlnc_stream':
+        # Sliding-window RLNC: the file is an append-only stream, see rest-server.py
+        import gf
+        import rlnc
+        import rlnc_stream
+
+        max_erasures = utils.form_number(payload, 'max_erasures', 1,
+                                         0, rlnc.STORAGE_NODES_NUM - 1)
+        subfragments_per_node = utils.form_number(payload, 'subfragments_per_node', 3, 1)
+        symbol_size = utils.form_number(payload, 'symbol_size', rlnc_stream.SYMBOL_SIZE, 1)
+        window = utils.form_number(payload, 'window', rlnc_stream.WINDOW_STEPS, 1)
+        coefficient_format = payload.get('coefficient_format', 'raw')
+        if coefficient_format not in rlnc.COEFFICIENT_FORMATS:
+            return await make_response({"message": "Unknown coefficient format: {}".format(
+                coefficient_format)}, 400)
+        field = utils.form_number(payload, 'field', 8)
+        if field not in rlnc.FIELDS:
+            return await make_response({"message": "Unknown field: GF(2^{})".format(field)},
+                                       400)
+        if window < 1 or symbol_size < 1 or symbol_size % gf.ELEMENT_TYPES[field].itemsize:
+            return await make_response({"message": "Invalid window or symbol size"}, 400)
+        print("Stream: %d byte symbols, window of %d steps" % (symbol_size, window))
+
+        fragment_names, window_data = await async_storage.run(
+            rlnc_stream.store_stream, stream, max_erasures, subfragments_per_node,
+            SEND_TASK_SOCKET, RESPONSE_SOCKET, REPAIR_SOCKET, REPAIR_RESPONSE_SOCKET,
+            symbol_size, window, coefficient_format, field)
+
+        storage_details = {
+            "coded_fragments": fragment_names,
+            "max_erasures": max_erasures,
+            "subfragments_per_node": subfragments_per_node,
+            "symbol_size": symbol_size,
+            "window": window,
+            "coefficient_format": coefficient_format,
+            "field": field
+        }
+
+    elif storage_mode == 's3':
+        # Store the file contents in Amazon S3
+        import s3
+
+        # Read region code from the request
+        region = payload.get('s3_region')
+
+        # Upload the file to S3
+        bucket_name, object_key = await async_storage.run(s3.store_stream, stream, size,
+                                                          region, content_type)
+
+        # Construct the dict that goes into the 'storage_details' DB field
+        storage_details = {
+            "region": region,
+            "bucket": bucket_name,
+            "object": object_key
+        }
+
+    elif storage_mode == 'compressed':
+        # Compress and store the file
+        hash_ids, new_blocks = await async_storage.run(store_compressed, stream,
+                                                       SEND_TASK_SOCKET, RESPONSE_SOCKET)
+
+        # Construct the dict that goes into the 'storage_details' DB field
+        storage_details = {
+            "hash_ids": hash_ids,
+            "new_blocks": new_blocks
+        }
+
+    else:
+        logging.error("Unexpected storage mode: %s" % storage_mode)
+        return await make_response("Wrong storage mode", 400)
+
+    # Insert the File record in the DB
+    import json
+    db = utils.get_db()
+    cursor = db.execute(
+        "INSERT INTO `file`(`filename`, `size`, `content_type`, `storage_mode`, `storage_details`) VALUES (?,?,?,?,?)",
+        (filename, size, content_type, storage_mode, json.dumps(storage_details))
+    )
+    db.commit()
+    if storage_mode == 'erasure_coding_rlnc_stream':
+        stream_windows[cursor.lastrowid] = window_data
+
+    return await make_response({"id": cursor.lastrowid }, 201)
+#
+
+
+# Overwrite part of a file or append to it. The request body is the new data, the
+# 'offset' query parameter is where it is written (default: append to the end).
+# See rest-server.py and updates.py.
+@app.route('/files/<int:file_id>',  methods=['PATCH'])
+async def update_file(file_id):
+    data = await request.get_data()
+
+    async with update_locks[file_id]:
+        db = utils.get_db()
+        cursor = db.execute("SELECT * FROM `file` WHERE `id`=?", [file_id])
+        if not cursor:
+            return await make_response({"message": "Error connecting to the database"}, 500)
+
+        f = cursor.fetchone()
+        if not f:
+            return await make_response({"message": "File {} not found".format(file_id)},
+                                       404)
+
+        # Convert to a Python dictionary
+        f = dict(f)
+        offset = int(request.args.get('offset', f['size']))
+        if offset < 0 or offset > f['size']:
+            return await make_response(
+                {"message": "Offset must be between 0 and the file size"}, 400)
+        print("File update: %s, %d bytes at offset %d" % (f['filename'], len(data), offset))
+
+        # Parse the storage details JSON string
+        import json
+        storage_details = json.loads(f['storage_details'])
+        # Chunks that may have missed an update: they are not read, and the ones that
+        # miss this update are added. They are deleted and repaired by the next repair.
+        stale_chunks = list(storage_details.get('stale_chunks', []))
+        if f['storage_mode'] == 'erasure_coding_rlnc_stream' and offset != f['size']:
+            return await make_response({"message": "Streams can only be appended to"}, 400)
+
+        try:
+            result = await async_storage.run(
+                updates.update_file, f, storage_details, offset, data, stale_chunks,
+                stream_windows.get(file_id), DATA_REQ_SOCKET, RESPONSE_SOCKET,
+                SEND_TASK_SOCKET, REPAIR_SOCKET, REPAIR_RESPONSE_SOCKET)
+        except TimeoutError as e:
+            logging.error("Updating file %d timed out: %s" % (file_id, e))
+            # The window of a stream may not match the data on the nodes any more
+            stream_windows.pop(file_id, None)
+            updates.mark_stale_chunks(db, file_id, storage_details, stale_chunks)
+            return await make_response({"message": str(e)}, 504)
+        except FileNotFoundError as e:
+            # Lost fragments must be repaired before the file can be updated
+            logging.error("Updating file %d failed: %s" % (file_id, e))
+            stream_windows.pop(file_id, None)
+            updates.mark_stale_chunks(db, file_id, storage_details, stale_chunks)
+            return await make_response({"message": str(e)}, 503)
+        if result is None:
+            return await make_response(
+                {"message": "Storage mode {} does not support updates".format(
+                    f['storage_mode'])}, 400)
+        size, old_chunks, window_data = result
+        if window_data is not None:
+            stream_windows[file_id] = window_data
+
+        db.execute(
+            "UPDATE `file` SET `size`=?, `storage_details`=? WHERE `id`=?",
+            (size, json.dumps(storage_details), file_id)
+        )
+        db.commit()
+
+    if old_chunks is not None:
+        await async_storage.run(updates.delete_old_chunks, file_id, *old_chunks,
+                                REPAIR_SOCKET, REPAIR_RESPONSE_SOCKET)
+
+    return await make_response({"id": file_id, "size": size})
+#
+
+
+async def repair_files(storage_modes, repair_processes):
+    """
+    Run the repair processes of the files stored with the given storage modes, one
+    process for each mode, and save the files whose stale chunks were deleted.
+
+    :return: The response with the number of missing and repaired subfragments
+    """
+    async with repair_lock:
+        db = utils.get_db()
+        cursor = db.execute(
+            "SELECT `id`, `storage_details`, `size`, `storage_mode` FROM `file` WHERE `storage_mode` IN ({})".format(
+                ", ".join("?" * len(storage_modes))),
+            storage_modes)
+        if not cursor:
+            return await make_response({"message": "Error connecting to the database"}, 500)
+
+        files = [dict(file) for file in cursor.fetchall()]
+        stale_file_ids = [file['id'] for file in files if 'stale_chunks' in file['storage_details']]
+
+        fragments_missing = fragments_repaired = 0
+        for storage_mode, start_repair_process in zip(storage_modes, repair_processes):
+            missing, repaired = await async_storage.run(
+                start_repair_process,
+                [file for file in files if file['storage_mode'] == storage_mode],
+                REPAIR_SOCKET, REPAIR_RESPONSE_SOCKET)
+            fragments_missing += missing
+            fragments_repaired += repaired
+
+        # Save the files whose stale chunks were deleted
+        for file in files:
+            if file['id'] in stale_file_ids:
+                db.execute("UPDATE `file` SET `storage_details`=? WHERE `id`=?",
+                           (file['storage_details'], file['id']))
+        db.commit()
+
+    return await make_response({"fragments_missing": fragments_missing,
+                                "fragments_repaired": fragments_repaired})
+#
+
+
+@app.route('/services/rlnc_repair',  methods=['GET'])
+async def rlnc_repair():
+    import rlnc
+    import rlnc_stream
+
+    # Streams are repaired step by step
+    return await repair_files(['erasure_coding_rlnc', 'erasure_coding_rlnc_stream'],
+                              [rlnc.start_repair_process, rlnc_stream.start_repair_process])
+#
+
+
+@app.route('/services/rs_repair',  methods=['GET'])
+async def rs_repair():
+    import reedsolomon
+
+    return await repair_files(['erasure_coding_rs'], [reedsolomon.start_repair_process])
+#
+
+
+@app.route('/services/decoding_cache',  methods=['GET'])
+async def decoding_cache():
+    # Hit/miss counters of the decoding matrix caches, useful to watch during node outages
+    import reedsolomon
+    import rlnc
+
+    stats = {}
+    for name, cache_info in [("erasure_coding_rs", reedsolomon.decoding_matrix.cache_info()),
+                             ("erasure_coding_rlnc", rlnc.decoding_matrix.cache_info())]:
+        stats[name] = {
+            "hits": cache_info.hits,
+            "misses": cache_info.misses,
+            "size": cache_info.currsize,
+            "max_size": cache_info.maxsize
+        }
+
+    return await make_response(stats)
+#
+
+
+@app.errorhandler(utils.FormError)
+async def form_error(e):
+    # Invalid fields of an upload form
+    return await make_response({"message": str(e)}, 400)
+
+
+@app.errorhandler(500)
+async def server_error(e):
+    logging.exception("Internal error: %s", e)
+    return await make_response({"error": str(e)}, 500)
+
+
+# Start the Quart app (must be after the endpoint functions)
+host_local_computer = "localhost" # Listen for connections on the local computer
+host_local_network = "0.0.0.0" # Listen for connections on the local network
+app.run(host=host_local_network if utils.is_raspberry_pi() else host_local_computer, port=9000)
@@ -0,0 +1,278 @@
+import os
+import asyncio
+import concurrent.futures
+
+import zmq
+import zmq.asyncio
+
+import messages_pb2
+from utils import random_string
+
+# Awaitable storage operations for the asyncio controller (async-rest-server.py).
+# The store_file/get_file functions of the storage modules talk to the storage nodes
+# with blocking ZMQ calls. run() executes one of them in a worker thread and hands it
+# sockets of its own, which are connected over inproc to the event loop. The event loop
+# owns the sockets to the storage nodes: it forwards the requests of all operations to
+# the nodes and routes every response back to the operation that is waiting for it,
+# so many operations can wait for the storage nodes at the same time.
+#
+# Every request to the storage nodes carries a request ID, which the nodes send back in
+# the first frame of their responses (see utils.receive_response); responses are routed
+# by it.
+
+# Number of worker threads, i.e. how many storage operations can run at once
+MAX_OPERATIONS = int(os.environ.get('MAX_OPERATIONS', 256))
+
+# The ZMQ context needs this many sockets, every operation has up to five and the event
+# loop a few. It must be set before the first socket of the context is created.
+MAX_SOCKETS = 5*MAX_OPERATIONS + 64
+
+# Stand-ins for the ZMQ sockets in the arguments of run(). Each is replaced with a
+# socket of the operation that behaves like the controller socket of the same name.
+SEND_TASK_SOCKET = object()
+RESPONSE_SOCKET = object()
+DATA_REQ_SOCKET = object()
+REPAIR_SOCKET = object()
+REPAIR_RESPONSE_SOCKET = object()
+
+# Inproc endpoints of the event loop, by socket stand-in
+__ENDPOINTS = {
+    SEND_TASK_SOCKET: "send_task",
+    RESPONSE_SOCKET: "response",
+    DATA_REQ_SOCKET: "data_req",
+    REPAIR_SOCKET: "repair",
+    REPAIR_RESPONSE_SOCKET: "repair_response",
+}
+
+__context = None
+__executor = None
+# Socket of the event loop for each inproc endpoint
+__routers = {}
+# Request ID -> ID of the operation that sent the request
+__routes = {}
+# Operation ID -> set of its request IDs, removed when the operation ends
+__operation_requests = {}
+# Returned by the worker thread when an iterator is exhausted
+__END = object()
+
+
+def __request_id(endpoint, frames):
+    """
+    Returns the request ID of a request to the storage nodes.
+
+    :param endpoint: The inproc endpoint the request was sent to
+    :param frames: The frames of the request
+    :return: The request ID, an empty string if the request has none
+    """
+    if endpoint == "send_task":
+        task = messages_pb2.storedata_request()
+        task.ParseFromString(frames[0].bytes)
+        return task.request_id
+    if endpoint == "data_req":
+        task = messages_pb2.getdata_request()
+        task.ParseFromString(frames[0].bytes)
+        return task.request_id
+    # Repair requests: the topic, then the header
+    header = messages_pb2.header()
+    header.ParseFromString(frames[1].bytes)
+    return header.request_id
+#
+
+
+async def __forward_requests(endpoint, socket):
+    """
+    Forward the requests that the operations send to an inproc endpoint to the storage
+    nodes, after registering the route of their responses.
+
+    :param endpoint: The inproc endpoint
+    :param socket: The controller socket to the storage nodes
+    """
+    router = __routers[endpoint]
+    while True:
+        identity, *frames = await router.recv_multipart(copy=False)
+        operation = identity.bytes.split(b'/')[0]
+        request_id = __request_id(endpoint, frames)
+        if request_id:
+            __routes[request_id] = operation
+            __operation_requests.setdefault(operation, set()).add(request_id)
+        await socket.send_multipart(frames, copy=False)
+#
+
+
+async def __forward_responses(endpoint, socket):
+    """
+    Forward the responses of the storage nodes to the operations waiting for them.
+
+    :param endpoint: The inproc endpoint of the operations' response sockets
+    :param socket: The controller socket where the storage nodes respond
+    """
+    router = __routers[endpoint]
+    while True:
+        frames = await socket.recv_multipart(copy=False)
+        request_id = frames[0].bytes.decode('utf-8', 'replace')
+        operation = __routes.get(request_id)
+        if operation is None:
+            # A late response to an operation that has ended
+            print("Dropping response to request %s, no operation is waiting for it"
+                  % request_id)
+            continue
+        await router.send_multipart([operation + b'/' + endpoint.encode('utf-8')] + frames,
+                                    copy=False)
+#
+
+
+def start(context, send_task_socket, response_socket, data_req_socket, repair_socket,
+          repair_response_socket):
+    """
+    Start forwarding the messages of the operations, must be called in the event loop
+    before run().
+
+    :param context: The zmq.asyncio.Context of the sockets, see MAX_SOCKETS
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param data_req_socket: A ZMQ PUB socket to request chunks from the storage nodes
+    :param repair_socket: A ZMQ PUB socket for repair requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket where the storage nodes respond
+                                   to repair requests
+    :return: The forwarding tasks
+    """
+    global __context, __executor
+    # A blocking context for the worker threads that shares the inproc endpoints
+    __context = zmq.Context.shadow(context.underlying)
+    __executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_OPERATIONS)
+
+    for endpoint in __ENDPOINTS.values():
+        router = context.socket(zmq.ROUTER)
+        # Queue the messages of busy operations instead of dropping them
+        router.set(zmq.SNDHWM, 0)
+        router.set(zmq.RCVHWM, 0)
+        router.bind("inproc://" + endpoint)
+        __routers[endpoint] = router
+
+    return [asyncio.create_task(coroutine) for coroutine in (
+        __forward_requests("send_task", send_task_socket),
+        __forward_requests("data_req", data_req_socket),
+        __forward_requests("repair", repair_socket),
+        __forward_responses("response", response_socket),
+        __forward_responses("repair_response", repair_response_socket),
+    )]
+#
+
+
+def __call(operation, function, args, kwargs, sockets=None):
+    """
+    Worker thread task: call the function with the socket stand-ins in its arguments
+    replaced by sockets of the operation. The sockets are closed when the function
+    returns, unless a dict is given to keep them in.
+    """
+    keep_sockets = sockets is not None
+    if not keep_sockets:
+        sockets = {}
+
+    def replace(arg):
+        stand_in = next((stand_in for stand_in in __ENDPOINTS if arg is stand_in), None)
+        if stand_in is None:
+            return arg
+        if stand_in not in sockets:
+            endpoint = __ENDPOINTS[stand_in]
+            socket = __context.socket(zmq.DEALER)
+            socket.set(zmq.IDENTITY, operation + b'/' + endpoint.encode('utf-8'))
+            socket.set(zmq.SNDHWM, 0)
+            socket.set(zmq.RCVHWM, 0)
+            socket.connect("inproc://" + endpoint)
+            sockets[stand_in] = socket
+        return sockets[stand_in]
+
+    try:
+        return function(*[replace(arg) for arg in args],
+                        **{name: replace(arg) for name, arg in kwargs.items()})
+    finally:
+        if not keep_sockets:
+            __close_sockets(sockets)
+#
+
+
+def __close_sockets(sockets):
+    """
+    Close the sockets of an operation.
+    """
+    for socket in sockets.values():
+        socket.close(linger=0)
+    sockets.clear()
+#
+
+
+def __end_operation(operation):
+    """
+    Clean up after an operation, must be called in the event loop once its sockets are
+    closed.
+    """
+    # Forget the routes of the operation's responses
+    for request_id in __operation_requests.pop(operation, ()):
+        __routes.pop(request_id, None)
+    # The sockets of closed operations are only freed once the routers handle the
+    # disconnects, which idle routers don't do by themselves
+    for router in __routers.values():
+        router.get(zmq.EVENTS)
+#
+
+
+async def run(function, *args, **kwargs):
+    """
+    Awaitable version of a storage operation, e.g.
+    await run(raid1.get_file, part1_filenames, part2_filenames, DATA_REQ_SOCKET,
+              RESPONSE_SOCKET)
+    Any function can be run, its sockets are given as the stand-ins of this module.
+
+    :param function: The blocking function, e.g. a store_file or get_file
+    :param args: The arguments of the function
+    :param kwargs: The keyword arguments of the function
+    :return: The return value of the function
+    """
+    operation = random_string(8).encode('utf-8')
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            __executor, __call, operation, function, args, kwargs)
+    finally:
+        __end_operation(operation)
+#
+
+
+async def iterate(function, *args, **kwargs):
+    """
+    Asynchronous generator version of a storage operation that returns an iterator, e.g.
+    async for chunk in iterate(raid1.stream_file, part1_filenames, part2_filenames,
+                               DATA_REQ_SOCKET, RESPONSE_SOCKET):
+    The function is called and each item is produced in a worker thread. The operation
+    keeps its sockets until the iterator is exhausted or the asynchronous generator is
+    closed, e.g. because the client went away.
+
+    :param function: The blocking function, e.g. a stream_file
+    :param args: The arguments of the function
+    :param kwargs: The keyword arguments of the function
+    :return: Asynchronous generator of the items of the iterator
+    """
+    operation = random_string(8).encode('utf-8')
+    loop = asyncio.get_running_loop()
+    sockets = {}
+    # The last task of the operation in a worker thread
+    task = None
+    try:
+        task = __executor.submit(__call, operation, function, args, kwargs, sockets)
+        iterator = iter(await asyncio.wrap_future(task))
+        while True:
+            task = __executor.submit(next, iterator, __END)
+            item = await asyncio.wrap_future(task)
+            if item is __END:
+                break
+            yield item
+    finally:
+        def end(_=None):
+            __close_sockets(sockets)
+            loop.call_soon_threadsafe(__end_operation, operation)
+        if task is None or task.done():
+            end()
+        else:
+            # The task was cancelled, but the worker thread still uses the sockets
+            task.add_done_callback(end)
+#
@@ -0,0 +1,182 @@
+"""
+Aarhus University - Distributed Storage course - Lab 11
+
+Erasure coding benchmark
+
+Measures the encoding and decoding throughput of the NumPy codec with an increasing
+number of worker processes, the cost and benefit of sparse RLNC coefficients, and of
+coding RLNC over GF(2^4), GF(2^8) or GF(2^16).
+The storage nodes are not involved, only the coding.
+
+Usage: python benchmark.py [size in MiB] [max. number of workers]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+import gf
+import rlnc
+import workers
+import reedsolomon
+
+# Densities of the sparse RLNC table
+DENSITIES = [1.0, 0.5, 0.25, 0.1, 0.05]
+
+# Number of random coefficient vectors drawn to measure the overhead of a density
+OVERHEAD_TRIALS = 200
+
+
+def measure(function, repeat=3):
+    """
+    Returns the best time of 'repeat' runs of the function, in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+#
+
+
+def extra_symbols(symbols, density, trials, field=8):
+    """
+    Returns how many random coded symbols of the given density are received in addition
+    to 'symbols' until the decoder reaches full rank, a list with one number per trial.
+    """
+    extra = []
+    seed = rlnc.SYSTEMATIC_SEEDS
+    for _ in range(trials):
+        basis = []
+        received = 0
+        while len(basis) < symbols:
+            gf.reduce_row(basis, rlnc.seed_coefficients(seed, symbols, density, field), field)
+            seed += 1
+            received += 1
+        extra.append(received - symbols)
+    return extra
+#
+
+
+def decodable_matrix(symbols, density=1.0, field=8):
+    """
+    Returns the coefficients of 'symbols' random coded symbols that can be decoded,
+    and their inverse.
+    """
+    element_type = gf.ELEMENT_TYPES[field]
+    seed = rlnc.SYSTEMATIC_SEEDS
+    while True:
+        matrix = np.array([np.frombuffer(rlnc.seed_coefficients(seed + i, symbols, density,
+                                                                field), dtype=element_type)
+                           for i in range(symbols)])
+        seed += symbols
+        try:
+            return matrix, gf.invert_matrix(matrix, field)
+        except ValueError:
+            pass
+#
+
+
+def sparse_table(size, symbols):
+    """
+    Print the encoding and decoding throughput of one RLNC generation and the extra
+    symbols needed for decoding at each of the DENSITIES, with a single process.
+    """
+    data = np.random.randint(0, 256, (symbols, size // symbols), dtype=np.uint8)
+    out = np.empty_like(data)
+    workers.WORKERS = 1
+    workers.shutdown()
+
+    print()
+    print("RLNC, %d symbols, 1 worker" % symbols)
+    print("%-12s%16s%16s%16s" % ("Density", "Encode MiB/s", "Decode MiB/s", "Extra symbols"))
+    for density in DENSITIES:
+        matrix, inverse = decodable_matrix(symbols, density)
+        encode = measure(lambda: workers.matmul(matrix, data, out=out))
+        # The inverse of a sparse matrix is usually much denser, decoding gains less
+        decode = measure(lambda: workers.matmul(inverse, data, out=out))
+        extra = extra_symbols(symbols, density, OVERHEAD_TRIALS)
+        print("%-12s%16.0f%16.0f%16.2f" % (density, size / encode / (1024*1024),
+                                           size / decode / (1024*1024),
+                                           sum(extra) / len(extra)))
+#
+
+
+def field_table(size, symbols):
+    """
+    Print the encoding and decoding throughput of one dense RLNC generation in each of
+    the fields, and how likely 'symbols' random coded symbols are not enough to decode
+    it, with a single process.
+    """
+    data = np.random.randint(0, 256, (symbols, size // symbols // 2 * 2), dtype=np.uint8)
+    out = np.empty_like(data)
+    workers.WORKERS = 1
+    workers.shutdown()
+
+    print()
+    print("RLNC, %d symbols, 1 worker" % symbols)
+    print("%-12s%16s%16s%16s" % ("Field", "Encode MiB/s", "Decode MiB/s", "P(extra)"))
+    for field in rlnc.FIELDS:
+        matrix, inverse = decodable_matrix(symbols, field=field)
+        encode = measure(lambda: workers.matmul(matrix, data, out=out, field=field))
+        decode = measure(lambda: workers.matmul(inverse, data, out=out, field=field))
+        extra = extra_symbols(symbols, 1.0, OVERHEAD_TRIALS, field)
+        print("%-12s%16.0f%16.0f%16.4f" % ("GF(2^%d)" % field, data.size / encode / (1024*1024),
+                                           data.size / decode / (1024*1024),
+                                           sum(1 for count in extra if count) / len(extra)))
+#
+
+
+def main():
+    size = int(sys.argv[1]) * 1024*1024 if len(sys.argv) > 1 else 64*1024*1024
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+
+    # (name, coefficient matrix, number of source symbols)
+    k, m = 10, 4
+    rs = reedsolomon.coefficient_matrix(k, m)
+    rlnc_symbols = 32
+    rlnc = np.random.randint(1, 256, (rlnc_symbols, rlnc_symbols), dtype=np.uint8)
+    cases = [
+        ("RS encode (%d+%d)" % (k, m), rs, k),
+        ("RS decode (%d+%d, %d lost)" % (k, m, m), gf.invert_matrix(rs[m:]), k),
+        ("RLNC decode (%d symbols)" % rlnc_symbols, gf.invert_matrix(rlnc), rlnc_symbols),
+    ]
+
+    worker_counts = [1]
+    while worker_counts[-1]*2 <= max_workers:
+        worker_counts.append(worker_counts[-1]*2)
+    if worker_counts[-1] != max_workers:
+        worker_counts.append(max_workers)
+
+    print("Data size: %d MiB, %d CPU cores" % (size // (1024*1024), os.cpu_count() or 1))
+    print("%-32s" % "Workers" + "".join("%12d" % count for count in worker_counts))
+
+    for name, matrix, symbols in cases:
+        # In shared memory like the data of the storage modes, so it is coded in place
+        workers.WORKERS = max_workers
+        data = workers.empty((symbols, size // symbols))
+        data[:] = np.random.randint(0, 256, data.shape, dtype=np.uint8)
+        out = workers.empty((matrix.shape[0], data.shape[1]))
+        results = []
+        for count in worker_counts:
+            workers.WORKERS = count
+            workers.shutdown()
+            # Start the pool before measuring
+            workers.matmul(matrix, data, out=out)
+            seconds = measure(lambda: workers.matmul(matrix, data, out=out))
+            results.append(size / seconds / (1024*1024))
+        print("%-32s" % (name + " MiB/s") + "".join("%12.0f" % result for result in results))
+        print("%-32s" % "  speedup" + "".join("%12.2f" % (result / results[0])
+                                              for result in results))
+
+    sparse_table(size, rlnc_symbols)
+    field_table(size, rlnc_symbols)
+
+    workers.shutdown()
+#
+
+if __name__ == "__main__":
+    main()
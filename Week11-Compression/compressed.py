@@ -1,11 +1,22 @@
 import messages_pb2
 import hashlib
 import zlib
+import itertools
+import collections
+import math
+import time
 import utils
 
 # Deduplication block size (bytes)
 BLOCK_SIZE = 4096
 
+# Number of blocks whose hashes are looked up in the DB at once (one query parameter
+# each, older SQLite versions allow at most 999)
+LOOKUP_BATCH_BLOCKS = 512
+
+# How many new blocks may have been sent to the storage nodes without being acknowledged
+MAX_BLOCKS_IN_FLIGHT = 1024
+
 def store_file(file_data, send_task_socket, response_socket):
     """
     Compress a file using deduplication and Gzip, and distribute the unique blocks 
@@ -16,76 +27,136 @@ def store_file(file_data, send_task_socket, response_socket):
     :param response_socket: A ZMQ PULL socket where the storage nodes respond.
     :return: List of hash IDs and a string that indicates deduplication rate
     """
-    
-    hash_ids = []
+    # Cut the file to 4kB blocks
+    return __store_blocks(utils.chunks(file_data, BLOCK_SIZE),
+                          send_task_socket, response_socket)
+#
 
-    # Cut the file to 4kB blocks and calculate the MD5 hashes
-    blocks = []
-    hashes = []
-    for block in utils.chunks(file_data, BLOCK_SIZE):
-        h = hashlib.md5()
-        h.update(block)
-        hash_string = h.digest().hex() # Convert the bytes to hex string
-        hashes.append(hash_string)
-        blocks.append(block)
-    #
-
-    # Figure out which hashes are already stored
-    db = utils.get_db()
-    # Construct a parameterized query that looks like this: 
-    # SELECT hash FROM block_hash WHERE hash IN (?,?,?,?) 
-    query = "SELECT * FROM `block_hash` WHERE `hash` IN ({placeholders})".format(
-        placeholders=','.join(['?']*len(hashes))
-    )
-    cursor = db.execute(query, hashes)
-    existing_hashes = cursor.fetchall()
-    # Convert to dictionaries
-    existing_hashes = [dict(h) for h in existing_hashes]
-
-    # Iterate the blocks and hashes again to construct the list of BlockHash IDs. 
-    # New blocks are Gzipped and sent to the Storage Nodes
-    new_blocks_num = 0
-    for i in range(len(blocks)):
-        block = blocks[i]
-        hash_string = hashes[i]
-
-        # Check if the hash is already known
-        existing_hash = next((h for h in existing_hashes if h['hash'] == hash_string), None)
-        if existing_hash:
-            # Yes, this hash is already known and stored, use its ID 
-            hash_ids.append(existing_hash['id'])
-            # Move on to the next block
+def store_stream(stream, send_task_socket, response_socket):
+    """
+    Like store_file, but read the file from a file object block by block, so only the
+    blocks of one lookup batch are held in memory
+
+    :param stream: A binary file object to read the file contents from
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :return: List of hash IDs and a string that indicates deduplication rate
+    """
+    return __store_blocks(utils.read_chunks(stream, BLOCK_SIZE),
+                          send_task_socket, response_socket)
+#
+
+def __receive_store_acks(response_socket, request_id, pending, keep=0):
+    """
+    Wait until at most 'keep' of the sent blocks are left unacknowledged
+
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param request_id: The ID the blocks were sent with
+    :param pending: Set of the hashes of the blocks that are not acknowledged yet
+    :param keep: How many blocks may stay unacknowledged
+    """
+    while len(pending) > keep:
+        resp = utils.receive_response(response_socket, request_id)[0].decode('utf-8')
+        if resp not in pending:
+            print("Dropping unexpected response %s" % resp)
             continue
-        
-        # This is a new block, previously unknown to the system.
-        new_blocks_num += 1
-        
-        # Compress the block and send to a random Storage Node
-        compressed_block = zlib.compress(block)
-        compression_rate = 100*(1-(len(compressed_block)/len(block)))
-        print("New block {} compressed by {:.2f}% with Gzip".format(hash_string, compression_rate))
-        task = messages_pb2.storedata_request()
-        task.filename = hash_string
-        send_task_socket.send_multipart([
-            task.SerializeToString(),
-            compressed_block
-        ])
-        
-        #  Store the new block hash in the DB.
-        cursor = db.execute("INSERT INTO `block_hash`(`hash`) VALUES (?)", [hash_string])
-        new_hash_id = cursor.lastrowid
+        pending.remove(resp)
+#
+
+def __store_blocks(blocks, send_task_socket, response_socket):
+    """
+    Deduplicate and store the blocks of a file. They are handled in batches of
+    LOOKUP_BATCH_BLOCKS: the hashes of a batch are looked up in the DB at once, then its
+    new blocks are Gzipped and sent to the Storage Nodes.
+
+    :param blocks: The blocks of the file, e.g. a generator that reads them
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :return: List of hash IDs and a string that indicates deduplication rate
+    """
+    db = utils.get_db()
+    blocks = iter(blocks)
+
+    # The hashes of all blocks of the file
+    hashes = []
+    # Block hash ID of each hash that is known, None for the new blocks until they
+    # are inserted into the DB
+    hash_ids_by_hash = {}
+    new_hashes = []
+    # The storage nodes send the request ID back with their responses
+    request_id = utils.random_string(8)
+    # Blocks that have been sent but not acknowledged yet
+    pending = set()
+    while True:
+        batch = list(itertools.islice(blocks, LOOKUP_BATCH_BLOCKS))
+        if not batch:
+            break
+
+        # Calculate the MD5 hashes
+        batch_hashes = []
+        for block in batch:
+            h = hashlib.md5()
+            h.update(block)
+            hash_string = h.digest().hex() # Convert the bytes to hex string
+            batch_hashes.append(hash_string)
+        hashes += batch_hashes
+
+        # Figure out which hashes are already stored
+        lookup = list(set(batch_hashes) - hash_ids_by_hash.keys())
+        # Construct a parameterized query that looks like this: 
+        # SELECT hash FROM block_hash WHERE hash IN (?,?,?,?) 
+        query = "SELECT * FROM `block_hash` WHERE `hash` IN ({placeholders})".format(
+            placeholders=','.join(['?']*len(lookup))
+        )
+        cursor = db.execute(query, lookup)
+        existing_hashes = cursor.fetchall()
+        # Convert to dictionaries
+        existing_hashes = [dict(h) for h in existing_hashes]
+        hash_ids_by_hash.update({h['hash']: h['id'] for h in existing_hashes})
+
+        # Iterate the blocks and hashes again. New blocks are Gzipped and sent to the
+        # Storage Nodes
+        for block, hash_string in zip(batch, batch_hashes):
+            # Check if the hash is already known, or repeating within the file
+            if hash_string in hash_ids_by_hash:
+                # Yes, this block is already stored, deduplicate it
+                continue
 
-        # Also, add it to 'existing_hashes' so if it's repeating within 
-        # the file we can deduplicate it
-        existing_hashes.append({
-            "id": new_hash_id,
-            "hash": hash_string
-        })
+            # This is a new block, previously unknown to the system.
+            new_hashes.append(hash_string)
+            hash_ids_by_hash[hash_string] = None
 
-        hash_ids.append(new_hash_id)
+            # Compress the block and send to a random Storage Node
+            compressed_block = zlib.compress(block)
+            compression_rate = 100*(1-(len(compressed_block)/len(block)))
+            print("New block {} compressed by {:.2f}% with Gzip".format(hash_string, compression_rate))
+            task = messages_pb2.storedata_request()
+            task.filename = hash_string
+            task.request_id = request_id
+            pending.add(hash_string)
+            send_task_socket.send_multipart([
+                task.SerializeToString(),
+                compressed_block
+            ])
+        del batch
+
+        # Keep the number of blocks in flight bounded
+        __receive_store_acks(response_socket, request_id, pending, MAX_BLOCKS_IN_FLIGHT)
     # 
 
-    new_blocks = "{}/{}".format(new_blocks_num, len(blocks))
+    # Wait until every new block is stored
+    __receive_store_acks(response_socket, request_id, pending)
+
+    # Store the new block hashes in the DB. Writing locks the DB until the caller
+    # commits, so this is done only after the blocks are stored.
+    for hash_string in new_hashes:
+        cursor = db.execute("INSERT INTO `block_hash`(`hash`) VALUES (?)", [hash_string])
+        hash_ids_by_hash[hash_string] = cursor.lastrowid
+
+    # The BlockHash IDs of all blocks of the file
+    hash_ids = [hash_ids_by_hash[hash_string] for hash_string in hashes]
+
+    new_blocks = "{}/{}".format(len(new_hashes), len(hashes))
     return hash_ids, new_blocks
 #
 
@@ -100,6 +171,24 @@ def get_file(hash_ids, data_req_socket, response_socket):
     """
 
     file_contents = bytearray()
+    for blocks in stream_file(hash_ids, data_req_socket, response_socket):
+        file_contents += blocks
+
+    return file_contents
+#
+
+def stream_file(hash_ids, data_req_socket, response_socket):
+    """
+    Retrieve a compressed file block by block. Up to MAX_BLOCKS_IN_FLIGHT blocks are
+    requested ahead, and the blocks are sent on in order as soon as they arrive.
+    The block hashes are loaded from the DB before the function returns, the blocks
+    are retrieved by the returned generator.
+
+    :param hash_ids: List of hash IDs that identify blocks of the file
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :return: Generator of the decompressed data, several blocks at a time
+    """
 
     # Load the block hashes from DB
     db = utils.get_db()
@@ -107,30 +196,92 @@ def get_file(hash_ids, data_req_socket, response_socket):
         placeholders=','.join(['?']*len(hash_ids))
     )
     cursor = db.execute(query, hash_ids)
-    block_hashes  = [dict(h) for h in cursor.fetchall()]
+    hashes_by_id = {h['id']: h['hash'] for h in cursor.fetchall()}
 
-    # Load each block
+    # Find the block hash record of each block
+    hash_strings = []
     for hash_id in hash_ids:
-        # Find the block hash record
-        block_hash = next((h for h in block_hashes if h['id'] == hash_id), None)
-        if not block_hash:
-            raise ValueError("Hash %d not found in DB!", hash_id)
-
-        hash_string = block_hash['hash']
-        # Load the block from the Storage Node 
-        task = messages_pb2.getdata_request()
-        task.filename = hash_string
-        data_req_socket.send(
-            task.SerializeToString()
-        )
-        result = response_socket.recv_multipart()
-        # First frame: file name (string)
-        filename_received = result[0].decode('utf-8')
-        assert(filename_received == hash_string)
-        # Second frame: data
-        compressed_block = result[1]
-        # Decompress and append to the file contents
-        file_contents += zlib.decompress(compressed_block)
+        if hash_id not in hashes_by_id:
+            raise ValueError("Hash %d not found in DB!" % hash_id)
+        hash_strings.append(hashes_by_id[hash_id])
 
-    return file_contents
-#
\ No newline at end of file
+    return __stream_blocks(hash_strings, data_req_socket, response_socket)
+#
+
+def stream_file_range(hash_ids, start, end, data_req_socket, response_socket):
+    """
+    Retrieve a byte range of a compressed file. Only the blocks that overlap the range
+    are loaded from the DB and the Storage Nodes.
+
+    :param hash_ids: List of hash IDs that identify blocks of the file
+    :param start: First byte of the range
+    :param end: End of the range (exclusive)
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :return: Generator of the decompressed data of the range
+    """
+    assert(0 <= start <= end)
+    # Every block but the last one of the file holds BLOCK_SIZE bytes
+    first_block, end_block = start // BLOCK_SIZE, math.ceil(end / BLOCK_SIZE)
+    blocks = stream_file(hash_ids[first_block:end_block], data_req_socket, response_socket)
+    return utils.slice_chunks(blocks, start - first_block*BLOCK_SIZE,
+                              end - first_block*BLOCK_SIZE)
+#
+
+def __stream_blocks(hash_strings, data_req_socket, response_socket):
+    """
+    Generator that loads the blocks with the given hashes from the Storage Nodes and
+    yields their decompressed data, joining the blocks that are already there.
+    """
+    # The storage nodes send the request ID back with the blocks
+    request_id = utils.random_string(8)
+    # Decompressed blocks that have arrived, by hash
+    blocks = {}
+    # How many of the requested positions of the file need each block
+    needed = collections.Counter()
+    # The position of the next block to request
+    requested = 0
+
+    data = bytearray()
+    for position, hash_string in enumerate(hash_strings):
+        # Keep MAX_BLOCKS_IN_FLIGHT blocks requested ahead, each block only once
+        while requested < min(position + MAX_BLOCKS_IN_FLIGHT, len(hash_strings)):
+            if needed[hash_strings[requested]] == 0:
+                # Load the block from the Storage Node 
+                task = messages_pb2.getdata_request()
+                task.filename = hash_strings[requested]
+                task.request_id = request_id
+                data_req_socket.send(
+                    task.SerializeToString()
+                )
+            needed[hash_strings[requested]] += 1
+            requested += 1
+
+        while hash_string not in blocks:
+            # Take the blocks that have arrived, but don't wait while there is data to
+            # send on
+            result = utils.receive_response(response_socket, request_id,
+                                            time.monotonic() if data else None)
+            if result is None:
+                yield bytes(data)
+                data = bytearray()
+                continue
+            # First frame: file name (string)
+            filename_received = result[0].decode('utf-8')
+            if needed[filename_received] == 0:
+                print("Dropping unexpected response %s" % filename_received)
+                continue
+            # Second frame: data
+            blocks[filename_received] = zlib.decompress(result[1])
+
+        data += blocks[hash_string]
+        needed[hash_string] -= 1
+        if needed[hash_string] == 0:
+            del blocks[hash_string]
+        # Keep the data that is held back bounded as well
+        if len(data) >= MAX_BLOCKS_IN_FLIGHT * BLOCK_SIZE:
+            yield bytes(data)
+            data = bytearray()
+    if data:
+        yield bytes(data)
+#
@@ -0,0 +1,192 @@
+import math
+
+# Selection of the storage mode function that retrieves a file, shared by the Flask
+# (rest-server.py) and asyncio (async-rest-server.py) controllers. The Flask controller
+# calls the function directly, the asyncio controller runs it with async_storage.iterate.
+
+
+def file_reader(f, storage_details, file_range, data_req_socket, response_socket):
+    """
+    Returns the generator function that retrieves a file (or a byte range of it) in
+    chunks with its storage mode, and the arguments to call it with.
+
+    Files stored before the systematic layout, striping, generations, seeds, sparse
+    codes and other fields were introduced have none of these storage details; the
+    defaults describe how they were stored.
+
+    :param f: The file record from the database, as a dictionary
+    :param storage_details: The parsed storage details of the file
+    :param file_range: The (start, end) byte range to retrieve, None for the whole file
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :return: (function, list of arguments), or None if the storage mode is unknown
+    """
+    if f['storage_mode'] == 'raid1':
+        import raid1
+
+        if file_range is not None:
+            # Only retrieve the parts of the halves in the range
+            return raid1.stream_file_range, [
+                storage_details['part1_filenames'],
+                storage_details['part2_filenames'],
+                f['size'],
+                file_range[0],
+                file_range[1],
+                data_req_socket,
+                response_socket
+            ]
+        return raid1.stream_file, [
+            storage_details['part1_filenames'],
+            storage_details['part2_filenames'],
+            data_req_socket,
+            response_socket
+        ]
+
+    elif f['storage_mode'] == 'erasure_coding_rs':
+        import reedsolomon
+
+        coded_fragments = storage_details['coded_fragments']
+        max_erasures = storage_details['max_erasures']
+        # Files stored before the systematic layout and striping were introduced
+        # are not systematic and consist of a single stripe
+        systematic = storage_details.get('systematic', False)
+        stripes = storage_details.get('stripes', 1)
+        # Chunks that may have missed an update are not read until they are repaired
+        stale_chunks = storage_details.get('stale_chunks', [])
+
+        if file_range is not None:
+            # Only retrieve the stripes (and the parts of the fragments) in the range
+            symbol_size = storage_details.get(
+                'symbol_size', math.ceil(f['size']/(len(coded_fragments) - max_erasures)))
+            return reedsolomon.stream_file_range, [
+                coded_fragments,
+                max_erasures,
+                f['size'],
+                symbol_size,
+                file_range[0],
+                file_range[1],
+                data_req_socket,
+                response_socket,
+                systematic,
+                stripes,
+                stale_chunks
+            ]
+        return reedsolomon.stream_file, [
+            coded_fragments,
+            max_erasures,
+            f['size'],
+            data_req_socket,
+            response_socket,
+            systematic,
+            stripes,
+            stale_chunks
+        ]
+
+    elif f['storage_mode'] == 'erasure_coding_rlnc':
+        import rlnc
+
+        # Files stored before generations, seeds, the systematic layout, sparse codes
+        # and other fields were introduced consist of a single generation of dense
+        # coded subfragments with raw GF(2^8) coefficients
+        stale_chunks = storage_details.get('stale_chunks', [])
+        if file_range is not None:
+            # Only retrieve the generations (and the parts of the subfragments) in the
+            # range
+            symbols_num = ((rlnc.STORAGE_NODES_NUM - storage_details['max_erasures'])
+                           * storage_details['subfragments_per_node'])
+            return rlnc.stream_file_range, [
+                storage_details['coded_fragments'],
+                storage_details['max_erasures'],
+                storage_details['subfragments_per_node'],
+                f['size'],
+                storage_details.get('symbol_size', math.ceil(f['size']/symbols_num)),
+                file_range[0],
+                file_range[1],
+                data_req_socket,
+                response_socket,
+                storage_details.get('generations', 1),
+                storage_details.get('coefficient_format', 'raw'),
+                storage_details.get('systematic', False),
+                storage_details.get('density', 1.0),
+                storage_details.get('field', 8),
+                stale_chunks
+            ]
+        return rlnc.stream_file, [
+            storage_details['coded_fragments'],
+            storage_details['max_erasures'],
+            f['size'],
+            data_req_socket,
+            response_socket,
+            storage_details.get('generations', 1),
+            storage_details['subfragments_per_node'],
+            storage_details.get('coefficient_format', 'raw'),
+            storage_details.get('systematic', False),
+            storage_details.get('density', 1.0),
+            storage_details.get('field', 8),
+            stale_chunks
+        ]
+
+    elif f['storage_mode'] == 'erasure_coding_rlnc_stream':
+        import rlnc_stream
+
+        stream = [
+            storage_details['coded_fragments'],
+            storage_details['max_erasures'],
+            storage_details['subfragments_per_node'],
+            storage_details['symbol_size'],
+            storage_details['window']
+        ]
+        stale_chunks = storage_details.get('stale_chunks', [])
+        if file_range is not None:
+            # The steps before the range are decoded as well, see stream_file_range
+            return rlnc_stream.stream_file_range, stream + [
+                file_range[0],
+                file_range[1],
+                data_req_socket,
+                response_socket,
+                storage_details['coefficient_format'],
+                storage_details['field'],
+                stale_chunks
+            ]
+        return rlnc_stream.stream_file, stream + [
+            f['size'],
+            data_req_socket,
+            response_socket,
+            storage_details['coefficient_format'],
+            storage_details['field'],
+            stale_chunks
+        ]
+
+    elif f['storage_mode'] == 's3':
+        # Download the file contents from Amazon S3
+        import s3
+
+        s3_object = [
+            storage_details['region'],
+            storage_details['bucket'],
+            storage_details['object']
+        ]
+        if file_range is not None:
+            return s3.stream_file_range, s3_object + [file_range[0], file_range[1]]
+        return s3.stream_file, s3_object
+
+    elif f['storage_mode'] == 'compressed':
+        import compressed
+
+        if file_range is not None:
+            # Only retrieve the blocks in the range
+            return compressed.stream_file_range, [
+                storage_details['hash_ids'],
+                file_range[0],
+                file_range[1],
+                data_req_socket,
+                response_socket
+            ]
+        return compressed.stream_file, [
+            storage_details['hash_ids'],
+            data_req_socket,
+            response_socket
+        ]
+
+    return None
+#
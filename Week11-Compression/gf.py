@@ -0,0 +1,338 @@
+import numpy as np
+
+# Vectorized GF(2^8) arithmetic on NumPy byte arrays.
+# The field is generated by the primitive polynomial x^8 + x^4 + x^3 + x^2 + 1 (0x11D),
+# the same one used by kodo's binary8 field, so symbols coded here are byte-compatible
+# with symbols coded by kodo.
+#
+# RLNC can also code over GF(2^4) and GF(2^16), selected with the 'field' argument (the
+# number of bits of an element) of the functions below. A smaller field multiplies
+# faster, a larger one makes random coefficient vectors linearly dependent less often.
+# In GF(2^4) every data byte holds two elements, in GF(2^16) every two data bytes hold
+# one (little-endian) element. Coefficients are stored one element per byte in GF(2^4)
+# and GF(2^8) and as little-endian 16 bit words in GF(2^16).
+
+PRIMITIVE_POLYNOMIAL = 0x11D
+FIELD_SIZE = 256
+
+# Supported fields by their number of bits, with their primitive polynomials
+# (x^4 + x + 1 and x^16 + x^12 + x^3 + x + 1)
+PRIMITIVE_POLYNOMIALS = {4: 0x13, 8: PRIMITIVE_POLYNOMIAL, 16: 0x1100B}
+FIELDS = tuple(PRIMITIVE_POLYNOMIALS)
+
+# NumPy type of one field element (of a coefficient)
+ELEMENT_TYPES = {4: np.dtype(np.uint8), 8: np.dtype(np.uint8), 16: np.dtype('<u2')}
+
+# Number of bytes that are multiplied in one go by matmul. Small enough for the
+# lookup tables and the partial results to stay in the CPU cache.
+BLOCK_SIZE = 64*1024
+
+
+def __build_tables(field=8):
+    """
+    Build the exponent (antilog), logarithm and full multiplication tables of a field.
+    GF(2^16) has no full multiplication table, it would take 8 GiB.
+
+    :param field: Number of bits of the field elements
+    :return: The EXP, LOG and MUL (or None) tables as NumPy arrays
+    """
+    size = 1 << field
+    exp = np.zeros(2*size, dtype=np.int64)
+    log = np.zeros(size, dtype=np.int64)
+    x = 1
+    for i in range(size-1):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & size:
+            x ^= PRIMITIVE_POLYNOMIALS[field]
+    # Duplicate the table so that log[a]+log[b] never has to be reduced
+    exp[size-1:2*(size-1)] = exp[:size-1]
+
+    if field > 8:
+        return exp, log, None
+    # MUL[a][b] = a*b, the row MUL[c] is the lookup table for multiplying with c
+    mul = np.zeros((size, size), dtype=np.uint8)
+    nonzero = np.arange(1, size)
+    mul[1:, 1:] = exp[log[nonzero][:, None] + log[nonzero][None, :]]
+
+    return exp, log, mul
+#
+
+__tables = {field: __build_tables(field) for field in FIELDS}
+EXP_TABLE, LOG_TABLE, MUL_TABLE = __tables[8]
+
+# BYTE_MUL[c][x] = c*x for every byte x, in GF(2^4) both halves of the byte are
+# multiplied with c: the lookup tables for multiplying bytes of data with a coefficient
+BYTE_MUL_TABLES = {
+    4: (__tables[4][2][:, np.arange(256) >> 4] << 4) | __tables[4][2][:, np.arange(256) & 15],
+    8: MUL_TABLE,
+}
+
+
+def __mul(a, b, field):
+    """
+    Element-wise product of two arrays (or scalars) of field elements, with broadcasting.
+    """
+    if field <= 8:
+        return __tables[field][2][a, b]
+    exp, log, _ = __tables[field]
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    product = exp[log[a] + log[b]].astype(ELEMENT_TYPES[field])
+    return np.where((a != 0) & (b != 0), product, 0).astype(ELEMENT_TYPES[field])
+#
+
+
+def multiply(a, b, field=8):
+    """
+    Multiply two field elements.
+    """
+    return int(__mul(a, b, field))
+#
+
+def inverse(a, field=8):
+    """
+    Multiplicative inverse of a non-zero field element.
+    """
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(2^%d)" % field)
+    exp, log, _ = __tables[field]
+    return int(exp[(1 << field) - 1 - log[a]])
+#
+
+
+def cauchy_matrix(xs, ys):
+    """
+    Build the Cauchy matrix C[i][j] = 1/(x_i + y_j). If all x_i and y_j are distinct, every
+    square submatrix of it is invertible, which is what makes it a good MDS code generator.
+
+    :param xs: Row elements
+    :param ys: Column elements, disjoint from xs
+    :return: (len(xs) x len(ys)) uint8 matrix
+    """
+    assert(len(set(xs)) + len(set(ys)) == len(set(xs) | set(ys)) == len(xs) + len(ys))
+    matrix = np.zeros((len(xs), len(ys)), dtype=np.uint8)
+    for i, x in enumerate(xs):
+        for j, y in enumerate(ys):
+            matrix[i][j] = inverse(x ^ y)
+    return matrix
+#
+
+
+def matmul(matrix, data, out=None, field=8):
+    """
+    Multiply a coefficient matrix with rows of data: out[r] = sum_j matrix[r][j] * data[j].
+    This is the core operation of encoding, decoding and recoding.
+
+    Four output rows are computed at once: for each input row we build a table that maps
+    a data byte to the four products packed into a 32 bit word (split-table multiply),
+    so each data byte is looked up only once no matter how many output rows there are.
+    Input rows with a zero coefficient in all four output rows are skipped, so sparse
+    matrices are multiplied faster.
+
+    :param matrix: (rows x k) coefficient matrix, uint8 (uint16 in GF(2^16))
+    :param data: (k x length) uint8 array with the input rows
+    :param out: Optional (rows x length) uint8 array to write the result into
+    :param field: Number of bits of the field elements
+    :return: (rows x length) uint8 array with the output rows
+    """
+    if field == 16:
+        return __matmul16(matrix, data, out)
+    byte_mul = BYTE_MUL_TABLES[field]
+    matrix = np.asarray(matrix, dtype=np.uint8)
+    data = np.asarray(data, dtype=np.uint8)
+    rows, k = matrix.shape
+    assert(data.shape[0] == k)
+    length = data.shape[1]
+
+    if out is None:
+        out = np.empty((rows, length), dtype=np.uint8)
+    for group in range(0, rows, 4):
+        group_rows = matrix[group:group+4]
+        group_size = group_rows.shape[0]
+
+        # tables[j][x] = (c0*x) | (c1*x)<<8 | (c2*x)<<16 | (c3*x)<<24, c_i = group_rows[i][j]
+        tables = np.zeros((k, 256), dtype=np.uint32)
+        for i in range(group_size):
+            tables |= byte_mul[group_rows[i]].astype(np.uint32) << (8*i)
+        # The input rows that contribute to this group of output rows
+        used = np.flatnonzero(group_rows.any(axis=0))
+
+        for start in range(0, length, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, length)
+            if len(used) == 0:
+                acc = np.zeros(end - start, dtype=np.uint32)
+            else:
+                acc = tables[used[0]].take(data[used[0], start:end])
+            for j in used[1:]:
+                acc ^= tables[j].take(data[j, start:end])
+            # Unpack the 32 bit words to one byte per output row
+            out[group:group+group_size, start:end] = \
+                acc.view(np.uint8).reshape(end-start, 4)[:, :group_size].T
+    return out
+#
+
+
+def __matmul16(matrix, data, out=None):
+    """
+    matmul in GF(2^16). Like in GF(2^8), four output rows are computed at once, but an
+    element has two bytes: the products with its low and its high byte are looked up in
+    two tables of 256 entries that pack four 16 bit products into a 64 bit word.
+    """
+    matrix = np.asarray(matrix, dtype=ELEMENT_TYPES[16])
+    data = np.asarray(data, dtype=np.uint8)
+    rows, k = matrix.shape
+    assert(data.shape[0] == k)
+    length = data.shape[1]
+    assert(length % 2 == 0)
+
+    if out is None:
+        out = np.empty((rows, length), dtype=np.uint8)
+    values = np.arange(256)
+    for group in range(0, rows, 4):
+        group_rows = matrix[group:group+4]
+        group_size = group_rows.shape[0]
+
+        # low[j][x] = sum_i (c_i*x) << 16i, high[j][x] = sum_i (c_i*(x<<8)) << 16i
+        low = np.zeros((k, 256), dtype=np.uint64)
+        high = np.zeros((k, 256), dtype=np.uint64)
+        for i in range(group_size):
+            coefficients = group_rows[i][:, None]
+            low |= __mul(coefficients, values, 16).astype(np.uint64) << np.uint64(16*i)
+            high |= __mul(coefficients, values << 8, 16).astype(np.uint64) << np.uint64(16*i)
+        used = np.flatnonzero(group_rows.any(axis=0))
+
+        for start in range(0, length, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, length)
+            acc = np.zeros((end - start) // 2, dtype=np.uint64)
+            for j in used:
+                acc ^= low[j].take(data[j, start:end:2])
+                acc ^= high[j].take(data[j, start+1:end:2])
+            out[group:group+group_size, start:end].view(ELEMENT_TYPES[16])[:] = \
+                acc.view(ELEMENT_TYPES[16]).reshape(-1, 4)[:, :group_size].T
+    return out
+#
+
+
+def add_scaled(data, delta, coefficient, field=8):
+    """
+    Add a multiple of one row of bytes to another: data + coefficient*delta. In a coded
+    symbol this applies a change 'delta' of the source symbol that has the coefficient
+    'coefficient' in it.
+
+    :param data: Bytes-like object with the row to add to
+    :param delta: Bytes-like object of the same length (even in GF(2^16))
+    :param coefficient: The field element to multiply delta with
+    :param field: Number of bits of the field elements
+    :return: The result as bytes
+    """
+    data = np.frombuffer(data, dtype=ELEMENT_TYPES[field] if field == 16 else np.uint8)
+    delta = np.frombuffer(delta, dtype=data.dtype)
+    if field == 16:
+        return (data ^ __mul(coefficient, delta, field)).tobytes()
+    return (data ^ BYTE_MUL_TABLES[field][coefficient][delta]).tobytes()
+#
+
+
+def random_coefficients(seed, count):
+    """
+    Uniformly distributed random field elements generated from a seed, like the
+    RandomUniform coefficient generator of kodo: the same seed always gives the same
+    vector, so a coded symbol can carry its seed instead of its coefficient vector.
+    The generator is SplitMix64, which is simple enough to give the same result
+    everywhere.
+
+    :param seed: Non-negative integer seed
+    :param count: Number of elements to generate
+    :return: bytes with 'count' field elements
+    """
+    mask = (1 << 64) - 1
+    state = seed & mask
+    out = bytearray()
+    while len(out) < count:
+        state = (state + 0x9E3779B97F4A7C15) & mask
+        z = state
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask
+        z ^= z >> 31
+        out += z.to_bytes(8, 'little')
+    return bytes(out[:count])
+#
+
+
+def reduce_row(basis, row, field=8):
+    """
+    One step of an incremental Gaussian elimination: eliminate the pivot columns of the
+    rows in 'basis' from a new row, and add the result to the basis if it is not zero,
+    that is if the row is linearly independent of the basis. len(basis) is the rank.
+
+    :param basis: List of (pivot column, row) tuples, built by this function. Each row
+                  has a 1 in its pivot column and 0 in the pivot columns of the rows
+                  before it.
+    :param row: The new row as an array of field elements or bytes-like object
+    :param field: Number of bits of the field elements
+    :return: True if the row was added to the basis
+    """
+    row = np.frombuffer(row, dtype=ELEMENT_TYPES[field]).copy()
+    for pivot, basis_row in basis:
+        if row[pivot]:
+            row ^= __mul(row[pivot], basis_row, field)
+    nonzero = np.nonzero(row)[0]
+    if len(nonzero) == 0:
+        return False
+    pivot = nonzero[0]
+    basis.append((pivot, __mul(inverse(row[pivot], field), row, field)))
+    return True
+#
+
+
+def independent_rows(matrix, field=8):
+    """
+    Select a maximal set of linearly independent rows of a matrix, greedily from the
+    first row on.
+
+    :param matrix: (rows x k) matrix of field elements
+    :param field: Number of bits of the field elements
+    :return: List with the indices of the selected rows
+    """
+    basis = []
+    return [index for index, row in enumerate(np.asarray(matrix, dtype=ELEMENT_TYPES[field]))
+            if reduce_row(basis, row, field)]
+#
+
+
+def invert_matrix(matrix, field=8):
+    """
+    Invert a square matrix over the field using Gauss-Jordan elimination.
+
+    :param matrix: (k x k) matrix of field elements
+    :param field: Number of bits of the field elements
+    :return: The (k x k) inverse matrix
+    :raises ValueError: if the matrix is singular
+    """
+    matrix = np.array(matrix, dtype=ELEMENT_TYPES[field])
+    k = matrix.shape[0]
+    assert(matrix.shape == (k, k))
+
+    # Work on the augmented matrix [M | I]
+    work = np.concatenate([matrix, np.eye(k, dtype=matrix.dtype)], axis=1)
+    for col in range(k):
+        # Find a pivot row
+        pivots = np.nonzero(work[col:, col])[0]
+        if len(pivots) == 0:
+            raise ValueError("Matrix is singular, the symbols are not linearly independent")
+        pivot = col + pivots[0]
+        if pivot != col:
+            work[[col, pivot]] = work[[pivot, col]]
+
+        # Scale the pivot row so that the pivot becomes 1
+        work[col] = __mul(inverse(work[col, col], field), work[col], field)
+
+        # Eliminate the column from every other row
+        factors = work[:, col].copy()
+        factors[col] = 0
+        work ^= __mul(factors[:, None], work[col][None, :], field)
+
+    return work[:, k:]
+#
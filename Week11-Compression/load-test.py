@@ -0,0 +1,112 @@
+"""
+Aarhus University - Distributed Storage course - Lab 11
+
+Load test of the REST API: several clients upload files at the same time, then download
+them again and check their contents. Prints the throughput of the uploads and the
+downloads, run it against rest-server.py and async-rest-server.py to compare them.
+
+Usage: python load-test.py [clients] [files] [size in KiB] [storage mode] [server URL]
+
+Results with 4 storage nodes and the controller on one machine with a single CPU core,
+256 KiB raid1 files, in files/s (upload / download):
+
+    storage node latency   rest-server.py, 1 client   async-rest-server.py
+    none                   152 / 224                  1 client: 68 / 119,  64 clients: 78 / 163
+    5 ms                   48 / 86                    1 client: 37 / 62,   64 clients: 69 / 160
+    20 ms                  27 / 36                    1 client: 22 / 30,   16 clients: 66 / 150
+
+The latency was added to the responses of the storage nodes. With more than one
+client, rest-server.py stops responding: its request threads share the sockets to the
+storage nodes and drop each other's responses. The asyncio controller is slower for a
+single client, every storage operation is handed to a worker thread, but it serves
+concurrent clients. Its throughput grows with the latency of the storage nodes until
+the CPU is saturated.
+"""
+import os
+import sys
+import time
+import uuid
+import json
+import concurrent.futures
+import urllib.request
+import urllib.error
+
+
+def upload(url, data, storage_mode):
+    """
+    Upload a file as multipart form data.
+
+    :return: The ID of the new file
+    """
+    boundary = uuid.uuid4().hex
+    body = (("--%s\r\n"
+             "Content-Disposition: form-data; name=\"storage\"\r\n\r\n"
+             "%s\r\n"
+             "--%s\r\n"
+             "Content-Disposition: form-data; name=\"file\"; filename=\"load-test.bin\"\r\n"
+             "Content-Type: application/octet-stream\r\n\r\n")
+            % (boundary, storage_mode, boundary)).encode('utf-8')
+    body += data + ("\r\n--%s--\r\n" % boundary).encode('utf-8')
+    request = urllib.request.Request(url + "/files_mp", data=body, method='POST', headers={
+        "Content-Type": "multipart/form-data; boundary=%s" % boundary})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())["id"]
+#
+
+
+def download(url, file_id):
+    """
+    Returns the contents of a file.
+    """
+    with urllib.request.urlopen("%s/files/%d" % (url, file_id)) as response:
+        return response.read()
+#
+
+
+def run(clients, tasks):
+    """
+    Run the tasks with 'clients' concurrent clients.
+
+    :return: (elapsed seconds, list of the results, number of failed tasks)
+    """
+    results = []
+    errors = 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as executor:
+        for future in [executor.submit(task) for task in tasks]:
+            try:
+                results.append(future.result())
+            except (urllib.error.URLError, ConnectionError) as e:
+                print("Request failed: %s" % e)
+                results.append(None)
+                errors += 1
+    return time.perf_counter() - start, results, errors
+#
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    size = int(sys.argv[3]) * 1024 if len(sys.argv) > 3 else 1024*1024
+    storage_mode = sys.argv[4] if len(sys.argv) > 4 else 'raid1'
+    url = sys.argv[5] if len(sys.argv) > 5 else "http://localhost:9000"
+
+    contents = [os.urandom(size) for _ in range(files)]
+    print("%d clients, %d files of %d KiB, %s" % (clients, files, size // 1024, storage_mode))
+
+    seconds, file_ids, errors = run(clients, [
+        (lambda data=data: upload(url, data, storage_mode)) for data in contents])
+    print("Upload:   %8.2f files/s %8.2f MiB/s, %d failed"
+          % (files / seconds, files*size / seconds / (1024*1024), errors))
+
+    stored = [(file_id, data) for file_id, data in zip(file_ids, contents) if file_id is not None]
+    seconds, downloads, errors = run(clients, [
+        (lambda file_id=file_id: download(url, file_id)) for file_id, _ in stored])
+    wrong = sum(1 for (_, data), downloaded in zip(stored, downloads)
+                if downloaded is not None and downloaded != data)
+    print("Download: %8.2f files/s %8.2f MiB/s, %d failed, %d with wrong contents"
+          % (len(stored) / seconds, len(stored)*size / seconds / (1024*1024), errors, wrong))
+#
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@ import messages_pb2
 import math
 import random
 
-from utils import random_string
+from utils import random_string, receive_response, read_chunk
 
 def store_file(file_data, send_task_socket, response_socket):
     """
@@ -17,36 +17,77 @@ def store_file(file_data, send_task_socket, response_socket):
     size = len(file_data)
 
     # RAID 1: cut the file in half and store both halves 2x
-    file_data_1 = file_data[:math.ceil(size/2.0)]
-    file_data_2 = file_data[math.ceil(size/2.0):]
+    halves = (file_data[:math.ceil(size/2.0)], file_data[math.ceil(size/2.0):])
+    return __store_halves(halves, send_task_socket, response_socket)
+#
+
+def store_stream(stream, size, send_task_socket, response_socket):
+    """
+    Implements storing a file with RAID 1 using 4 storage nodes, reading it from a file
+    object. Only one half of the file is held in memory at a time.
+
+    :param stream: A binary file object to read the file contents from
+    :param size: The size of the file
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :return: A list of the random generated chunk names, e.g. (c1,c2), (c3,c4)
+    """
+    # Each half is read when it is sent
+    halves = (read_chunk(stream, length) for length in (math.ceil(size/2.0), size//2))
+    return __store_halves(halves, send_task_socket, response_socket)
+#
+
+def __store_halves(halves, send_task_socket, response_socket):
+    """
+    Store both halves of a file 2x.
+
+    :param halves: The data of the first and of the second half
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :return: A list of the random generated chunk names, e.g. (c1,c2), (c3,c4)
+    """
+    halves = iter(halves)
 
     # Generate two random chunk names for each half
     file_data_1_names = [random_string(8), random_string(8)]
     file_data_2_names = [random_string(8), random_string(8)]
     print("Filenames for part 1: %s" % file_data_1_names)
     print("Filenames for part 2: %s" % file_data_2_names)
+    # The storage nodes send the request ID back with their responses
+    request_id = random_string(8)
 
     # Send 2 'store data' Protobuf requests with the first half and chunk names
+    file_data_1 = next(halves)
     for name in file_data_1_names:
         task = messages_pb2.storedata_request()
         task.filename = name
+        task.request_id = request_id
         send_task_socket.send_multipart([
             task.SerializeToString(),
             file_data_1
         ])
+    del file_data_1
 
     # Send 2 'store data' Protobuf requests with the second half and chunk names
+    file_data_2 = next(halves)
     for name in file_data_2_names:
         task = messages_pb2.storedata_request()
         task.filename = name
+        task.request_id = request_id
         send_task_socket.send_multipart([
             task.SerializeToString(),
             file_data_2
         ])
-
-    # Wait until we receive 4 responses from the workers
-    for task_nbr in range(4):
-        resp = response_socket.recv_string()
+    del file_data_2
+
+    # Wait until we receive a response for each of the 4 chunks
+    pending = set(file_data_1_names + file_data_2_names)
+    while pending:
+        resp = receive_response(response_socket, request_id)[0].decode('utf-8')
+        if resp not in pending:
+            print("Dropping unexpected response %s" % resp)
+            continue
+        pending.remove(resp)
         print('Received: %s' % resp)
     
     # Return the chunk names of each replica
@@ -63,26 +104,96 @@ def get_file(part1_filenames, part2_filenames, data_req_socket, response_socket)
     :param response_socket: A ZMQ PULL socket where the storage nodes respond.
     :return: The original file contents
     """
+    # Combine the parts and return
+    file_data = bytearray()
+    for part in stream_file(part1_filenames, part2_filenames, data_req_socket,
+                            response_socket):
+        file_data += part
+    return file_data
+#
+
+def stream_file(part1_filenames, part2_filenames, data_req_socket, response_socket):
+    """
+    Generator that retrieves a file stored with RAID 1 and yields its first half as soon
+    as it arrives, then the second half.
+
+    :param part1_filenames: List of chunk names that store the first half
+    :param part2_filenames: List of chunk names that store the second half
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :return: Generator of the two halves of the file
+    """
     # Select one chunk of each half
     part1_filename = part1_filenames[random.randint(0, len(part1_filenames)-1)]
     part2_filename = part2_filenames[random.randint(0, len(part2_filenames)-1)]
 
-    # Request both chunks in parallel
-    task1 = messages_pb2.getdata_request()
-    task1.filename = part1_filename
-    data_req_socket.send(
-        task1.SerializeToString()
-    )
-    task2 = messages_pb2.getdata_request()
-    task2.filename = part2_filename
-    data_req_socket.send(
-        task2.SerializeToString()
-    )
-
-    # Receive both chunks and insert them to 
-    file_data_parts = [None, None]
-    for _ in range(2):
-        result = response_socket.recv_multipart()
+    yield from __stream_parts([(part1_filename, 0, 0), (part2_filename, 0, 0)],
+                              data_req_socket, response_socket)
+    print("Both chunks received successfully")
+#
+
+def stream_file_range(part1_filenames, part2_filenames, file_size, start, end,
+                      data_req_socket, response_socket):
+    """
+    Generator that retrieves a byte range of a file stored with RAID 1. Only the parts
+    of the halves that overlap the range are requested from the storage nodes.
+
+    :param part1_filenames: List of chunk names that store the first half
+    :param part2_filenames: List of chunk names that store the second half
+    :param file_size: The size of the file
+    :param start: First byte of the range
+    :param end: End of the range (exclusive)
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :return: Generator of the parts of the range in each half
+    """
+    assert(0 <= start <= end <= file_size)
+    half_size = math.ceil(file_size/2.0)
+
+    parts = []
+    for filenames, half_start, half_end in ((part1_filenames, 0, half_size),
+                                            (part2_filenames, half_size, file_size)):
+        # The part of the range that falls into this half
+        part_start, part_end = max(start, half_start), min(end, half_end)
+        if part_start < part_end:
+            filename = filenames[random.randint(0, len(filenames)-1)]
+            parts.append((filename, part_start - half_start, part_end - part_start))
+
+    yield from __stream_parts(parts, data_req_socket, response_socket)
+#
+
+def __stream_parts(parts, data_req_socket, response_socket):
+    """
+    Generator that requests the parts of chunks in parallel and yields them in order as
+    soon as they arrive. A part that arrives early is kept until the ones before it are
+    sent on.
+
+    :param parts: List of (chunk name, offset, length) of the parts, a length of 0 means
+                  up to the end of the chunk
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :return: Generator of the data of the parts
+    """
+    # The storage nodes send the request ID back with the chunks
+    request_id = random_string(8)
+
+    # Request all parts in parallel
+    for filename, offset, length in parts:
+        task = messages_pb2.getdata_request()
+        task.filename = filename
+        task.request_id = request_id
+        task.offset = offset
+        task.length = length
+        data_req_socket.send(
+            task.SerializeToString()
+        )
+
+    # Receive the parts, the later ones are kept until the ones before them are sent on
+    positions = {filename: position for position, (filename, _, _) in enumerate(parts)}
+    file_data_parts = [None]*len(parts)
+    next_part = 0
+    while next_part < len(parts):
+        result = receive_response(response_socket, request_id)
         # First frame: file name (string)
         filename_received = result[0].decode('utf-8')
         # Second frame: data
@@ -90,16 +201,13 @@ def get_file(part1_filenames, part2_filenames, data_req_socket, response_socket)
 
         print("Received %s" % filename_received)
 
-        if filename_received == part1_filename:
-            # The first part was received
-            file_data_parts[0] = chunk_data
+        if filename_received in positions:
+            file_data_parts[positions[filename_received]] = chunk_data
         else:
-            # The second part was received
-            file_data_parts[1] = chunk_data
+            print("Dropping unexpected response %s" % filename_received)
 
-    print("Both chunks received successfully")
-    
-    # Combine the parts and return
-    file_data = file_data_parts[0] + file_data_parts[1]
-    return file_data
-#
\ No newline at end of file
+        while next_part < len(parts) and file_data_parts[next_part] is not None:
+            yield file_data_parts[next_part]
+            file_data_parts[next_part] = b''
+            next_part += 1
+#
@@ -1,89 +1,376 @@
-import kodo
 import math
 import random
-import copy # for deepcopy
-from utils import random_string
+import collections
+import functools
+import os
+import time
+from utils import random_string, stripe_chunk_name, receive_response, read_chunk, chunks, \
+    symbol_range_parts, chunk_status, delete_stale_chunks
 import messages_pb2
 import json
 
-STORAGE_NODES_NUM = 4
+import numpy as np
+import gf
+import workers
 
-RS_CAUCHY_COEFFS = [
-    bytearray([253, 126, 255, 127]),
-    bytearray([126, 253, 127, 255]),
-    bytearray([255, 127, 253, 126]),
-    bytearray([127, 255, 126, 253])
-]
+try:
+    import kodo
+except ImportError:
+    # kodo is a binary module that is not available on every platform,
+    # the NumPy codec is used without it
+    kodo = None
 
-def store_file(file_data, max_erasures, send_task_socket, response_socket):
+# Number of storage nodes in the cluster. A file can have at most this many fragments.
+STORAGE_NODES_NUM = int(os.environ.get('STORAGE_NODES_NUM', 4))
+
+# The engine used for coding: 'kodo' or 'numpy'. Both produce the same coefficient-prefixed
+# fragments, so files stored with one can be read with the other. Set it with the
+# ERASURE_CODEC environment variable or by assigning reedsolomon.CODEC at runtime.
+CODEC = os.environ.get('ERASURE_CODEC', 'kodo' if kodo else 'numpy')
+
+# Maximum amount of file data that is encoded at once. Larger files are cut to stripes of
+# (about) this size, so the controller never holds more than a few stripes in memory.
+STRIPE_SIZE = 16*1024*1024
+
+# How many stripes may have been sent to the storage nodes without being acknowledged
+MAX_STRIPES_IN_FLIGHT = 2
+
+# How many decoding matrices (one per set of surviving fragments) are kept in memory
+DECODING_CACHE_SIZE = 128
+
+# Hedged reads: how many fragments to request on top of the k that are needed, so one
+# slow or dead node does not hold up the read (None: request all fragments)
+HEDGED_READ_EXTRA = 1
+
+# How long (in milliseconds) to wait for the first k fragments of a stripe before
+# requesting all the remaining fragments as well
+DEGRADED_READ_TIMEOUT = 1000
+
+# Deadline (in milliseconds) for retrieving the k fragments of one stripe
+READ_TIMEOUT = 10000
+
+@functools.lru_cache(maxsize=None)
+def coefficient_matrix(k, m, systematic=False):
+    """
+    Generates the coefficient vectors of the k+m fragments of a file, any k of which are
+    enough to decode it. The matrices are cached, so each parameter set is built only once.
+
+    Without the systematic layout every fragment is coded with a row of the Cauchy matrix
+    1/(x_i + y_j), x_i = i, y_j = 255 - j (for k+m=4 this is the fixed table that was used
+    before the geometry became configurable). With the systematic layout the first k rows
+    are unit vectors, followed by the Cauchy parity rows x_i = k+m+i, y_j = j.
+
+    :param k: How many fragments are needed to reconstruct the file
+    :param m: How many fragments can be lost (max_erasures)
+    :param systematic: Whether the file uses the systematic layout
+    :return: Read-only (k+m x k) uint8 matrix, one coefficient vector per row
+    """
+    n = k + m
+    if k < 1 or m < 0:
+        raise ValueError("Invalid code parameters k=%d, m=%d" % (k, m))
+
+    if systematic:
+        if n + m > gf.FIELD_SIZE:
+            raise ValueError("k+2m must be at most %d for a systematic code" % gf.FIELD_SIZE)
+        parity = gf.cauchy_matrix([n + i for i in range(m)], list(range(k)))
+        matrix = np.concatenate([np.eye(k, dtype=np.uint8), parity])
+    else:
+        if n + k > gf.FIELD_SIZE:
+            raise ValueError("2k+m must be at most %d" % gf.FIELD_SIZE)
+        matrix = gf.cauchy_matrix(list(range(n)), [gf.FIELD_SIZE-1 - j for j in range(k)])
+
+    matrix.setflags(write=False)
+    return matrix
+#
+
+
+@functools.lru_cache(maxsize=DECODING_CACHE_SIZE)
+def decoding_matrix(k, m, systematic, survivors):
+    """
+    Returns the inverse of the coefficient vectors of the surviving fragments. Multiplying
+    the surviving fragments' data with it gives back the original data, so a degraded read
+    does not have to repeat the Gaussian elimination every time. The matrices are cached;
+    decoding_matrix.cache_info() reports the hits and misses.
+
+    :param k: How many fragments are needed to reconstruct the file
+    :param m: How many fragments can be lost (max_erasures)
+    :param systematic: Whether the file uses the systematic layout
+    :param survivors: Sorted tuple of the indices of the k fragments used for decoding
+    :return: Read-only (k x k) uint8 matrix
+    """
+    matrix = gf.invert_matrix(coefficient_matrix(k, m, systematic)[list(survivors)])
+    matrix.setflags(write=False)
+    return matrix
+#
+
+
+@functools.lru_cache(maxsize=DECODING_CACHE_SIZE)
+def repair_matrix(k, m, systematic, survivors, lost):
+    """
+    Returns the matrix that produces lost fragments directly from k surviving ones: the
+    coefficient vectors of the lost fragments times the inverse of the survivors'. A
+    repair is then a single multiplication with it, instead of decoding the whole stripe
+    and encoding it again.
+
+    :param k: How many fragments are needed to reconstruct the file
+    :param m: How many fragments can be lost (max_erasures)
+    :param systematic: Whether the file uses the systematic layout
+    :param survivors: Sorted tuple of the indices of the k fragments used for the repair
+    :param lost: Tuple of the indices of the fragments to repair
+    :return: Read-only (lost x k) uint8 matrix
+    """
+    matrix = gf.matmul(coefficient_matrix(k, m, systematic)[list(lost)],
+                       decoding_matrix(k, m, systematic, survivors))
+    matrix.setflags(write=False)
+    return matrix
+#
+
+
+def __encode_fragments(file_data, coefficients, symbols, symbol_size):
+    """
+    Produce one coded fragment for each coefficient vector with the selected codec.
+    Each fragment is the coefficient vector followed by the coded symbol data.
+
+    :param file_data: The data to encode, at most symbols*symbol_size bytes
+    :param coefficients: (fragments x symbols) matrix, one coefficient vector per row
+    :param symbols: Number of source symbols
+    :param symbol_size: Size of one source symbol
+    :return: List of coded fragments
+    """
+    if CODEC == 'kodo':
+        # Kodo RLNC encoder using 2^8 finite field
+        encoder = kodo.RLNCEncoder(kodo.field.binary8, symbols, symbol_size)
+        encoder.set_symbols_storage(bytearray(file_data))
+        return [bytearray(vector) + bytearray(encoder.produce_symbol(bytearray(vector)))
+                for vector in coefficients]
+
+    # Cut the zero-padded data to source symbols, one per row. Both arrays are in shared
+    # memory for large stripes, so the worker processes code them in place.
+    source = workers.empty((symbols, symbol_size))
+    source.reshape(-1)[:len(file_data)] = np.frombuffer(file_data, dtype=np.uint8)
+    source.reshape(-1)[len(file_data):] = 0
+    # Code directly behind the coefficients, so the fragments need no further copies
+    fragments = workers.empty((len(coefficients), symbols + symbol_size))
+    fragments[:, :symbols] = coefficients
+    coded = []
+    for i in range(len(coefficients)):
+        nonzero = np.flatnonzero(fragments[i, :symbols])
+        if len(nonzero) == 1 and fragments[i, nonzero[0]] == 1:
+            # Unit vector (systematic data fragment): the symbol is a plain copy
+            fragments[i, symbols:] = source[nonzero[0]]
+        else:
+            coded.append(i)
+
+    # Code the other fragments together (in parallel, for large stripes)
+    if coded:
+        first, end = coded[0], coded[-1] + 1
+        if end - first == len(coded):
+            workers.matmul(fragments[first:end, :symbols], source,
+                           out=fragments[first:end, symbols:])
+        else:
+            fragments[coded, symbols:] = workers.matmul(fragments[coded, :symbols], source)
+    return list(fragments)
+#
+
+
+def __receive_store_acks(response_socket, request_id, pending, keep=0):
+    """
+    Wait for the storage nodes to acknowledge stored chunks, until at most 'keep' chunks
+    are left unacknowledged. Responses to other requests are dropped.
+
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param request_id: The ID the chunks were sent with
+    :param pending: Set of the chunk names that were sent but not acknowledged yet
+    :param keep: How many chunks may stay unacknowledged
+    """
+    while len(pending) > keep:
+        resp = receive_response(response_socket, request_id)
+        name = resp[0].decode('utf-8')
+        if len(resp) > 1 or name not in pending:
+            print("Dropping unexpected response %s" % name)
+            continue
+        pending.remove(name)
+        print('Received: %s' % name)
+#
+
+
+def __store_stripes(stripes, fragment_names, first_stripe, coefficients, symbols,
+                    symbol_size, send_task_socket, response_socket):
+    """
+    Encode stripes of a file one after the other and send their fragments to the storage
+    nodes. ZMQ sends the fragments in the background while the next stripe is encoded.
+
+    :param stripes: The data of the stripes, starting with the first one. It may be a
+                    generator that reads each stripe only when it is encoded.
+    :param fragment_names: Names of the fragments of the file
+    :param first_stripe: Index of the first stripe
+    :param coefficients: The coefficient matrix of the code
+    :param symbols: Number of source symbols per stripe (k)
+    :param symbol_size: Size of one source symbol
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    """
+    # The storage nodes send the request ID back with their acknowledgements
+    request_id = random_string(8)
+    # Chunks that have been sent but not acknowledged yet
+    pending = set()
+    for stripe, stripe_data in enumerate(stripes, first_stripe):
+        # Generate one coded fragment for each Storage Node with the next Reed Solomon
+        # coefficient vector
+        fragments = __encode_fragments(stripe_data, coefficients, symbols, symbol_size)
+        del stripe_data
+
+        for name, fragment in zip(fragment_names, fragments):
+            # Send a Protobuf STORE DATA request to the Storage Nodes
+            task = messages_pb2.storedata_request()
+            task.filename = stripe_chunk_name(name, stripe)
+            task.request_id = request_id
+            pending.add(task.filename)
+
+            send_task_socket.send_multipart([
+                task.SerializeToString(),
+                fragment
+            ])
+        del fragments
+
+        # To keep the memory use bounded, wait for the acks of older stripes before going on
+        __receive_store_acks(response_socket, request_id, pending,
+                             keep=len(fragment_names) * (MAX_STRIPES_IN_FLIGHT - 1))
+    
+    # Wait until we receive a response for every remaining fragment
+    __receive_store_acks(response_socket, request_id, pending)
+#
+
+
+def __stripe_geometry(file_size, symbols, symbol_size=None):
+    """
+    Returns the symbol size and the number of stripes of a file. The size of one coded
+    fragment of a stripe is the stripe size/number of symbols, rounded up. Every stripe
+    has the same size, only the last one is padded.
+
+    :param file_size: The size of the file
+    :param symbols: Number of source symbols per stripe (k)
+    :param symbol_size: The size of the symbols of each stripe
+                        (default: just large enough for the file, at most STRIPE_SIZE/k)
+    :return: The symbol size and the number of stripes
+    """
+    if symbol_size is None:
+        symbol_size = min(math.ceil(file_size/symbols), math.ceil(STRIPE_SIZE/symbols))
+    stripe_size = symbols * symbol_size
+    stripes = max(1, math.ceil(file_size/stripe_size)) if stripe_size > 0 else 1
+    return symbol_size, stripes
+#
+
+
+def store_file(file_data, max_erasures, send_task_socket, response_socket, systematic=False,
+               k=None, symbol_size=None):
     """
     Store a file using Reed Solomon erasure coding, protecting it against 'max_erasures' 
-    unavailable storage nodes. 
+    unavailable storage nodes. The file is cut to k pieces and coded to k+max_erasures
+    fragments, each sent to a different storage node. With the systematic layout the first
+    fragments are plain slices of the file and only the last 'max_erasures' are coded.
+    Files larger than STRIPE_SIZE are cut to stripes that are encoded and sent one after
+    the other; each fragment then consists of one chunk per stripe.
     The erasure coding part codes are the customized version of the 'encode_decode_using_coefficients'
     example of kodo-python, where you can find a detailed description of each step.
+    The coding itself is done by kodo or the NumPy codec, depending on CODEC.
 
     :param file_data: The file contents to be stored as a Python bytearray 
     :param max_erasures: How many storage node failures should the data survive
     :param send_task_socket: A ZMQ PUSH socket to the storage nodes
     :param response_socket: A ZMQ PULL socket where the storage nodes respond
-    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4)
+    :param systematic: Store the file with the systematic layout
+    :param k: How many fragments are needed to reconstruct the file
+              (default: use every storage node, k = STORAGE_NODES_NUM - max_erasures)
+    :param symbol_size: The size of the symbols of each stripe
+                        (default: just large enough for the file, at most STRIPE_SIZE/k)
+    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4), the number of
+             stripes and the symbol size
+    """
+
+    # How many coded fragments (=symbols) will be required to reconstruct the encoded data. 
+    symbols = k if k is not None else STORAGE_NODES_NUM - max_erasures
+
+    # Make sure we can realize max_erasures with the available storage nodes
+    assert(max_erasures >= 0)
+    assert(symbols > 0)
+    assert(symbols + max_erasures <= STORAGE_NODES_NUM)
+
+    symbol_size, stripes = __stripe_geometry(len(file_data), symbols, symbol_size)
+    stripe_size = symbols * symbol_size
+    coefficients = coefficient_matrix(symbols, max_erasures, systematic)
+
+    # Generate a random name for each fragment
+    fragment_names = [random_string(8) for _ in range(len(coefficients))]
+
+    file_view = memoryview(file_data)
+    __store_stripes((file_view[i*stripe_size:(i + 1)*stripe_size] for i in range(stripes)),
+                    fragment_names, 0, coefficients, symbols, symbol_size,
+                    send_task_socket, response_socket)
+
+    return fragment_names, stripes, symbol_size
+#
+
+
+def store_stream(stream, file_size, max_erasures, send_task_socket, response_socket,
+                 systematic=False, k=None):
     """
+    Store a file like store_file, reading it from a file object one stripe at a time:
+    each stripe is read just before it is encoded, so no more than MAX_STRIPES_IN_FLIGHT
+    stripes of the file are held in memory. The fragments are the same as with
+    store_file.
 
-    # Make sure we can realize max_erasures with 4 storage nodes
+    :param stream: A binary file object to read the file contents from
+    :param file_size: The size of the file
+    :param max_erasures: How many storage node failures should the data survive
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param systematic: Store the file with the systematic layout
+    :param k: How many fragments are needed to reconstruct the file
+              (default: use every storage node, k = STORAGE_NODES_NUM - max_erasures)
+    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4), the number of
+             stripes and the symbol size
+    """
+    symbols = k if k is not None else STORAGE_NODES_NUM - max_erasures
     assert(max_erasures >= 0)
-    assert(max_erasures < STORAGE_NODES_NUM)
+    assert(symbols > 0)
+    assert(symbols + max_erasures <= STORAGE_NODES_NUM)
 
-    # How many coded fragments (=symbols) will be required to reconstruct the encoded data. 
-    symbols = STORAGE_NODES_NUM - max_erasures
-    # The size of one coded fragment (total size/number of symbols, rounded up)
-    symbol_size = math.ceil(len(file_data)/symbols)
-    # Kodo RLNC encoder using 2^8 finite field
-    encoder = kodo.RLNCEncoder(kodo.field.binary8, symbols, symbol_size)
-    encoder.set_symbols_storage(file_data)
-
-    fragment_names = []
-
-    # Generate one coded fragment for each Storage Node
-    for i in range(STORAGE_NODES_NUM):
-        # Select the next Reed Solomon coefficient vector 
-        coefficients = RS_CAUCHY_COEFFS[i]
-        # Generate a coded fragment with these coefficients 
-        # (trim the coeffs to the actual length we need)
-        symbol = encoder.produce_symbol(coefficients[:symbols])
-        # Generate a random name for it and save
-        name = random_string(8)
-        fragment_names.append(name)
-        
-        # Send a Protobuf STORE DATA request to the Storage Nodes
-        task = messages_pb2.storedata_request()
-        task.filename = name
+    symbol_size, stripes = __stripe_geometry(file_size, symbols)
+    coefficients = coefficient_matrix(symbols, max_erasures, systematic)
+    fragment_names = [random_string(8) for _ in range(len(coefficients))]
 
-        send_task_socket.send_multipart([
-            task.SerializeToString(),
-            coefficients[:symbols] + bytearray(symbol)
-        ])
-    
-    # Wait until we receive a response for every fragment
-    for task_nbr in range(STORAGE_NODES_NUM):
-        resp = response_socket.recv_string()
-        print('Received: %s' % resp)
+    __store_stripes((read_chunk(stream, symbols * symbol_size) for _ in range(stripes)),
+                    fragment_names, 0, coefficients, symbols, symbol_size,
+                    send_task_socket, response_socket)
 
-    return fragment_names
+    return fragment_names, stripes, symbol_size
 #
 
 
 def decode_file(symbols):
     """
     Decode a file using Reed Solomon decoder and the provided coded symbols.
-    The number of symbols must be the same as STORAGE_NODES_NUM - max_erasures.
+    The number of symbols must be the same as k, the number of fragments needed to decode.
 
     :param symbols: coded symbols that contain both the coefficients and symbol data
     :return: the decoded file data
     """
 
-    # Reconstruct the original data with a decoder
     symbols_num = len(symbols)
     symbol_size = len(symbols[0]['data']) - symbols_num #subtract the coefficients' size
+
+    if CODEC == 'numpy':
+        # Separate the coefficients from the symbol data, one symbol per row
+        coefficients = np.array([symbol['data'][:symbols_num] for symbol in symbols], dtype=np.uint8)
+        symbol_data = np.array([np.frombuffer(symbol['data'], dtype=np.uint8, offset=symbols_num)
+                                for symbol in symbols])
+        # Solve the linear system by multiplying with the inverse of the coefficient matrix
+        data_out = workers.matmul(gf.invert_matrix(coefficients), symbol_data)
+        print("File decoded successfully")
+        return bytearray(data_out)
+
+    # Reconstruct the original data with a decoder
     decoder = kodo.RLNCDecoder(kodo.field.binary8, symbols_num, symbol_size)
     data_out = bytearray(decoder.block_size())
     decoder.set_symbols_storage(data_out)
@@ -103,92 +390,689 @@ def decode_file(symbols):
 #
 
 
-def get_file(coded_fragments, max_erasures, file_size,
-             data_req_socket, response_socket):
+def __receive_fragments(fragnames, response_socket, symbols, request_id, deadline=None):
     """
-    Implements retrieving a file that is stored with Reed Solomon erasure coding
+    Receive the requested fragments from the storage nodes, until 'symbols' of them arrived.
+    Responses to other requests (e.g. fragments that arrived too late for an earlier
+    read, possibly of another range or from before an update) and duplicates are dropped.
 
-    :param coded_fragments: Names of the coded fragments
-    :param max_erasures: Max erasures setting that was used when storing the file
-    :param file_size: The original data size. 
-    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param fragnames: Names of the requested fragments
     :param response_socket: A ZMQ PULL socket where the storage nodes respond.
-    :return: A list of the random generated chunk names, e.g. (c1,c2), (c3,c4)
+    :param symbols: How many fragments to wait for
+    :param request_id: The ID the fragments were requested with
+    :param deadline: Give up at this time.monotonic() time (default: wait forever)
+    :return: List of the received fragments in the same format as decode_file() expects
+    """
+    received = []
+    received_names = set()
+    while len(received) < symbols:
+        result = receive_response(response_socket, request_id, deadline)
+        if result is None:
+            break
+        # Responses contain the chunk name and then the data
+        chunkname = result[0].decode('utf-8')
+        if len(result) < 2 or chunkname not in fragnames or chunkname in received_names:
+            print("Dropping unexpected fragment %s" % chunkname)
+            continue
+        received_names.add(chunkname)
+        received.append({
+            "chunkname": chunkname, 
+            "data": bytearray(result[1])
+        })
+    return received
+#
+
+
+def __decode_fragments(symbols, chunk_names, max_erasures, systematic):
+    """
+    Decode (a range of) a stripe from any k of its fragments. With the NumPy codec this is
+    a single matrix multiplication with the cached inverse for this set of surviving
+    fragments.
+
+    :param symbols: The received fragments, without the coefficients at their beginning
+    :param chunk_names: Names of all chunks of the stripe, in fragment order
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param systematic: Whether the file was stored with the systematic layout
+    :return: (k x symbol size) array with the data of the stripe (including the padding)
+    """
+    symbols_num = len(chunk_names) - max_erasures
+    # Order the fragments by their index, so the rows match the cached inverse
+    by_index = sorted(((chunk_names.index(symbol['chunkname']), symbol) for symbol in symbols),
+                      key=lambda indexed: indexed[0])
+
+    if CODEC != 'numpy':
+        # kodo expects the coefficients in front of the symbol data
+        coefficients = coefficient_matrix(symbols_num, max_erasures, systematic)
+        data_out = decode_file([{"data": bytearray(coefficients[index]) + symbol['data']}
+                                for index, symbol in by_index])
+        return np.frombuffer(data_out, dtype=np.uint8).reshape(symbols_num, -1)
+
+    survivors = tuple(index for index, _ in by_index)
+    inverse = decoding_matrix(symbols_num, max_erasures, systematic, survivors)
+
+    symbol_data = workers.empty((len(by_index), len(by_index[0][1]['data'])))
+    for row, (_, symbol) in enumerate(by_index):
+        symbol_data[row] = np.frombuffer(symbol['data'], dtype=np.uint8)
+    return workers.matmul(inverse, symbol_data)
+#
+
+
+def __join_data_fragments(symbols, chunk_names, symbols_num):
+    """
+    Reassemble (a range of) a systematic stripe from its data fragments, without any
+    decoding.
+
+    :param symbols: The data fragments, in any order
+    :param chunk_names: Names of all chunks of the stripe, in fragment order
+    :param symbols_num: k, the number of data fragments
+    :return: (k x symbol size) array with the data of the stripe (including the padding).
+             Rows of the data fragments that were not received are zero.
+    """
+    symbol_size = len(symbols[0]['data'])
+    data_out = np.zeros((symbols_num, symbol_size), dtype=np.uint8)
+    for symbol in symbols:
+        data_out[chunk_names.index(symbol['chunkname'])] = np.frombuffer(symbol['data'],
+                                                                         dtype=np.uint8)
+    return data_out
+#
+
+
+def __request_fragments(fragnames, data_req_socket, request_id, offset=0, length=0):
+    """
+    Request the given fragments (or the same byte range of each) from the storage nodes
+    in parallel. The nodes send the request ID back with the fragments.
     """
-    
-    # We need 4-max_erasures fragments to reconstruct the file, select this many 
-    # by randomly removing 'max_erasures' elements from the given chunk names. 
-    fragnames = copy.deepcopy(coded_fragments)
-    for i in range(max_erasures):
-        fragnames.remove(random.choice(fragnames))
-    
-    # Request the coded fragments in parallel
     for name in fragnames:
         task = messages_pb2.getdata_request()
         task.filename = name
+        task.request_id = request_id
+        task.offset = offset
+        task.length = length
         data_req_socket.send(
             task.SerializeToString()
             )
+#
 
-    # Receive all chunks and insert them into the symbols array
-    symbols = []
-    for _ in range(len(fragnames)):
-        result = response_socket.recv_multipart()
-        # In this case we don't care about the received name, just use the 
-        # data from the second frame
-        symbols.append({
-            "chunkname": result[0].decode('utf-8'), 
-            "data": bytearray(result[1])
-        })
-    print("All coded fragments received successfully")
 
-    #Reconstruct the original file data
-    file_data = decode_file(symbols)
+def __get_stripe(chunk_names, max_erasures, systematic, data_req_socket, response_socket,
+                 rows=None, columns=None, stale_chunks=()):
+    """
+    Retrieve and decode one stripe of a file stored with Reed Solomon erasure coding.
+    This is a hedged read: k+HEDGED_READ_EXTRA fragments are requested and the first k
+    that arrive are used. If k fragments don't arrive within DEGRADED_READ_TIMEOUT, the
+    remaining fragments are requested as well.
+    Only the symbol data is requested from the storage nodes, not the coefficients that
+    are stored in front of it, and optionally only a range of its columns: since each byte
+    of a fragment only depends on the bytes at the same position of the data fragments,
+    a range of columns can be decoded on its own.
+    Chunks that may have missed an update are never read.
 
-    return file_data[:file_size]
+    :param chunk_names: Names of the chunks of this stripe, one for each fragment
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param systematic: Whether the file was stored with the systematic layout
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param rows: The data fragments that are needed (default: all). Only used to skip
+                 requesting the other data fragments of systematic stripes.
+    :param columns: The (start, end) range of the symbol columns to retrieve
+                    (default: the whole symbols)
+    :param stale_chunks: Names of the chunks that may have missed an update
+    :return: (k x length) array with the requested columns of the data fragments
+    :raises TimeoutError: if k fragments did not arrive within READ_TIMEOUT
+    :raises FileNotFoundError: if fewer than k chunks of the stripe are up to date
+    """
+    # We need k = n-max_erasures fragments to reconstruct the stripe
+    symbols_num = len(chunk_names) - max_erasures
+    extra = max_erasures if HEDGED_READ_EXTRA is None else min(HEDGED_READ_EXTRA, max_erasures)
+    if rows is None:
+        rows = range(symbols_num)
+    # Skip the coefficients at the beginning of each fragment
+    offset, length = symbols_num, 0
+    if columns is not None:
+        offset, length = symbols_num + columns[0], columns[1] - columns[0]
+
+    usable = [name for name in chunk_names if name not in stale_chunks]
+    if len(usable) < symbols_num:
+        raise FileNotFoundError("Only %d of the %d fragments needed are up to date, the "
+                                "file must be repaired" % (len(usable), symbols_num))
+
+    if systematic and all(chunk_names[row] in usable for row in rows):
+        # Prefer the data fragments, which need no decoding, and hedge with parity fragments
+        parity = [name for name in chunk_names[symbols_num:] if name in usable]
+        fragnames = [chunk_names[row] for row in rows] + \
+                    random.sample(parity, min(extra, len(parity)))
+        needed = len(rows)
+    else:
+        # Any k fragments will do, select k+extra at random
+        fragnames = random.sample(usable, min(symbols_num + extra, len(usable)))
+        needed = symbols_num
+    # Responses to earlier reads that arrive late have another request ID
+    request_id = random_string(8)
+    __request_fragments(fragnames, data_req_socket, request_id, offset, length)
+
+    start = time.monotonic()
+    symbols = __receive_fragments(fragnames, response_socket, needed, request_id,
+                                  deadline=start + DEGRADED_READ_TIMEOUT/1000)
+    data_only = systematic and len(symbols) == needed and \
+                all(chunk_names.index(symbol["chunkname"]) < symbols_num for symbol in symbols)
+
+    if not data_only and len(symbols) < symbols_num:
+        # Degraded read: some nodes are slow or down, request every remaining fragment and
+        # use whichever arrive first
+        print("Only %d of %d fragments received, requesting the remaining fragments"
+              % (len(symbols), needed))
+        remaining_names = [name for name in usable if name not in fragnames]
+        __request_fragments(remaining_names, data_req_socket, request_id, offset, length)
+        received_names = [symbol["chunkname"] for symbol in symbols]
+        symbols += __receive_fragments([name for name in usable if name not in received_names],
+                                       response_socket, symbols_num - len(symbols), request_id,
+                                       deadline=start + READ_TIMEOUT/1000)
+
+        if len(symbols) < symbols_num:
+            raise TimeoutError("Only %d of the %d fragments needed arrived within %d ms"
+                               % (len(symbols), symbols_num, READ_TIMEOUT))
+
+    if data_only:
+        # Healthy read: the file is just the data fragments one after the other
+        print("All data fragments received successfully")
+        return __join_data_fragments(symbols, chunk_names, symbols_num)
+
+    print("Coded fragments received successfully")
+    #Reconstruct the original file data
+    return __decode_fragments(symbols, chunk_names, max_erasures, systematic)
 #
 
 
-def get_file_for_repair(fragments_to_retrieve, file_size,
-                        repair_socket, repair_response_socket):
+def get_file(coded_fragments, max_erasures, file_size,
+             data_req_socket, response_socket, systematic=False, stripes=1,
+             stale_chunks=()):
     """
-    Implements retrieving a file that is stored with Reed Solomon erasure coding for use
-    in the repair process. Apart from the communication with the storage nodes, the
-    implementation is similar to how a file is retrieved using get_file.
+    Implements retrieving a file that is stored with Reed Solomon erasure coding.
+    Each stripe is read with hedged requests and decoded from the first k fragments that
+    arrive. Files with the systematic layout are read from their data fragments when
+    those arrive first, so healthy reads need no decoding.
 
-    :param fragments_to_retrieve: Names of the coded fragments that should be retrieved
+    :param coded_fragments: Names of the coded fragments
+    :param max_erasures: Max erasures setting that was used when storing the file
     :param file_size: The original data size. 
     :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
     :param response_socket: A ZMQ PULL socket where the storage nodes respond.
-    :return: A list of the random generated chunk names, e.g. (c1,c2), (c3,c4)
+    :param systematic: Whether the file was stored with the systematic layout
+    :param stripes: How many stripes the file was cut to
+    :param stale_chunks: Names of the chunks that may have missed an update, which are
+                         not read
+    :return: The decoded file
+    :raises TimeoutError: if a stripe could not be retrieved within READ_TIMEOUT
+    :raises FileNotFoundError: if fewer than k chunks of a stripe are up to date
     """
-    
-    # Request the coded fragments in parallel.
-    for name in fragments_to_retrieve:
+    file_data = bytearray()
+    for stripe_data in stream_file(coded_fragments, max_erasures, file_size,
+                                   data_req_socket, response_socket, systematic, stripes,
+                                   stale_chunks):
+        file_data += stripe_data
+
+    return file_data
+#
+
+
+def stream_file(coded_fragments, max_erasures, file_size,
+                data_req_socket, response_socket, systematic=False, stripes=1,
+                stale_chunks=()):
+    """
+    Generator version of get_file: retrieves the stripes of a file one after the other
+    and yields the data of each as soon as it is decoded, so only one stripe of the file
+    is held in memory. The parameters are the same as those of get_file.
+
+    :return: Generator of the decoded data of each stripe, without the padding
+    :raises TimeoutError: if a stripe could not be retrieved within READ_TIMEOUT
+    :raises FileNotFoundError: if fewer than k chunks of a stripe are up to date
+    """
+    remaining = file_size
+    for stripe in range(stripes):
+        chunk_names = [stripe_chunk_name(name, stripe) for name in coded_fragments]
+        stripe_data = __get_stripe(chunk_names, max_erasures, systematic,
+                                   data_req_socket, response_socket,
+                                   stale_chunks=stale_chunks).reshape(-1)
+        yield stripe_data[:remaining].tobytes()
+        remaining -= min(remaining, len(stripe_data))
+#
+
+
+def get_file_range(coded_fragments, max_erasures, file_size, symbol_size, start, end,
+                   data_req_socket, response_socket, systematic=False, stripes=1,
+                   stale_chunks=()):
+    """
+    Implements retrieving a byte range of a file that is stored with Reed Solomon
+    erasure coding. Only the stripes that overlap the range are retrieved, and only the
+    columns of the symbols that hold the range are requested (see symbol_range_parts),
+    so the cost of a short read does not depend on the size of the file. Systematic
+    files are read from the data fragments that hold the range when possible.
+
+    :param coded_fragments: Names of the coded fragments
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param file_size: The original data size.
+    :param symbol_size: The size of the symbols of each stripe
+    :param start: First byte of the range
+    :param end: End of the range (exclusive)
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param systematic: Whether the file was stored with the systematic layout
+    :param stripes: How many stripes the file was cut to
+    :param stale_chunks: Names of the chunks that may have missed an update, which are
+                         not read
+    :return: The requested bytes of the file
+    :raises TimeoutError: if a stripe could not be retrieved within READ_TIMEOUT
+    :raises FileNotFoundError: if fewer than k chunks of a stripe are up to date
+    """
+    file_data = bytearray()
+    for data in stream_file_range(coded_fragments, max_erasures, file_size, symbol_size,
+                                  start, end, data_req_socket, response_socket,
+                                  systematic, stripes, stale_chunks):
+        file_data += data
+
+    return file_data
+#
+
+
+def stream_file_range(coded_fragments, max_erasures, file_size, symbol_size, start, end,
+                      data_req_socket, response_socket, systematic=False, stripes=1,
+                      stale_chunks=()):
+    """
+    Generator version of get_file_range: yields the part of the range in each stripe as
+    soon as it is retrieved. The parameters are the same as those of get_file_range.
+
+    :return: Generator of the requested bytes of each stripe that overlaps the range
+    :raises TimeoutError: if a stripe could not be retrieved within READ_TIMEOUT
+    :raises FileNotFoundError: if fewer than k chunks of a stripe are up to date
+    """
+    assert(0 <= start <= end <= file_size)
+    symbols_num = len(coded_fragments) - max_erasures
+    stripe_size = symbols_num * symbol_size
+
+    if start == end:
+        return
+    for stripe in range(start // stripe_size, math.ceil(end / stripe_size)):
+        chunk_names = [stripe_chunk_name(name, stripe) for name in coded_fragments]
+        # The part of the range that falls into this stripe
+        stripe_start = max(start - stripe*stripe_size, 0)
+        stripe_end = min(end - stripe*stripe_size, stripe_size)
+
+        # The data fragments that hold this part of the range, and their columns
+        for part_start, part_end, first_row, last_row, columns in \
+                symbol_range_parts(stripe_start, stripe_end, symbol_size):
+            data = __get_stripe(chunk_names, max_erasures, systematic, data_req_socket,
+                                response_socket, range(first_row, last_row + 1), columns,
+                                stale_chunks)
+            # Cut the range out of the data fragments
+            data = data[first_row:last_row + 1].reshape(-1)
+            offset = first_row*symbol_size + columns[0]
+            yield data[part_start - offset:part_end - offset].tobytes()
+#
+
+
+def __send_update(chunk_names, symbols_num, symbol_index, offset, delta, request_id,
+                  repair_socket):
+    """
+    Send a change of one source symbol to the storage nodes, which apply it to every
+    chunk of the stripe that they store. Each chunk receives the delta multiplied by its
+    own coefficient for the symbol, so the controller sends the same bytes to every node.
+
+    :param chunk_names: Names of the chunks of the stripe
+    :param symbols_num: k, the length of the coefficient vectors
+    :param symbol_index: Index of the changed source symbol
+    :param offset: Position of the change within the symbol
+    :param delta: The old data XOR the new data
+    :param request_id: The ID the nodes acknowledge the update with
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    """
+    task = messages_pb2.update_fragments_request()
+    task.fragment_names.extend(chunk_names)
+    task.symbol_count = symbols_num
+    task.symbol_index = symbol_index
+    task.offset = offset
+
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.UPDATE_FRAGMENT_DATA_REQ
+    header.request_id = request_id
+
+    repair_socket.send_multipart([b"all_nodes",
+                                  header.SerializeToString(),
+                                  task.SerializeToString(),
+                                  delta])
+#
+
+
+def __receive_update_acks(repair_response_socket, request_id, pending):
+    """
+    Wait until every chunk has been updated by the storage nodes. Every node acknowledges
+    every chunk of an update with the parts of it that it updated, so a chunk that no
+    node stores is told apart from a slow node.
+
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param request_id: The ID the updates were sent with
+    :param pending: Counter of the updated chunk names, once for each update sent. The
+                    acknowledged updates are removed from it.
+    :raises TimeoutError: if the updates were not acknowledged within READ_TIMEOUT
+    :raises FileNotFoundError: if all storage nodes answered that they don't store a chunk
+    """
+    # Number of acknowledgements without the chunk that mean that no node stores it
+    all_absent = {name: count*STORAGE_NODES_NUM for name, count in pending.items()}
+    absent = collections.Counter()
+    missing = sum(pending.values())
+    deadline = time.monotonic() + READ_TIMEOUT/1000
+    while missing > 0:
+        resp = receive_response(repair_response_socket, request_id, deadline)
+        if resp is None:
+            raise TimeoutError("%d chunk updates were not acknowledged within %d ms"
+                               % (missing, READ_TIMEOUT))
+        ack = messages_pb2.fragment_status_response()
+        ack.ParseFromString(resp[0])
+        name = ack.fragment_name
+        if name not in all_absent:
+            print("Dropping unexpected response %s" % name)
+            continue
+        if not ack.chunks:
+            absent[name] += 1
+            if absent[name] == all_absent[name]:
+                raise FileNotFoundError("Chunk %s is not stored on any storage node" % name)
+            continue
+        pending[name] -= 1
+        missing -= 1
+#
+
+
+def update_file(coded_fragments, max_erasures, file_size, symbol_size, offset, data,
+                data_req_socket, response_socket, send_task_socket,
+                repair_socket, repair_response_socket, systematic=False, stripes=1,
+                stale_chunks=None):
+    """
+    Implements overwriting part of a file, or appending to it, that is stored with Reed
+    Solomon erasure coding without encoding the file again. The code is linear, so
+    changing the original data by 'delta' changes each fragment by its coefficient times
+    'delta': only the changed bytes are read and sent to the storage nodes as deltas,
+    which the nodes apply to the fragments they store. Appended data first fills the
+    padding of the last stripe; data beyond that is encoded as new stripes.
+    A file that is smaller than one full stripe has small symbols, so when it outgrows
+    them it is stored again (under new fragment names) with symbols at least twice as
+    large. A file that grows in small steps is thus rewritten only a few times.
+    The chunks to change are checked before the first delta is sent. If some storage
+    nodes do not acknowledge the update after all, the chunks that may have missed it
+    are added to 'stale_chunks'. They are not read until they are repaired.
+
+    :param coded_fragments: Names of the coded fragments
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param file_size: The original data size.
+    :param symbol_size: The size of the symbols of each stripe
+    :param offset: Where to write the data, at most file_size
+    :param data: The new data
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param systematic: Whether the file was stored with the systematic layout
+    :param stripes: How many stripes the file was cut to
+    :param stale_chunks: List of the names of the chunks that may have missed an earlier
+                         update, which are not read. If the update fails, the chunks that
+                         may have missed it are added to it.
+    :return: The fragment names, file size, number of stripes and symbol size after the
+             update
+    :raises TimeoutError: if the data could not be read or updated within READ_TIMEOUT
+    :raises FileNotFoundError: if a chunk to update is not stored on any storage node,
+                               or too few chunks of a stripe are up to date
+    """
+    assert(0 <= offset <= file_size)
+    if stale_chunks is None:
+        stale_chunks = []
+    symbols_num = len(coded_fragments) - max_erasures
+    stripe_size = symbols_num * symbol_size
+    full_symbol_size = math.ceil(STRIPE_SIZE/symbols_num)
+
+    data = memoryview(data)
+    end = offset + len(data)
+    capacity = stripes * stripe_size
+
+    if end > capacity and symbol_size < full_symbol_size:
+        # The file is a single stripe with small symbols: store it again with larger ones
+        file_data = get_file(coded_fragments, max_erasures, file_size,
+                             data_req_socket, response_socket, systematic, stripes,
+                             stale_chunks)
+        file_data[offset:end] = data
+        symbol_size = min(max(2*symbol_size, math.ceil(end/symbols_num)), full_symbol_size)
+        coded_fragments, stripes, symbol_size = store_file(
+            file_data, max_erasures, send_task_socket, response_socket, systematic,
+            symbols_num, symbol_size)
+        print("File stored again with symbol size %d" % symbol_size)
+        return coded_fragments, end, stripes, symbol_size
+
+    # Encode the data beyond the last stripe as new stripes with the same geometry. They
+    # are stored first: until the file size is updated, they are not used if the update
+    # of the existing stripes fails.
+    new_stripes = stripes
+    if end > capacity:
+        new_stripes = stripes + math.ceil((end - capacity) / stripe_size)
+        __store_stripes(chunks(data[capacity - offset:], stripe_size), coded_fragments,
+                        stripes, coefficient_matrix(symbols_num, max_erasures, systematic),
+                        symbols_num, symbol_size, send_task_socket, response_socket)
+
+    # The part of the existing stripes that changes, including their padding
+    update_end = min(end, capacity)
+    if offset < update_end:
+        # The padding is read as well: it is zero, unless an update that failed changed
+        # it on the chunks that acknowledged it
+        old_data = get_file_range(coded_fragments, max_erasures, capacity, symbol_size,
+                                  offset, update_end, data_req_socket, response_socket,
+                                  systematic, stripes, stale_chunks)
+        delta = np.frombuffer(old_data, dtype=np.uint8) ^ \
+                np.frombuffer(data[:update_end - offset], dtype=np.uint8)
+
+        # The delta of each source symbol it touches
+        updates = []
+        position = offset
+        while position < update_end:
+            stripe, stripe_offset = divmod(position, stripe_size)
+            symbol_index, symbol_offset = divmod(stripe_offset, symbol_size)
+            length = min(symbol_size - symbol_offset, update_end - position)
+            symbol_delta = delta[position - offset:position - offset + length]
+            if symbol_delta.any():
+                updates.append((stripe, symbol_index, symbol_offset, symbol_delta.tobytes()))
+            position += length
+
+        # Make sure that every chunk of the changed stripes can be updated
+        changed_chunks = [stripe_chunk_name(name, stripe)
+                          for stripe in sorted(set(update[0] for update in updates))
+                          for name in coded_fragments]
+        holders = chunk_status(changed_chunks, STORAGE_NODES_NUM, READ_TIMEOUT,
+                               repair_socket, repair_response_socket)
+        for name in changed_chunks:
+            if name not in holders:
+                raise FileNotFoundError("Chunk %s is not stored on any storage node" % name)
+
+        request_id = random_string(8)
+        pending = collections.Counter()
+        for stripe, symbol_index, symbol_offset, symbol_delta in updates:
+            chunk_names = [stripe_chunk_name(name, stripe) for name in coded_fragments]
+            __send_update(chunk_names, symbols_num, symbol_index, symbol_offset,
+                          symbol_delta, request_id, repair_socket)
+            pending.update(chunk_names)
+        try:
+            __receive_update_acks(repair_response_socket, request_id, pending)
+        except (TimeoutError, FileNotFoundError):
+            # The chunks that were not acknowledged must not be used until they are repaired
+            stale_chunks += [name for name, count in pending.items()
+                             if count > 0 and name not in stale_chunks]
+            raise
+        print("Updated %d bytes in %d chunks" % (update_end - offset,
+                                                 len(updates)*len(coded_fragments)))
+
+    return coded_fragments, max(file_size, end), new_stripes, symbol_size
+#
+
+
+def __get_fragments_for_repair(fragnames, symbols_num, repair_socket, repair_response_socket):
+    """
+    Retrieve the symbol data of the given fragments (without the coefficients at their
+    beginning) on the repair sockets.
+
+    :param fragnames: Names of the fragments to retrieve
+    :param symbols_num: k, the length of the coefficient vectors
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :return: Dictionary of the fragments' symbol data by name, without the ones that did
+             not arrive within READ_TIMEOUT
+    """
+    # Request the fragments in parallel.
+    request_id = random_string(8)
+    for name in fragnames:
         task = messages_pb2.getdata_request()
         task.filename = name
+        task.offset = symbols_num
         header = messages_pb2.header()
         header.request_type = messages_pb2.FRAGMENT_DATA_REQ
+        header.request_id = request_id
         repair_socket.send_multipart([b"all_nodes",
                                       header.SerializeToString(),
                                       task.SerializeToString()])
 
-    # Receive all chunks and insert them into the symbols array
-    symbols = []
-    for _ in range(len(fragments_to_retrieve)):
-        result = repair_response_socket.recv_multipart()
-        # In this case we don't care about the received name, just use the 
-        # data from the second frame
-        symbols.append({
-            "chunkname": result[0].decode('utf-8'), 
-            "data": bytearray(result[1])
-        })
-    print(str(len(fragments_to_retrieve)) + " coded fragments received successfully")
+    received = {}
+    deadline = time.monotonic() + READ_TIMEOUT/1000
+    while len(received) < len(fragnames):
+        result = receive_response(repair_response_socket, request_id, deadline)
+        if result is None:
+            print("%d fragments did not arrive within %d ms"
+                  % (len(fragnames) - len(received), READ_TIMEOUT))
+            break
+        received[result[0].decode('utf-8')] = result[1]
+    print(str(len(received)) + " fragments received successfully")
+    return received
+#
 
-    #Reconstruct the original file data
-    file_data = decode_file(symbols)
 
-    return file_data[:file_size]# Reconstruct the original data with a decoder
+def __repair_stripe(chunk_names, storage_details, repair_socket, repair_response_socket):
+    """
+    Checks that all chunks of one stripe of a file are stored on the storage nodes and
+    repairs the missing ones.
+
+    :param chunk_names: Names of the chunks of this stripe, one for each fragment
+    :param storage_details: The storage details of the file
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :return: the number of missing fragments, the number of repaired fragments
+    """
+
+    #Ask every node about each coded fragment to check that it is not missing
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.FRAGMENT_STATUS_REQ
+    header.request_id = random_string(8)
+    for fragment in chunk_names:
+        task = messages_pb2.fragment_status_request()
+        task.fragment_name = fragment
+        repair_socket.send_multipart([b"all_nodes",
+                                      header.SerializeToString(),
+                                      task.SerializeToString()])
+
+    nodes = set() # list of all storage nodes
+    nodes_with_fragment = set() # list of storage nodes with fragments
+    missing_fragments = [] # list of missing coded fragments
+    existing_fragments = set() # set of existing coded fragments
+    # Wait until we receive a response from each node. Nodes that do not answer within
+    # READ_TIMEOUT are treated as nodes without the fragments.
+    answers = 0
+    deadline = time.monotonic() + READ_TIMEOUT/1000
+    while answers < len(chunk_names) * STORAGE_NODES_NUM:
+        resp = receive_response(repair_response_socket, header.request_id, deadline)
+        if resp is None:
+            print("%d fragment status requests were not answered within %d ms"
+                  % (len(chunk_names) * STORAGE_NODES_NUM - answers, READ_TIMEOUT))
+            break
+        response = messages_pb2.fragment_status_response()
+        response.ParseFromString(resp[0])
+        answers += 1
+
+        nodes.add(response.node_id) #Build a set of nodes
+        if response.is_present == True:
+            nodes_with_fragment.add(response.node_id)
+            existing_fragments.add(response.fragment_name)
+
+    for fragment in chunk_names:
+        if fragment not in existing_fragments:
+            print("Fragment %s lost" % fragment)
+            missing_fragments.append(fragment)
+        else:
+            print("Fragment %s OK" % fragment)
+
+    if len(missing_fragments) == 0:
+        return 0, 0
+
+    # If we have lost fragments, we must figure out where they were stored
+    # We assume that each node has exactly 1 or 0 fragments
+    nodes_without_fragment = list(nodes.difference(nodes_with_fragment))
+
+    # Check that enough fragments still remain to be able to repair
+    if len(missing_fragments) > storage_details["max_erasures"]:
+        print("Too many lost fragments: %s. Unable to repair file. " % len(missing_fragments))
+        return len(missing_fragments), 0
+
+    # Each repaired fragment is stored on a node that does not have one of this stripe
+    if len(nodes_without_fragment) < len(missing_fragments):
+        print("Only %d storage nodes are available for %d lost fragments. Unable to "
+              "repair file." % (len(nodes_without_fragment), len(missing_fragments)))
+        return len(missing_fragments), 0
+
+    # Retrieve sufficient fragments, without their coefficients
+    symbols = len(chunk_names) - storage_details["max_erasures"]
+    survivors = sorted(chunk_names.index(name) for name in existing_fragments)[:symbols]
+    received = __get_fragments_for_repair([chunk_names[index] for index in survivors],
+                                          symbols, repair_socket, repair_response_socket)
+    if len(received) < symbols:
+        print("Only %d of the %d fragments needed arrived. Unable to repair file."
+              % (len(received), symbols))
+        return len(missing_fragments), 0
+    symbol_data = workers.empty((symbols, len(received[chunk_names[survivors[0]]])))
+    for row, index in enumerate(survivors):
+        symbol_data[row] = np.frombuffer(received[chunk_names[index]], dtype=np.uint8)
+
+    # Produce all missing fragments in one pass over the surviving ones, right behind
+    # their Reed Solomon coefficient vectors
+    lost = [chunk_names.index(missing_fragment) for missing_fragment in missing_fragments]
+    code = (symbols, storage_details["max_erasures"], storage_details.get("systematic", False))
+    fragments = workers.empty((len(lost), symbols + symbol_data.shape[1]))
+    fragments[:, :symbols] = coefficient_matrix(*code)[lost]
+    workers.matmul(repair_matrix(*code, tuple(survivors), tuple(lost)), symbol_data,
+                   out=fragments[:, symbols:])
+
+    request_id = random_string(8)
+    for missing_fragment, fragment, node_id in zip(missing_fragments, fragments,
+                                                   nodes_without_fragment):
+        # Save with the same name as before
+        # Send a Protobuf STORE DATA request to the Storage Nodes
+        task = messages_pb2.storedata_request()
+        task.filename = missing_fragment
+
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
+        header.request_id = request_id
+
+        #Use the node_id as the topic
+        repair_socket.send_multipart([node_id.encode('UTF-8'),
+                                      header.SerializeToString(),
+                                      task.SerializeToString(),
+                                      fragment
+        ])
+
+    # Wait until we receive a response for every fragment
+    repaired = 0
+    deadline = time.monotonic() + READ_TIMEOUT/1000
+    for task_nbr in range(len(missing_fragments)):
+        resp = receive_response(repair_response_socket, request_id, deadline)
+        if resp is None:
+            print("%d repaired fragments were not acknowledged within %d ms"
+                  % (len(missing_fragments) - repaired, READ_TIMEOUT))
+            break
+        print('Repaired fragment: %s' % resp[0].decode('utf-8'))
+        repaired += 1
+
+    return len(missing_fragments), repaired
 #
 
 
@@ -198,9 +1082,12 @@ def start_repair_process(files, repair_socket, repair_response_socket):
     of files that are to be checked. For each file, it sends queries to the Storage
     nodes to check that all coded fragments are stored safely. If it finds a missing
     fragment, it determines which Storage node was supposed to store it and repairs it.
-    This happens by first retrieving the original file data, then re-encoding the missing
-    fragment. It also handles multiple missing fragments for a file, as long as their
-    number does not exceed `max_erasures`.
+    This happens by retrieving k of the remaining fragments and combining them directly
+    to the missing fragments, without decoding the file. It also handles multiple missing
+    fragments for a file, as long as their number does not exceed `max_erasures`.
+    Striped files are checked and repaired stripe by stripe. Chunks that may have missed
+    an update are deleted first, so that they are repaired like lost ones; the storage
+    details of these files are updated in place.
 
     :param files: List of files to be checked
     :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
@@ -216,103 +1103,29 @@ def start_repair_process(files, repair_socket, repair_response_socket):
         print("Checking file with id: %s" % file["id"])
         #We parse the JSON into a python dictionary
         storage_details = json.loads(file["storage_details"])
-
-        #Iterate over each coded fragment to check that it is not missing
-        nodes = set() # list of all storage nodes
-        nodes_with_fragment = set() # list of storage nodes with fragments
         coded_fragments = storage_details["coded_fragments"] # list of all coded fragments
-        missing_fragments = [] # list of missing coded fragments
-        existing_fragments = [] # list of existing coded fragments
-        for fragment in coded_fragments:
-            task = messages_pb2.fragment_status_request()
-            task.fragment_name = fragment
-            header = messages_pb2.header()
-            header.request_type = messages_pb2.FRAGMENT_STATUS_REQ
-
-            repair_socket.send_multipart([b"all_nodes",
-                                          header.SerializeToString(),
-                                          task.SerializeToString()])
-
-            fragment_found = False
-            # Wait until we receive a response from each node
-            for task_nbr in range(STORAGE_NODES_NUM):
-                msg = repair_response_socket.recv()
-                response = messages_pb2.fragment_status_response()
-                response.ParseFromString(msg)
-                
-                nodes.add(response.node_id) #Build a set of nodes
-                if response.is_present == True:
-                    nodes_with_fragment.add(response.node_id)
-                    existing_fragments.append(fragment)
-                    fragment_found = True
-
-            if fragment_found == False:
-                print("Fragment %s lost" % fragment)
-                missing_fragments.append(fragment)
-                number_of_missing_fragments += 1
-            else:
-                print("Fragment %s OK" % fragment)
-
-        # If we have lost fragments, we must figure out where they were stored
-        # We assume that each node has exactly 1 or 0 fragments
-        nodes_without_fragment = list(nodes.difference(nodes_with_fragment))
-
-
-        # Perform the actual repair, if necessary
-        if len(missing_fragments) > 0:
-            # Check that enough fragments still remain to be able to repair
-            if len(missing_fragments) > storage_details["max_erasures"]:
-                print("Too many lost fragments: %s. Unable to repair file. " % len(missing_fragments))
-                continue
-
-            # Retrieve sufficient fragments and decode
-            symbols = STORAGE_NODES_NUM - storage_details["max_erasures"]
-            file_data = get_file_for_repair(existing_fragments[:symbols], # only as many as necessary
-                                            file["size"],
-                                            repair_socket,
-                                            repair_response_socket
-            )
 
-            #Build the encoder
-            # How many coded fragments (=symbols) will be required to reconstruct the encoded data. 
-            symbols = STORAGE_NODES_NUM - storage_details["max_erasures"]
-            # The size of one coded fragment (total size/number of symbols, rounded up)
-            symbol_size = math.ceil(len(file_data)/symbols)
-            # Kodo RLNC encoder using 2^8 finite field
-            encoder = kodo.RLNCEncoder(kodo.field.binary8, symbols, symbol_size)
-            encoder.set_symbols_storage(file_data)
-
-            # Re-encode each missing fragment: 
-            for missing_fragment in missing_fragments:
-                fragment_index = coded_fragments.index(missing_fragment)
-                # Select the appropriate Reed Solomon coefficient vector
-                coefficients = RS_CAUCHY_COEFFS[fragment_index]
-                # Generate a coded fragment with these coefficients
-                # (trim the coeffs to the actual length we need)
-                symbol = encoder.produce_symbol(coefficients[:symbols])
-
-                # Save with the same name as before
-                # Send a Protobuf STORE DATA request to the Storage Nodes
-                task = messages_pb2.storedata_request()
-                task.filename = missing_fragment
-
-                header = messages_pb2.header()
-                header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
-
-                node_id = nodes_without_fragment[number_of_repaired_fragments]
-
-                #Use the node_id as the topic
-                repair_socket.send_multipart([node_id.encode('UTF-8'),
-                                              header.SerializeToString(),
-                                              task.SerializeToString(),
-                                              coefficients[:symbols] + bytearray(symbol)
-                ])
-                number_of_repaired_fragments += 1
-
-            # Wait until we receive a response for every fragment
-            for task_nbr in range(len(missing_fragments)):
-                resp = repair_response_socket.recv_string()
-                print('Repaired fragment: %s' % resp)
+        # Files stored before striping consist of a single stripe
+        stripes = storage_details.get("stripes", 1)
+
+        stale_chunks = set(storage_details.get("stale_chunks", []))
+
+        for stripe in range(stripes):
+            chunk_names = [stripe_chunk_name(name, stripe) for name in coded_fragments]
+            if stale_chunks.intersection(chunk_names):
+                delete_stale_chunks(chunk_names, stale_chunks, storage_details["max_erasures"],
+                                    STORAGE_NODES_NUM, READ_TIMEOUT,
+                                    repair_socket, repair_response_socket)
+            missing, repaired = __repair_stripe(chunk_names, storage_details,
+                                                repair_socket, repair_response_socket)
+            number_of_missing_fragments += missing
+            number_of_repaired_fragments += repaired
 
+        if "stale_chunks" in storage_details:
+            # Stale chunks that were deleted are repaired now, or counted as missing
+            storage_details["stale_chunks"] = sorted(stale_chunks)
+            if not stale_chunks:
+                del storage_details["stale_chunks"]
+            file["storage_details"] = json.dumps(storage_details)
 
     return number_of_missing_fragments, number_of_repaired_fragments
@@ -3,17 +3,20 @@ Aarhus University - Distributed Storage course - Lab 11
 
 REST API 
 """
-from flask import Flask, make_response, request, send_file
+from flask import Flask, Response, make_response, request
 
 import zmq # For ZMQ
 import time # For waiting a second for ZMQ connections
-import io # For sending binary data in a HTTP response
+import io # For measuring the size of uploaded files
+import itertools # For streaming files in HTTP responses
 import logging
 
 from apscheduler.schedulers.background import BackgroundScheduler # automated repair
 import atexit # unregister scheduler at app exit
 
 import utils
+import downloads
+import updates
 
 # Initiate ZMQ sockets
 context = zmq.Context()
@@ -46,6 +49,10 @@ print("Listening to ZMQ messages on tcp://*:5558 and tcp://*:5561")
 # Create the DB table if it doesn't exist
 utils.init_db()
 
+# Source data of the coding windows of the sliding-window RLNC streams, by file ID.
+# It is read back from the storage nodes when a stream is appended to after a restart.
+stream_windows = {}
+
 # Instantiate the Flask app (must be before the endpoint functions)
 app = Flask(__name__)
 # Close the DB connection after serving the request
@@ -89,74 +96,51 @@ def download_file(file_id):
     # Parse the storage details JSON string
     import json
     storage_details = json.loads(f['storage_details'])
-
-    if f['storage_mode'] == 'raid1':
-        import raid1
-
-        part1_filenames = storage_details['part1_filenames']
-        part2_filenames = storage_details['part2_filenames']
-
-        file_data = raid1.get_file(
-            part1_filenames, 
-            part2_filenames, 
-            data_req_socket, 
-            response_socket
-        )
-
-    elif f['storage_mode'] == 'erasure_coding_rs':
-        import reedsolomon
-
-        coded_fragments = storage_details['coded_fragments']
-        max_erasures = storage_details['max_erasures']
-
-        file_data = reedsolomon.get_file(
-            coded_fragments,
-            max_erasures,
-            f['size'],
-            data_req_socket, 
-            response_socket
-        )
-        
-    elif f['storage_mode'] == 'erasure_coding_rlnc':
-        import rlnc
-
-        coded_fragments = storage_details['coded_fragments']
-        max_erasures = storage_details['max_erasures']
-
-        file_data = rlnc.get_file(
-            coded_fragments,
-            max_erasures,
-            f['size'],
-            data_req_socket, 
-            response_socket
-        )
-
-    elif f['storage_mode'] == 's3':
-        # Download the file contents from Amazon S3
-        import s3
-        
-        file_data = s3.get_file(
-            region=storage_details['region'], 
-            bucket_name=storage_details['bucket'], 
-            object_key=storage_details['object']
-        )
-    
-    elif f['storage_mode'] == 'compressed':
-        import compressed
-
-        hash_ids = storage_details['hash_ids']
-
-        file_data = compressed.get_file(
-            hash_ids, 
-            data_req_socket, 
-            response_socket
-        )
-
-    else:
+    # HTTP Range requests: only single ranges are supported, the whole file is sent for
+    # multiple ranges
+    file_range = None
+    if request.range and len(request.range.ranges) == 1:
+        file_range = request.range.range_for_length(f['size'])
+        if file_range is None and request.range.ranges[0][0] < 0 and f['size'] > 0:
+            # A suffix range that is longer than the file selects the whole file
+            file_range = (0, f['size'])
+        if file_range is None:
+            response = make_response({"message": "Range not satisfiable"}, 416)
+            response.headers['Content-Range'] = "bytes */{}".format(f['size'])
+            return response
+
+    reader = downloads.file_reader(f, storage_details, file_range, data_req_socket,
+                                   response_socket)
+    if reader is None:
         logging.error("Unexpected storage mode: %s" % f['storage_mode'])
         return make_response("Unexpected storage mode: {}".format(f['storage_mode']), 400)
-
-    return send_file(io.BytesIO(file_data), mimetype=f['content_type'])
+    function, args = reader
+    chunks = function(*args)
+
+    # Retrieve the first chunk before the response is started, so that errors can still
+    # be reported with an error status. The rest of the file is sent as it is retrieved.
+    chunks = iter(chunks)
+    try:
+        first_chunk = next(chunks, b'')
+    except TimeoutError as e:
+        logging.error("Retrieving file %d timed out: %s" % (file_id, e))
+        return make_response({"message": str(e)}, 504)
+    except FileNotFoundError as e:
+        # Too many chunks are lost or may have missed an update, the file must be repaired
+        logging.error("Retrieving file %d failed: %s" % (file_id, e))
+        return make_response({"message": str(e)}, 503)
+
+    response = Response(itertools.chain([first_chunk], chunks), mimetype=f['content_type'])
+    response.headers['Accept-Ranges'] = 'bytes'
+    if file_range is not None:
+        # Partial content: only the requested byte range is sent
+        response.status_code = 206
+        response.headers['Content-Range'] = "bytes {}-{}/{}".format(
+            file_range[0], file_range[1] - 1, f['size'])
+        response.headers['Content-Length'] = file_range[1] - file_range[0]
+    else:
+        response.headers['Content-Length'] = f['size']
+    return response
 #
 
 
@@ -205,6 +189,77 @@ def delete_file(file_id):
     return make_response('TODO: implement this endpoint', 404)
 #
 
+
+# Overwrite part of a file or append to it. The request body is the new data, the
+# 'offset' query parameter is where it is written (default: append to the end).
+# Only the erasure coded storage modes support updates; they send the changes to the
+# storage nodes as deltas instead of storing the whole file again. Streams can only be
+# appended to.
+@app.route('/files/<int:file_id>',  methods=['PATCH'])
+def update_file(file_id):
+
+    db = utils.get_db()
+    cursor = db.execute("SELECT * FROM `file` WHERE `id`=?", [file_id])
+    if not cursor: 
+        return make_response({"message": "Error connecting to the database"}, 500)
+    
+    f = cursor.fetchone()
+    if not f:
+        return make_response({"message": "File {} not found".format(file_id)}, 404)
+
+    # Convert to a Python dictionary
+    f = dict(f)
+    data = request.get_data()
+    offset = int(request.args.get('offset', f['size']))
+    if offset < 0 or offset > f['size']:
+        return make_response({"message": "Offset must be between 0 and the file size"}, 400)
+    print("File update: %s, %d bytes at offset %d" % (f['filename'], len(data), offset))
+
+    # Parse the storage details JSON string
+    import json
+    storage_details = json.loads(f['storage_details'])
+    # Chunks that may have missed an update: they are not read, and the ones that miss
+    # this update are added. They are deleted and repaired by the next repair.
+    stale_chunks = list(storage_details.get('stale_chunks', []))
+    if f['storage_mode'] == 'erasure_coding_rlnc_stream' and offset != f['size']:
+        return make_response({"message": "Streams can only be appended to"}, 400)
+
+    try:
+        result = updates.update_file(f, storage_details, offset, data, stale_chunks,
+                                     stream_windows.get(file_id), data_req_socket,
+                                     response_socket, send_task_socket, repair_socket,
+                                     repair_response_socket)
+    except TimeoutError as e:
+        logging.error("Updating file %d timed out: %s" % (file_id, e))
+        # The window of a stream may not match the data on the nodes any more
+        stream_windows.pop(file_id, None)
+        updates.mark_stale_chunks(db, file_id, storage_details, stale_chunks)
+        return make_response({"message": str(e)}, 504)
+    except FileNotFoundError as e:
+        # Lost fragments must be repaired before the file can be updated
+        logging.error("Updating file %d failed: %s" % (file_id, e))
+        stream_windows.pop(file_id, None)
+        updates.mark_stale_chunks(db, file_id, storage_details, stale_chunks)
+        return make_response({"message": str(e)}, 503)
+    if result is None:
+        return make_response({"message": "Storage mode {} does not support updates".format(
+            f['storage_mode'])}, 400)
+    size, old_chunks, window_data = result
+    if window_data is not None:
+        stream_windows[file_id] = window_data
+
+    db.execute(
+        "UPDATE `file` SET `size`=?, `storage_details`=? WHERE `id`=?",
+        (size, json.dumps(storage_details), file_id)
+    )
+    db.commit()
+
+    if old_chunks is not None:
+        updates.delete_old_chunks(file_id, *old_chunks, repair_socket, repair_response_socket)
+
+    return make_response({"id": file_id, "size": size})
+#
+
 @app.route('/files_mp', methods=['POST'])
 def add_files_multipart():
     # Flask separates files from the other form fields
@@ -221,9 +276,11 @@ def add_files_multipart():
     # The sender encodes a the file name and type together with the file contents
     filename = file.filename
     content_type = file.mimetype
-    # Load the file contents into a bytearray and measure its size
-    data = bytearray(file.read())
-    size = len(data)
+    # The upload has been spooled to a temporary file, the storage modes read it from
+    # there in chunks instead of loading the whole file into memory
+    stream = file.stream
+    size = stream.seek(0, io.SEEK_END)
+    stream.seek(0)
     print("File received: %s, size: %d bytes, type: %s" % (filename, size, content_type))
     
     # Read the requested storage mode from the form (default value: 'raid1')
@@ -232,7 +289,8 @@ def add_files_multipart():
 
     if storage_mode == 'raid1':
         import raid1
-        file_data_1_names, file_data_2_names = raid1.store_file(data, send_task_socket, response_socket)
+        file_data_1_names, file_data_2_names = raid1.store_stream(stream, size, send_task_socket,
+                                                                  response_socket)
 
         storage_details = {
             "part1_filenames": file_data_1_names,
@@ -245,37 +303,137 @@ def add_files_multipart():
 
         # Parse max_erasures (everything is a string in request.form, 
         # we need to convert to int manually), set default value to 1
-        max_erasures = int(payload.get('max_erasures', 1))
+        max_erasures = utils.form_number(payload, 'max_erasures', 1,
+                                         0, reedsolomon.STORAGE_NODES_NUM - 1)
         print("Max erasures: %d" % (max_erasures))
+
+        # How many fragments are needed to reconstruct the file, the file is stored on
+        # k+max_erasures nodes (default: all storage nodes)
+        k = utils.form_number(payload, 'k', reedsolomon.STORAGE_NODES_NUM - max_erasures,
+                              1, reedsolomon.STORAGE_NODES_NUM - max_erasures)
+        print("k: %d" % (k))
+
+        # Systematic layout: the data fragments are plain slices of the file (default: off)
+        systematic = payload.get('systematic', 'false').lower() == 'true'
+        print("Systematic: %s" % (systematic))
         
         # Store the file contents with Reed Solomon erasure coding
-        fragment_names = reedsolomon.store_file(data, max_erasures, send_task_socket, response_socket)
+        fragment_names, stripes, symbol_size = reedsolomon.store_stream(
+            stream, size, max_erasures, send_task_socket, response_socket, systematic, k)
 
         storage_details = {
             "coded_fragments": fragment_names,
-            "max_erasures": max_erasures
+            "max_erasures": max_erasures,
+            "k": k,
+            "m": max_erasures,
+            "systematic": systematic,
+            "stripes": stripes,
+            "symbol_size": symbol_size
         }
 
     elif storage_mode == 'erasure_coding_rlnc':
         # RLNC
         import rlnc
 
-        max_erasures = int(payload.get('max_erasures', 1))
+        max_erasures = utils.form_number(payload, 'max_erasures', 1,
+                                         0, rlnc.STORAGE_NODES_NUM - 1)
         print("Max erasures: %d" % (max_erasures))
 
-        subfragments_per_node = int(payload.get('subfragments_per_node', 3))
+        subfragments_per_node = utils.form_number(payload, 'subfragments_per_node', 3, 1)
         print("Subfragments per node: %d" % (subfragments_per_node))
 
+        # Maximum size of the generations the file is cut to, smaller generations decode
+        # faster but spend more space on coefficients (default: rlnc.GENERATION_SIZE)
+        generation_size = utils.form_number(payload, 'generation_size',
+                                            rlnc.GENERATION_SIZE, 1)
+        print("Generation size: %d" % (generation_size))
+
+        # How the coefficient vector is stored in front of each coded subfragment:
+        # 'raw' (the vector itself, default) or 'seed' (a short seed it is generated from)
+        coefficient_format = payload.get('coefficient_format', 'raw')
+        if coefficient_format not in rlnc.COEFFICIENT_FORMATS:
+            return make_response({"message": "Unknown coefficient format: {}".format(
+                coefficient_format)}, 400)
+        print("Coefficient format: %s" % (coefficient_format))
+
+        # Systematic layout: the first nodes store the source symbols uncoded (default: off)
+        systematic = payload.get('systematic', 'false').lower() == 'true'
+        print("Systematic: %s" % (systematic))
+
+        # Fraction of non-zero coefficients in the coded subfragments, sparse codes
+        # encode and update faster (default: 1, dense)
+        density = utils.form_number(payload, 'density', 1.0, convert=float)
+        if not 0 < density <= 1:
+            return make_response({"message": "Density must be in (0, 1]: {}".format(
+                density)}, 400)
+        print("Density: %s" % (density))
+
+        # Number of bits of the finite field the coefficients are drawn from: 4, 8 or 16.
+        # Smaller fields code faster, larger ones need fewer extra symbols (default: 8)
+        field = utils.form_number(payload, 'field', 8)
+        if field not in rlnc.FIELDS:
+            return make_response({"message": "Unknown field: GF(2^{})".format(field)}, 400)
+        print("Field: GF(2^%d)" % (field))
+
         # Store the file contents with Random Linear Network Coding encoding
-        fragment_names = rlnc.store_file(data, max_erasures, subfragments_per_node,
-                                         send_task_socket, response_socket)
+        fragment_names, generations, symbol_size = rlnc.store_stream(
+            stream, size, max_erasures, subfragments_per_node, send_task_socket,
+            response_socket, generation_size=generation_size,
+            coefficient_format=coefficient_format, systematic=systematic, density=density,
+            field=field)
 
         storage_details = {
             "coded_fragments": fragment_names,
             "max_erasures": max_erasures,
-            "subfragments_per_node": subfragments_per_node
+            "subfragments_per_node": subfragments_per_node,
+            "generation_size": generation_size,
+            "coefficient_format": coefficient_format,
+            "systematic": systematic,
+            "density": density,
+            "field": field,
+            "generations": generations,
+            "symbol_size": symbol_size
         }
     
+    elif storage_mode == 'erasure_coding_rlnc_stream':
+        # Sliding-window RLNC: the file is an append-only stream, PATCH appends to it
+        import gf
+        import rlnc
+        import rlnc_stream
+
+        max_erasures = utils.form_number(payload, 'max_erasures', 1,
+                                         0, rlnc.STORAGE_NODES_NUM - 1)
+        subfragments_per_node = utils.form_number(payload, 'subfragments_per_node', 3, 1)
+        # Size of the source symbols and number of steps of
+        # (4 - max_erasures) * subfragments_per_node symbols a coded symbol covers
+        symbol_size = utils.form_number(payload, 'symbol_size', rlnc_stream.SYMBOL_SIZE, 1)
+        window = utils.form_number(payload, 'window', rlnc_stream.WINDOW_STEPS, 1)
+        coefficient_format = payload.get('coefficient_format', 'raw')
+        if coefficient_format not in rlnc.COEFFICIENT_FORMATS:
+            return make_response({"message": "Unknown coefficient format: {}".format(
+                coefficient_format)}, 400)
+        field = utils.form_number(payload, 'field', 8)
+        if field not in rlnc.FIELDS:
+            return make_response({"message": "Unknown field: GF(2^{})".format(field)}, 400)
+        if window < 1 or symbol_size < 1 or symbol_size % gf.ELEMENT_TYPES[field].itemsize:
+            return make_response({"message": "Invalid window or symbol size"}, 400)
+        print("Stream: %d byte symbols, window of %d steps" % (symbol_size, window))
+
+        fragment_names, window_data = rlnc_stream.store_stream(
+            stream, max_erasures, subfragments_per_node, send_task_socket, response_socket,
+            repair_socket, repair_response_socket, symbol_size, window, coefficient_format,
+            field)
+
+        storage_details = {
+            "coded_fragments": fragment_names,
+            "max_erasures": max_erasures,
+            "subfragments_per_node": subfragments_per_node,
+            "symbol_size": symbol_size,
+            "window": window,
+            "coefficient_format": coefficient_format,
+            "field": field
+        }
+
     elif storage_mode == 's3':
         # Store the file contents in Amazon S3
         import s3
@@ -284,7 +442,7 @@ def add_files_multipart():
         region = payload.get('s3_region') 
 
         # Upload the file to S3
-        bucket_name, object_key = s3.store_file(data, region, content_type)
+        bucket_name, object_key = s3.store_stream(stream, size, region, content_type)
         
         # Construct the dict that goes into the 'storage_details' DB field
         storage_details = {
@@ -297,7 +455,7 @@ def add_files_multipart():
         import compressed
 
         # Compress and store the file
-        hash_ids, new_blocks = compressed.store_file(data, send_task_socket, response_socket)
+        hash_ids, new_blocks = compressed.store_stream(stream, send_task_socket, response_socket)
         
         # Construct the dict that goes into the 'storage_details' DB field
         storage_details = {
@@ -317,24 +475,43 @@ def add_files_multipart():
         (filename, size, content_type, storage_mode, json.dumps(storage_details))
     )
     db.commit()
+    if storage_mode == 'erasure_coding_rlnc_stream':
+        stream_windows[cursor.lastrowid] = window_data
 
     return make_response({"id": cursor.lastrowid }, 201)
 #
 
 @app.route('/services/rlnc_repair',  methods=['GET'])
 def rlnc_repair():
-    #Retrieve the list of files stored using RLNC from the database
+    import rlnc
+    import rlnc_stream
+
+    #Retrieve the list of files and streams stored using RLNC from the database
     db = utils.get_db()
-    cursor = db.execute("SELECT `id`, `storage_details`, `size` FROM `file` WHERE `storage_mode`='erasure_coding_rlnc'")
+    cursor = db.execute("SELECT `id`, `storage_details`, `size`, `storage_mode` FROM `file` WHERE `storage_mode` IN ('erasure_coding_rlnc', 'erasure_coding_rlnc_stream')")
     if not cursor: 
         return make_response({"message": "Error connecting to the database"}, 500)
     
     rlnc_files = cursor.fetchall()
     rlnc_files = [dict(file) for file in rlnc_files]
+    stale_file_ids = [file['id'] for file in rlnc_files if 'stale_chunks' in file['storage_details']]
     
-    fragments_missing, fragments_repaired = rlnc.start_repair_process(rlnc_files,
-                                                                      repair_socket,
-                                                                      repair_response_socket)
+    fragments_missing, fragments_repaired = rlnc.start_repair_process(
+        [file for file in rlnc_files if file['storage_mode'] == 'erasure_coding_rlnc'],
+        repair_socket, repair_response_socket)
+    # Streams are repaired step by step
+    stream_missing, stream_repaired = rlnc_stream.start_repair_process(
+        [file for file in rlnc_files if file['storage_mode'] == 'erasure_coding_rlnc_stream'],
+        repair_socket, repair_response_socket)
+    fragments_missing += stream_missing
+    fragments_repaired += stream_repaired
+
+    # Save the files whose stale chunks were deleted
+    for file in rlnc_files:
+        if file['id'] in stale_file_ids:
+            db.execute("UPDATE `file` SET `storage_details`=? WHERE `id`=?",
+                       (file['storage_details'], file['id']))
+    db.commit()
 
     return make_response({"fragments_missing": fragments_missing,
                           "fragments_repaired": fragments_repaired})
@@ -343,6 +520,8 @@ def rlnc_repair():
 
 @app.route('/services/rs_repair',  methods=['GET'])
 def rs_repair():
+    import reedsolomon
+
     #Retrieve the list of files stored using Reed-Solomon from the database
     db = utils.get_db()
     cursor = db.execute("SELECT `id`, `storage_details`, `size` FROM `file` WHERE `storage_mode`='erasure_coding_rs'")
@@ -351,16 +530,44 @@ def rs_repair():
     
     rs_files = cursor.fetchall()
     rs_files = [dict(file) for file in rs_files]
+    stale_file_ids = [file['id'] for file in rs_files if 'stale_chunks' in file['storage_details']]
     
     fragments_missing, fragments_repaired = reedsolomon.start_repair_process(rs_files,
                                                                              repair_socket,
                                                                              repair_response_socket)
 
+    # Save the files whose stale chunks were deleted
+    for file in rs_files:
+        if file['id'] in stale_file_ids:
+            db.execute("UPDATE `file` SET `storage_details`=? WHERE `id`=?",
+                       (file['storage_details'], file['id']))
+    db.commit()
+
     return make_response({"fragments_missing": fragments_missing,
                           "fragments_repaired": fragments_repaired})
 #
 
 
+@app.route('/services/decoding_cache',  methods=['GET'])
+def decoding_cache():
+    # Hit/miss counters of the decoding matrix caches, useful to watch during node outages
+    import reedsolomon
+    import rlnc
+
+    stats = {}
+    for name, cache_info in [("erasure_coding_rs", reedsolomon.decoding_matrix.cache_info()),
+                             ("erasure_coding_rlnc", rlnc.decoding_matrix.cache_info())]:
+        stats[name] = {
+            "hits": cache_info.hits,
+            "misses": cache_info.misses,
+            "size": cache_info.currsize,
+            "max_size": cache_info.maxsize
+        }
+
+    return make_response(stats)
+#
+
+
 def rs_automated_repair():
     print("Running automated Reed-Solomon repair process")
     with app.app_context():
@@ -377,6 +584,12 @@ scheduler.add_job(func=rs_automated_repair, trigger="interval", seconds=60)
 atexit.register(lambda: scheduler.shutdown())
 
 
+@app.errorhandler(utils.FormError)
+def form_error(e):
+    # Invalid fields of an upload form
+    return make_response({"message": str(e)}, 400)
+
+
 @app.errorhandler(500)
 def server_error(e):
     logging.exception("Internal error: %s", e)
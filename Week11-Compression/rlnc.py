@@ -1,26 +1,395 @@
-import kodo
 import math
 import random
 import copy # for deepcopy
-from utils import random_string
+import collections
+import functools
+import itertools
+import os
+import time
+from utils import random_string, stripe_chunk_name, receive_response, read_chunk, chunks, \
+    symbol_range_parts, chunk_status, delete_stale_chunks
 import messages_pb2
 import json
 
+import numpy as np
+import gf
+import workers
+
+try:
+    import kodo
+except ImportError:
+    # kodo is a binary module that is not available on every platform
+    kodo = None
+
 STORAGE_NODES_NUM = 4
 
+# The engine used for coding: 'kodo' or 'numpy', see reedsolomon.CODEC. The NumPy codec
+# encodes, decodes and recodes without kodo, so neither the controller nor the storage
+# nodes need it.
+CODEC = os.environ.get('ERASURE_CODEC', 'kodo' if kodo else 'numpy')
+
+# How many decoding matrices are kept in memory
+DECODING_CACHE_SIZE = 128
+
+# How long to wait for the storage nodes to acknowledge an update, in milliseconds
+UPDATE_TIMEOUT = 10000
+
+# How long (in milliseconds) the rank of a generation may stay the same during a read
+# before its subfragments are requested from the other storage nodes as well
+RANK_STALL_TIMEOUT = 1000
+
+# Deadline (in milliseconds) for retrieving enough subfragments to decode a read
+READ_TIMEOUT = 10000
+
+# Default maximum amount of file data that is coded together as one generation. Smaller
+# generations decode faster, larger ones have larger symbols and so relatively smaller
+# coefficient vectors.
+GENERATION_SIZE = 16*1024*1024
+
+# How many generations may have been sent to the storage nodes without being acknowledged
+MAX_GENERATIONS_IN_FLIGHT = 2
+
+# Maximum amount of file data that a read retrieves and decodes at once. Up to
+# workers.WORKERS generations are decoded in parallel, as many as fit into this.
+READ_BATCH_SIZE = 32*1024*1024
+
+# Finite fields the coefficients can be drawn from, by their number of bits (see gf.py).
+# kodo is only used for GF(2^8), the other fields are always coded with NumPy.
+FIELDS = gf.FIELDS
+
+# Formats of the coefficient header of the coded subfragments:
+# 'raw': the coefficient vector itself, one element per source symbol of the generation
+# 'seed': a SEED_SIZE byte seed that the coefficients are generated from, see
+#         seed_coefficients
+COEFFICIENT_FORMATS = ('raw', 'seed')
+SEED_SIZE = 4
+
+# Seeds below this are not random: seed i stands for the unit vector of source symbol i,
+# the header of an uncoded subfragment of a systematic generation
+SYSTEMATIC_SEEDS = 1 << 16
+
+# How often repair symbols are recoded (or repair coefficients drawn) again at most until
+# they are independent of the remaining subfragments, before all subfragments are
+# requested from the nodes (or the generation is given up)
+REPAIR_RECODE_DRAWS = 10
+
+def header_size(coefficient_format, symbols, field=8):
+    """
+    Returns the size of the coefficient header of the coded subfragments.
+
+    :param coefficient_format: 'raw' or 'seed', see COEFFICIENT_FORMATS
+    :param symbols: Number of source symbols per generation
+    :param field: Number of bits of the field elements
+    """
+    assert(coefficient_format in COEFFICIENT_FORMATS)
+    if coefficient_format == 'seed':
+        return SEED_SIZE
+    return symbols * gf.ELEMENT_TYPES[field].itemsize
+#
+
+
+def __codec(field):
+    """
+    Returns the codec that codes over the given field: CODEC for GF(2^8), otherwise numpy.
+    """
+    return CODEC if field == 8 else 'numpy'
+#
+
+
+def seed_coefficients(seed, symbols, density=1.0, field=8):
+    """
+    Returns the coefficient vector of a subfragment in the 'seed' format.
+    In a sparse vector each coefficient is non-zero with probability 'density', and at
+    least one is. The same generator stream decides which ones. Vectors with fewer than
+    about ln(symbols) non-zero coefficients are rarely linearly independent, so the
+    density is raised to at least ln(symbols)/symbols.
+
+    :param seed: The seed as an integer
+    :param symbols: Number of source symbols per generation
+    :param density: Fraction of non-zero coefficients (1 or 0: dense)
+    :param field: Number of bits of the field elements
+    :return: bytes with the coefficient vector
+    """
+    element_type = gf.ELEMENT_TYPES[field]
+    if seed < SYSTEMATIC_SEEDS:
+        unit = np.zeros(symbols, dtype=element_type)
+        unit[seed] = 1
+        return unit.tobytes()
+    size = 1 << field
+    if not 0 < density < 1:
+        stream = np.frombuffer(gf.random_coefficients(seed, symbols*element_type.itemsize),
+                               dtype=element_type)
+        return (stream & (size - 1)).astype(element_type).tobytes()
+
+    density = max(density, math.log(symbols) / symbols)
+    stream = np.frombuffer(gf.random_coefficients(seed, 2*symbols*element_type.itemsize),
+                           dtype=element_type) & (size - 1)
+    keep = stream[symbols:] < round(density * size)
+    if not keep.any():
+        keep[seed % symbols] = True
+    # Non-zero values where the coefficient is kept
+    coefficients = np.where(keep, stream[:symbols] % (size - 1) + 1, 0).astype(element_type)
+    return coefficients.tobytes()
+#
+
+
+def expand_coefficients(symbol, symbols, density=1.0, field=8):
+    """
+    Convert a coded symbol in the 'seed' format to the 'raw' format, by replacing the
+    seed with the coefficient vector generated from it.
+
+    :param symbol: The coded symbol, the seed followed by the symbol data
+    :param symbols: Number of source symbols per generation
+    :param density: Fraction of non-zero coefficients, see seed_coefficients
+    :param field: Number of bits of the field elements
+    :return: bytearray with the coefficients followed by the symbol data
+    """
+    seed = int.from_bytes(symbol[:SEED_SIZE], 'big')
+    return bytearray(seed_coefficients(seed, symbols, density, field)) + \
+        memoryview(symbol)[SEED_SIZE:]
+#
+
+
+def __receive_store_acks(response_socket, request_id, pending, keep=0):
+    """
+    Wait for the storage nodes to acknowledge stored chunks, until at most 'keep' chunks
+    are left unacknowledged. Responses to other requests are dropped.
+
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param request_id: The ID the chunks were sent with
+    :param pending: Set of the chunk names that were sent but not acknowledged yet
+    :param keep: How many chunks may stay unacknowledged
+    """
+    while len(pending) > keep:
+        resp = receive_response(response_socket, request_id)
+        name = resp[0].decode('utf-8')
+        if len(resp) > 1 or name not in pending:
+            print("Dropping unexpected response %s" % name)
+            continue
+        pending.remove(name)
+        print('Received: %s' % name)
+#
+
+
+def __draw_coefficients(symbols, coefficient_format, source_symbol=None, density=1.0,
+                        field=8):
+    """
+    Draw the coefficients of a new subfragment.
+
+    :param symbols: Number of source symbols per generation
+    :param coefficient_format: 'raw' or 'seed', see COEFFICIENT_FORMATS
+    :param source_symbol: Index of the source symbol for an uncoded subfragment
+                          (default: a random linear combination)
+    :param density: Fraction of non-zero coefficients of a random linear combination
+    :param field: Number of bits of the field elements
+    :return: (header, coefficient vector) tuple
+    """
+    if source_symbol is not None:
+        seed = source_symbol
+    else:
+        seed = random.randrange(SYSTEMATIC_SEEDS, 1 << (8*SEED_SIZE))
+    coefficients = bytearray(seed_coefficients(seed, symbols, density, field))
+    if coefficient_format == 'seed':
+        return seed.to_bytes(SEED_SIZE, 'big'), coefficients
+    # Raw coefficient vectors are their own header
+    return coefficients, coefficients
+#
+
+
+def __generate_coefficients(symbols, subfragments_per_node, coefficient_format, systematic,
+                            density, field):
+    """
+    Draw random coefficient vectors for the subfragments of every storage node, again
+    until the subfragments of any 'symbols/subfragments_per_node' nodes can decode the
+    generation. A file with many generations would otherwise be likely to have one that
+    cannot be decoded after a node failure.
+    In a systematic generation the first nodes store the source symbols themselves, in
+    order, and only the other nodes store random linear combinations.
+
+    :param symbols: Number of source symbols per generation
+    :param subfragments_per_node: How many subfragments of a generation go to one node
+    :param coefficient_format: 'raw' or 'seed', see COEFFICIENT_FORMATS
+    :param systematic: Whether the generation is systematic
+    :param density: Fraction of non-zero coefficients of the random linear combinations
+    :param field: Number of bits of the field elements
+    :return: List with a list of (header, coefficient vector) tuples for each node
+    """
+    nodes_needed = symbols // subfragments_per_node
+    while True:
+        coefficients = []
+        for i in range(STORAGE_NODES_NUM):
+            if systematic and i < nodes_needed:
+                coefficients.append([__draw_coefficients(symbols, coefficient_format,
+                                                          i*subfragments_per_node + j,
+                                                          field=field)
+                                     for j in range(subfragments_per_node)])
+            else:
+                coefficients.append([__draw_coefficients(symbols, coefficient_format,
+                                                          density=density, field=field)
+                                     for j in range(subfragments_per_node)])
+        if __independent_fragments([[vector for _, vector in node] for node in coefficients],
+                                   nodes_needed, symbols, field):
+            return coefficients
+        print("Coefficient vectors are not linearly independent, drawing new ones")
+#
+
+
+def __store_generations(generations, fragment_names, first_generation,
+                        subfragments_per_node, symbols, symbol_size, coefficient_format,
+                        systematic, density, field, send_task_socket, response_socket):
+    """
+    Encode generations of a file one after the other and send their coded subfragments
+    to the storage nodes. Each generation is coded independently, with its own random
+    coefficients.
+
+    :param generations: The data of the generations, starting with the first one. It may
+                        be a generator that reads each generation only when it is encoded.
+    :param fragment_names: Names of the fragments of the file
+    :param first_generation: Index of the first generation
+    :param subfragments_per_node: How many subfragments of a generation go to one node
+    :param symbols: Number of source symbols per generation
+    :param symbol_size: Size of one source symbol
+    :param coefficient_format: 'raw' or 'seed', see COEFFICIENT_FORMATS
+    :param systematic: Store the source symbols uncoded on the first nodes
+    :param density: Fraction of non-zero coefficients of the coded subfragments
+    :param field: Number of bits of the field elements
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    """
+    generation_size = symbols * symbol_size
+    # The storage nodes send the request ID back with their acknowledgements
+    request_id = random_string(8)
+    # Chunks that have been sent but not acknowledged yet
+    pending = set()
+    for generation, generation_data in enumerate(generations, first_generation):
+        generation_data = bytearray(generation_data)
+        # Pad the last generation to whole symbols
+        generation_data += bytearray(generation_size - len(generation_data))
+
+        # Generate several coded subfragments for each Storage Node
+        node_coefficients = __generate_coefficients(symbols, subfragments_per_node,
+                                                    coefficient_format, systematic, density,
+                                                    field)
+        coded_nodes = range(symbols // subfragments_per_node if systematic else 0,
+                            len(fragment_names))
+
+        if __codec(field) == 'numpy':
+            # All coded subfragments of the generation in one matrix product
+            element_type = gf.ELEMENT_TYPES[field]
+            matrix = np.array([np.frombuffer(coefficients, dtype=element_type)
+                               for node in coded_nodes
+                               for _, coefficients in node_coefficients[node]],
+                              dtype=element_type).reshape(-1, symbols)
+            coded = iter(workers.matmul(matrix, np.frombuffer(generation_data, dtype=np.uint8)
+                                        .reshape(symbols, symbol_size), field=field))
+        else:
+            # Kodo RLNC encoder using 2^8 finite field
+            encoder = kodo.RLNCEncoder(kodo.field.binary8, symbols, symbol_size)
+            encoder.set_symbols_storage(generation_data)
+        for node, (name, coefficient_vectors) in enumerate(zip(fragment_names,
+                                                                node_coefficients)):
+            # Send a Protobuf STORE DATA request to the Storage Nodes
+            task = messages_pb2.storedata_request()
+            task.filename = stripe_chunk_name(name, generation)
+            task.request_id = request_id
+            pending.add(task.filename)
+
+            # Stores all subfragments that go to one Storage node
+            # First frame contains the task
+            frames = [task.SerializeToString()]
+
+            for j, (header, coefficients) in enumerate(coefficient_vectors):
+                if node not in coded_nodes:
+                    # Uncoded subfragment: the source symbol itself
+                    index = node*subfragments_per_node + j
+                    symbol = generation_data[index*symbol_size:(index + 1)*symbol_size]
+                elif __codec(field) == 'numpy':
+                    symbol = next(coded)
+                else:
+                    # Generate a coded fragment with these coefficients
+                    symbol = encoder.produce_symbol(coefficients)
+                frames.append(header + bytearray(symbol))
+
+            # Send all frames as a single multipart message
+            send_task_socket.send_multipart(frames)
+
+        # To keep the memory use bounded, wait for the acks of older generations
+        __receive_store_acks(response_socket, request_id, pending,
+                             keep=len(fragment_names) * (MAX_GENERATIONS_IN_FLIGHT - 1))
+
+    # Wait until we receive a response for every remaining chunk
+    __receive_store_acks(response_socket, request_id, pending)
+#
+
+
+def __generation_geometry(file_size, symbols, symbol_size=None, generation_size=None,
+                          field=8):
+    """
+    Returns the symbol size and the number of generations of a file. The size of one
+    coded subfragment is the generation size/number of symbols, rounded up to whole field
+    elements. Every generation has the same size, only the last one is padded.
+
+    :param file_size: The size of the file
+    :param symbols: Number of source symbols per generation
+    :param symbol_size: The size of the symbols (default: just large enough for the file,
+                        at most generation_size/symbols)
+    :param generation_size: The maximum size of a generation (default: GENERATION_SIZE)
+    :param field: Number of bits of the field elements
+    :return: The symbol size and the number of generations
+    """
+    if generation_size is None:
+        generation_size = GENERATION_SIZE
+    if symbol_size is None:
+        symbol_size = min(math.ceil(file_size/symbols), math.ceil(generation_size/symbols))
+        # Whole field elements
+        element_size = gf.ELEMENT_TYPES[field].itemsize
+        symbol_size = -(-symbol_size // element_size) * element_size
+    assert(symbol_size % gf.ELEMENT_TYPES[field].itemsize == 0)
+    generation_size = symbols * symbol_size
+    generations = max(1, math.ceil(file_size/generation_size)) if generation_size > 0 else 1
+    return symbol_size, generations
+#
+
+
 def store_file(file_data, max_erasures, subfragments_per_node,
-               send_task_socket, response_socket):
+               send_task_socket, response_socket, symbol_size=None, generation_size=None,
+               coefficient_format='raw', systematic=False, density=1.0, field=8):
     """
     Store a file using RLNC, protecting it against 'max_erasures' unavailable storage nodes.
     Alternatively, protect against a total of 'max_erasures' * 'subfragments_per_node'
-    subfragment losses distributed in any way across the nodes
+    subfragment losses distributed in any way across the nodes.
+    The file is cut to generations of 'generation_size' bytes that are coded and decoded
+    independently, so the cost of decoding one generation does not grow with the file.
+    Every generation has (4 - max_erasures) * subfragments_per_node source symbols; the
+    generation size sets the symbol size, and with it how much of each stored subfragment
+    is taken by its coefficient vector. With the 'seed' coefficient format every
+    subfragment starts with a short seed instead, which makes small symbols and large
+    generations affordable.
+    With the systematic layout the first 4 - max_erasures nodes store the source symbols
+    themselves, and only the other nodes store random linear combinations: reads from
+    the first nodes need no decoding.
+    With a density below 1 each coded subfragment combines only about that fraction of
+    the source symbols, which makes encoding (and updates) cheaper. The coefficients are
+    drawn again until every 4 - max_erasures nodes can decode, so sparse generations can
+    still be decoded from exactly that many subfragments.
+    The coefficients are elements of GF(2^field): in GF(2^4) coding is cheaper, in
+    GF(2^16) random coefficients are almost never linearly dependent, but raw coefficient
+    vectors are twice as long and the symbol size must be even.
 
     :param file_data: The file contents to be stored as a Python bytearray 
     :param max_erasures: How many storage node failures should the data survive
     :param subfragments_per_node: How many sugfragments are stored per fragment on a node
     :param send_task_socket: A ZMQ PUSH socket to the storage nodes
     :param response_socket: A ZMQ PULL socket where the storage nodes respond
-    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4)
+    :param symbol_size: The size of the symbols (default: just large enough for the file,
+                        at most generation_size/symbols)
+    :param generation_size: The maximum size of a generation (default: GENERATION_SIZE)
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param systematic: Store the file with the systematic layout
+    :param density: Fraction of non-zero coefficients, 0 < density <= 1 (default: dense)
+    :param field: Number of bits of the field elements, one of FIELDS (default: GF(2^8))
+    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4), the number of
+             generations and the symbol size
     """
 
     # Make sure we can realize max_erasures with 4 storage nodes
@@ -29,52 +398,122 @@ def store_file(file_data, max_erasures, subfragments_per_node,
 
     # At least one subfragment per node
     assert(subfragments_per_node > 0)
+    assert(0 < density <= 1)
+    assert(field in FIELDS)
 
-    # How many coded subfragments (=symbols) will be required to reconstruct the encoded data. 
+    # How many coded subfragments (=symbols) will be required to reconstruct a generation
     symbols = (STORAGE_NODES_NUM - max_erasures) * subfragments_per_node
-    # The size of one coded subfragment (total size/number of symbols, rounded up)
-    symbol_size = math.ceil(len(file_data)/symbols)
-    # Kodo RLNC encoder using 2^8 finite field
-    encoder = kodo.RLNCEncoder(kodo.field.binary8, symbols, symbol_size)
-    encoder.set_symbols_storage(file_data)
-
-    fragment_names = []
-
-    # Generate several coded subfragments for each Storage Node
-    for i in range(STORAGE_NODES_NUM):
-
-        # Generate a random name for them and save
-        name = random_string(8)
-        fragment_names.append(name)
-        
-        # Send a Protobuf STORE DATA request to the Storage Nodes
-        task = messages_pb2.storedata_request()
-        task.filename = name
-        
-        # Stores all subfragments that go to one Storage node
-        # First frame contains the task
-        frames = [task.SerializeToString()] 
+    symbol_size, generations = __generation_geometry(len(file_data), symbols, symbol_size,
+                                                     generation_size, field)
+    generation_size = symbols * symbol_size
 
-        for j in range(subfragments_per_node):
-            # Create a random coefficient vector
-            coefficients = encoder.generate()
-            # Generate a coded fragment with these coefficients 
-            symbol = encoder.produce_symbol(coefficients)
-            frames.append(coefficients + bytearray(symbol))
+    # Generate a random name for each fragment
+    fragment_names = [random_string(8) for _ in range(STORAGE_NODES_NUM)]
 
-        # Send all frames as a single multipart message
-        send_task_socket.send_multipart(frames)
- 
-    # Wait until we receive a response for every message
-    for task_nbr in range(STORAGE_NODES_NUM):
-        resp = response_socket.recv_string()
-        print('Received: %s' % resp)
+    file_view = memoryview(file_data)
+    __store_generations((file_view[i*generation_size:(i + 1)*generation_size]
+                         for i in range(generations)),
+                        fragment_names, 0, subfragments_per_node, symbols, symbol_size,
+                        coefficient_format, systematic, density, field,
+                        send_task_socket, response_socket)
 
-    return fragment_names
+    return fragment_names, generations, symbol_size
 #
 
 
-def decode_file(symbols):
+def store_stream(stream, file_size, max_erasures, subfragments_per_node,
+                 send_task_socket, response_socket, generation_size=None,
+                 coefficient_format='raw', systematic=False, density=1.0, field=8):
+    """
+    Store a file like store_file, reading it from a file object one generation at a time:
+    each generation is read just before it is encoded, so no more than
+    MAX_GENERATIONS_IN_FLIGHT generations of the file are held in memory. The fragments
+    are the same as with store_file.
+
+    :param stream: A binary file object to read the file contents from
+    :param file_size: The size of the file
+    :param max_erasures: How many storage node failures should the data survive
+    :param subfragments_per_node: How many sugfragments are stored per fragment on a node
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param generation_size: The maximum size of a generation (default: GENERATION_SIZE)
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param systematic: Store the file with the systematic layout
+    :param density: Fraction of non-zero coefficients, 0 < density <= 1 (default: dense)
+    :param field: Number of bits of the field elements, one of FIELDS (default: GF(2^8))
+    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4), the number of
+             generations and the symbol size
+    """
+    assert(max_erasures >= 0)
+    assert(max_erasures < STORAGE_NODES_NUM)
+    assert(subfragments_per_node > 0)
+    assert(0 < density <= 1)
+    assert(field in FIELDS)
+
+    symbols = (STORAGE_NODES_NUM - max_erasures) * subfragments_per_node
+    symbol_size, generations = __generation_geometry(file_size, symbols, None,
+                                                     generation_size, field)
+    fragment_names = [random_string(8) for _ in range(STORAGE_NODES_NUM)]
+
+    __store_generations((read_chunk(stream, symbols * symbol_size)
+                         for _ in range(generations)),
+                        fragment_names, 0, subfragments_per_node, symbols, symbol_size,
+                        coefficient_format, systematic, density, field,
+                        send_task_socket, response_socket)
+
+    return fragment_names, generations, symbol_size
+#
+
+
+@functools.lru_cache(maxsize=DECODING_CACHE_SIZE)
+def decoding_matrix(coefficients, symbols_num, field=8):
+    """
+    Returns the inverse of a coefficient matrix. RLNC coefficients are random, so the
+    cache is keyed by the coefficient vectors of the received symbols themselves: reading
+    the same file from the same surviving subfragments again is a cache hit.
+    decoding_matrix.cache_info() reports the hits and misses.
+
+    :param coefficients: The coefficient vectors as bytes, one after the other
+    :param symbols_num: Number of symbols (length of one coefficient vector)
+    :param field: Number of bits of the field elements
+    :return: Read-only (symbols_num x symbols_num) matrix
+    """
+    matrix = np.frombuffer(coefficients, dtype=gf.ELEMENT_TYPES[field]).reshape(symbols_num,
+                                                                               symbols_num)
+    inverse = gf.invert_matrix(matrix, field)
+    inverse.setflags(write=False)
+    return inverse
+#
+
+
+def __decoding_inputs(symbols, field=8):
+    """
+    Returns the decoding matrix and the symbol data of a generation for the NumPy codec.
+
+    :param symbols: coded symbols that contain both the coefficients and symbol data
+    :param field: Number of bits of the field elements
+    :return: The inverse of the coefficient matrix and a (symbols x symbol size) array
+    """
+    symbols_num = len(symbols)
+    header = header_size('raw', symbols_num, field)
+    # Order the symbols by their coefficients, so the same set of symbols always
+    # gives the same matrix (and cache key)
+    symbols = sorted(symbols, key=lambda symbol: bytes(symbol['data'][:header]))
+    coefficients = b''.join(bytes(symbol['data'][:header]) for symbol in symbols)
+    try:
+        inverse = decoding_matrix(coefficients, symbols_num, field)
+    except ValueError:
+        print("Decoding file failed! The %s symbols are not linearly independent" % len(symbols))
+        raise
+    # In shared memory for large generations, so the worker processes decode it in place
+    symbol_data = workers.empty((symbols_num, len(symbols[0]['data']) - header))
+    for row, symbol in enumerate(symbols):
+        symbol_data[row] = np.frombuffer(symbol['data'], dtype=np.uint8, offset=header)
+    return inverse, symbol_data
+#
+
+
+def decode_file(symbols, field=8):
     """
     Decode a file using RLNC decoder and the provided coded symbols.
     The number of symbols must be the same as (STORAGE_NODES_NUM - max_erasures) *
@@ -82,12 +521,19 @@ def decode_file(symbols):
     The implementation is almost identical to the Reed-Solomon equivalent function.
 
     :param symbols: coded symbols that contain both the coefficients and symbol data
+    :param field: Number of bits of the field elements
     :return: the decoded file data
     """
 
-    # Reconstruct the original data with a decoder
     symbols_num = len(symbols)
     symbol_size = len(symbols[0]['data']) - symbols_num #subtract the coefficients' size
+
+    if __codec(field) == 'numpy':
+        inverse, symbol_data = __decoding_inputs(symbols, field)
+        print("File decoded successfully")
+        return bytearray(workers.matmul(inverse, symbol_data, field=field))
+
+    # Reconstruct the original data with a decoder
     decoder = kodo.RLNCDecoder(kodo.field.binary8, symbols_num, symbol_size)
     data_out = bytearray(decoder.block_size())
     decoder.set_symbols_storage(data_out)
@@ -110,11 +556,63 @@ def decode_file(symbols):
 #
 
 
-def recode(symbols, symbol_count, output_symbol_count):
+def __uncoded_data(symbols, field=8):
+    """
+    Returns the data of a generation if all the symbols are uncoded source symbols (of a
+    systematic generation), without decoding: the symbols only have to be put in order.
+
+    :param symbols: coded symbols that contain both the coefficients and symbol data
+    :param field: Number of bits of the field elements
+    :return: The data of the generation, or None if some symbols are coded
+    """
+    symbols_num = len(symbols)
+    header = header_size('raw', symbols_num, field)
+    rows = [None] * symbols_num
+    for symbol in symbols:
+        coefficients = np.frombuffer(symbol['data'], dtype=gf.ELEMENT_TYPES[field],
+                                     count=symbols_num)
+        nonzero = np.flatnonzero(coefficients)
+        if len(nonzero) != 1 or coefficients[nonzero[0]] != 1 or rows[nonzero[0]] is not None:
+            return None
+        rows[nonzero[0]] = memoryview(symbol['data'])[header:]
+    return bytearray(b''.join(rows))
+#
+
+
+def decode_generations(generations, field=8):
+    """
+    Decode several generations of a file. With the NumPy codec the generations are
+    decoded in parallel by the worker processes, and generations that were read from
+    the uncoded subfragments of the systematic layout are not decoded at all.
+
+    :param generations: List with the coded symbols of each generation
+    :param field: Number of bits of the field elements
+    :return: List with the decoded data of each generation
+    """
+    if __codec(field) == 'numpy':
+        decoded = [__uncoded_data(symbols, field) for symbols in generations]
+        coded = [i for i, data in enumerate(decoded) if data is None]
+        inputs = [__decoding_inputs(generations[i], field) for i in coded]
+        outputs = workers.matmul_many([(inverse, symbol_data, None)
+                                       for inverse, symbol_data in inputs], field)
+        for i, output in zip(coded, outputs):
+            decoded[i] = bytearray(output)
+        print("%d generations decoded successfully, %d of them needed no decoding"
+              % (len(decoded), len(decoded) - len(coded)))
+        return decoded
+
+    return [decode_file(symbols, field) for symbols in generations]
+#
+
+
+def recode(symbols, symbol_count, output_symbol_count, field=8):
     """
     Recode a file using an RLNC recoder and the provided coded symbols.
     The symbols are fed into the recoder where output_symbol_count symbols are created
     by generating new linear combinations.
+    With the NumPy codec this is a single matrix product of random recoding coefficients
+    with the symbols: the coefficient vectors are combined like the data, so the results
+    are coefficient-prefixed symbols as they are.
     Examples of different techiques to recode using Kodo can be found here:
     https://github.com/steinwurf/kodo-python/blob/master/examples/pure_recode_symbol_api.py
     https://github.com/steinwurf/kodo-python/blob/master/examples/pure_recode_payload_api.py
@@ -123,9 +621,17 @@ def recode(symbols, symbol_count, output_symbol_count):
     :param symbols: coded symbols that contain both the coefficients and symbol data
     :param symbol_count: number of symbols needed to decode the file
     :param output_symbol_count: number of symbols to create
+    :param field: Number of bits of the field elements
     :return: the recoded symbols
     """
 
+    if __codec(field) == 'numpy':
+        received = np.array([np.frombuffer(symbol, dtype=np.uint8) for symbol in symbols])
+        recoding_coefficients = np.random.randint(0, 1 << field,
+                                                  (output_symbol_count, len(symbols)))
+        return [bytearray(symbol) for symbol in workers.matmul(recoding_coefficients, received,
+                                                               field=field)]
+
     symbol_size = len(symbols[0]) - symbol_count #subtract the coefficients' size
     recoder = kodo.RLNCPureRecoder(kodo.field.binary8, symbol_count, symbol_size, symbol_count)
 
@@ -152,45 +658,620 @@ def recode(symbols, symbol_count, output_symbol_count):
 #
 
 
+def __select_fragments(coded_fragments, max_erasures, systematic=False):
+    """
+    We need fragments from 4-max_erasures nodes to reconstruct the file, select this many
+    by randomly removing 'max_erasures' elements from the given fragment names.
+    Systematic files are read from the fragments with the uncoded source symbols.
+    """
+    if systematic:
+        return coded_fragments[:len(coded_fragments) - max_erasures]
+    fragnames = copy.deepcopy(coded_fragments)
+    for i in range(max_erasures):
+        fragnames.remove(random.choice(fragnames))
+    return fragnames
+#
+
+
+def __consume_symbol(decoder, symbol, symbols_num):
+    """
+    Feed a coded symbol to the progressive decoder of a generation. With kodo the symbol
+    is eliminated right away; the NumPy codec only eliminates the coefficient vector to
+    track the rank, and multiplies the symbol data with the inverse once the rank is full.
+
+    :param decoder: Decoder state, a dict created by __get_generations
+    :param symbol: The coded symbol, the coefficients followed by the symbol data
+    :param symbols_num: Number of source symbols per generation
+    :return: True if the symbol increased the rank of the decoder
+    """
+    field = decoder["field"]
+    if __codec(field) == 'numpy':
+        if not gf.reduce_row(decoder["basis"], symbol[:header_size('raw', symbols_num, field)],
+                             field):
+            return False
+        decoder["symbols"].append({"data": symbol})
+        return True
+
+    if decoder["kodo"] is None:
+        # Create the decoder once the symbol size is known
+        decoder["kodo"] = kodo.RLNCDecoder(kodo.field.binary8, symbols_num,
+                                           len(symbol) - symbols_num)
+        decoder["data"] = bytearray(decoder["kodo"].block_size())
+        decoder["kodo"].set_symbols_storage(decoder["data"])
+    rank = decoder["kodo"].rank()
+    decoder["kodo"].consume_symbol(symbol[symbols_num:], symbol[:symbols_num])
+    return decoder["kodo"].rank() > rank
+#
+
+
+def __decoder_rank(decoder):
+    """
+    Returns the rank of a progressive decoder.
+    """
+    if __codec(decoder["field"]) == 'numpy':
+        return len(decoder["basis"])
+    return decoder["kodo"].rank() if decoder["kodo"] is not None else 0
+#
+
+
+def __get_generations(coded_fragments, fragnames, requests, symbols_num, coefficient_format,
+                      density, field, data_req_socket, response_socket, stale_chunks=()):
+    """
+    Retrieve and decode generations of a file. The subfragments of all generations are
+    requested in parallel and fed to a decoder per generation as they arrive; a
+    generation is complete as soon as its rank reaches symbols_num, later subfragments
+    are dropped. A node that lost some subfragments of a fragment sends the ones it
+    still has; once the answered fragments and the ones still on their way cannot give
+    full rank, the missing symbols are requested from as many of the remaining nodes as
+    needed. If the rank of a generation stays the same for RANK_STALL_TIMEOUT (a node
+    is slow, down or lost the whole fragment), its subfragments are requested from the
+    remaining nodes as well.
+    Chunks that may have missed an update are never read: the fragments of a generation
+    whose chunk is stale are replaced with other ones.
+
+    :param coded_fragments: Names of all the coded fragments of the file
+    :param fragnames: Names of the fragments to read from first
+    :param requests: Dict of generation index -> (prefix_length, offset, length) of the
+                     getdata requests, length 0 means to the end of the subfragments
+    :param symbols_num: Number of source symbols per generation (None: work it out from
+                        the number of subfragments in the first response)
+    :param coefficient_format: 'raw' or 'seed', see COEFFICIENT_FORMATS
+    :param density: Fraction of non-zero coefficients, see seed_coefficients
+    :param field: Number of bits of the field elements
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param stale_chunks: Names of the chunks that may have missed an update
+    :return: Dict of generation index -> decoded data
+    :raises TimeoutError: if a generation could not be decoded within READ_TIMEOUT
+    :raises FileNotFoundError: if fewer fragments of a generation than fragnames are up
+                               to date
+    """
+    # Responses to earlier reads are told apart by the request ID
+    request_id = random_string(8)
+    stale_chunks = set(stale_chunks)
+
+    def usable(generation, names):
+        # The fragments whose chunk of the generation is up to date
+        return [name for name in names
+                if stripe_chunk_name(name, generation) not in stale_chunks]
+
+    def send_requests(generation, names):
+        prefix_length, offset, length = requests[generation]
+        for name in names:
+            task = messages_pb2.getdata_request()
+            task.filename = stripe_chunk_name(name, generation)
+            task.prefix_length = prefix_length
+            task.offset = offset
+            task.length = length
+            task.request_id = request_id
+            data_req_socket.send(task.SerializeToString())
+
+    # Every node stores the same number of subfragments of a generation
+    subfragments_per_node = None
+    if symbols_num is not None:
+        subfragments_per_node = symbols_num // len(fragnames)
+
+    def request_missing(generation):
+        # Ask the remaining nodes for the symbols that the answered fragments lacked
+        # and the fragments on their way cannot make up for
+        missing = (symbols_num - __decoder_rank(decoders[generation])
+                   - subfragments_per_node * len(pending[generation]))
+        remaining = [name for name in usable(generation, coded_fragments)
+                     if name not in requested[generation]]
+        if missing > 0 and remaining:
+            names = remaining[:-(-missing // subfragments_per_node)]
+            print("Generation %d is missing %d symbols, requesting %d more fragments"
+                  % (generation, missing, len(names)))
+            send_requests(generation, names)
+            requested[generation].update(names)
+            pending[generation].update(names)
+
+    # Request the coded fragments in parallel. Nodes return all the subfragments they have
+    requested = {}
+    # Requested fragments that have not been answered yet
+    pending = {}
+    chunk_generations = {}
+    chunk_fragments = {}
+    for generation in requests:
+        # Replace the fragments with stale chunks with other ones
+        names = usable(generation, fragnames)
+        others = [name for name in usable(generation, coded_fragments) if name not in names]
+        if len(names) + len(others) < len(fragnames):
+            raise FileNotFoundError("Only %d of the %d fragments of generation %d needed are "
+                                    "up to date, the file must be repaired"
+                                    % (len(names) + len(others), len(fragnames), generation))
+        names += others[:len(fragnames) - len(names)]
+        send_requests(generation, names)
+        requested[generation] = set(names)
+        pending[generation] = set(names)
+        for name in coded_fragments:
+            chunk_generations[stripe_chunk_name(name, generation)] = generation
+            chunk_fragments[stripe_chunk_name(name, generation)] = name
+
+    # Feed the subfragments to the decoder of their generation as they arrive
+    decoders = {generation: {"field": field, "basis": [], "symbols": [], "kodo": None,
+                             "data": None}
+                for generation in requests}
+    incomplete = set(requests)
+    start = time.monotonic()
+    stall_deadline = start + RANK_STALL_TIMEOUT/1000
+    while incomplete:
+        if time.monotonic() >= start + READ_TIMEOUT/1000:
+            ranks = ", ".join("%d" % __decoder_rank(decoders[generation])
+                              for generation in sorted(incomplete))
+            raise TimeoutError("%d generations could not be decoded within %d ms, rank %s of %s"
+                               % (len(incomplete), READ_TIMEOUT, ranks, symbols_num))
+        result = receive_response(response_socket, request_id,
+                                  min(stall_deadline, start + READ_TIMEOUT/1000))
+        if result is None:
+            if time.monotonic() >= stall_deadline:
+                # The rank stalled: some nodes are slow, down or lost subfragments
+                for generation in incomplete:
+                    remaining = [name for name in usable(generation, coded_fragments)
+                                 if name not in requested[generation]]
+                    if remaining:
+                        print("Rank of generation %d stalled at %d, requesting %d more fragments"
+                              % (generation, __decoder_rank(decoders[generation]), len(remaining)))
+                        send_requests(generation, remaining)
+                        requested[generation].update(remaining)
+                        pending[generation].update(remaining)
+                stall_deadline = time.monotonic() + RANK_STALL_TIMEOUT/1000
+            continue
+
+        # Responses contain the chunk name and then the subfragments
+        name = result[0].decode('utf-8')
+        if len(result) < 2 or name not in chunk_generations:
+            print("Dropping unexpected response %s" % name)
+            continue
+        generation = chunk_generations[name]
+        if generation not in incomplete:
+            # The generation was decoded without this fragment
+            continue
+        pending[generation].discard(chunk_fragments[name])
+        if symbols_num is None:
+            # Every node stores the same number of subfragments of a generation (unless
+            # the first one to answer lost some)
+            subfragments_per_node = len(result) - 1
+            symbols_num = subfragments_per_node * len(fragnames)
+
+        decoder = decoders[generation]
+        for i in range(1, len(result)):
+            if coefficient_format == 'seed':
+                symbol = expand_coefficients(result[i], symbols_num, density, field)
+            else:
+                symbol = bytearray(result[i])
+            if __consume_symbol(decoder, symbol, symbols_num):
+                stall_deadline = time.monotonic() + RANK_STALL_TIMEOUT/1000
+            if __decoder_rank(decoder) == symbols_num:
+                incomplete.remove(generation)
+                break
+        else:
+            request_missing(generation)
+    print("Received enough coded fragments to decode %d generations" % len(requests))
+
+    #Reconstruct the original data of the generations
+    if __codec(field) == 'numpy':
+        decoded = decode_generations([decoders[generation]["symbols"]
+                                      for generation in requests], field)
+    else:
+        decoded = [decoders[generation]["data"] for generation in requests]
+    return dict(zip(requests, decoded))
+#
+
+
 def get_file(coded_fragments, max_erasures, file_size,
-             data_req_socket, response_socket):
+             data_req_socket, response_socket, generations=1, subfragments_per_node=None,
+             coefficient_format='raw', systematic=False, density=1.0, field=8,
+             stale_chunks=()):
     """
-    Implements retrieving a file that is stored with RLNC erasure coding. Only works
-    if there are no missing fragments.
-    The implementation is similar to the Reed-Solomon equivalent function.
+    Implements retrieving a file that is stored with RLNC erasure coding. Subfragments
+    are requested from 4-max_erasures nodes and decoded as they arrive. Nodes that lost
+    subfragments send the rest, and the symbols that are missing for full rank are
+    requested from the other nodes, so the file can be read before it is repaired
+    (see __get_generations).
+    The implementation is similar to the Reed-Solomon equivalent function. Up to
+    workers.WORKERS generations are retrieved and decoded at once, as long as they fit
+    into READ_BATCH_SIZE.
 
     :param coded_fragments: Names of the coded fragments
     :param max_erasures: Max erasures setting that was used when storing the file
     :param file_size: The original data size.
     :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
     :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param generations: How many generations the file was cut to
+    :param subfragments_per_node: How many subfragments are stored per fragment on a node
+                                  (default: the number in the first response)
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param systematic: Whether the file was stored with the systematic layout
+    :param density: Fraction of non-zero coefficients the file was stored with
+    :param field: Number of bits of the field elements the file was stored with
+    :param stale_chunks: Names of the chunks that may have missed an update, which are
+                         not read
     :return: The decoded file
+    :raises TimeoutError: if the file could not be decoded within READ_TIMEOUT
+    :raises FileNotFoundError: if too few chunks of a generation are up to date
     """
+    file_data = bytearray()
+    for generation_data in stream_file(coded_fragments, max_erasures, file_size,
+                                       data_req_socket, response_socket, generations,
+                                       subfragments_per_node, coefficient_format,
+                                       systematic, density, field, stale_chunks):
+        file_data += generation_data
+
+    return file_data
+#
 
-    # We need fragments from 4-max_erasures nodes to reconstruct the file, select this many
-    # by randomly removing 'max_erasures' elements from the given chunk names.
-    fragnames = copy.deepcopy(coded_fragments)
-    for i in range(max_erasures):
-        fragnames.remove(random.choice(fragnames))
 
-    # Request the coded fragments in parallel. Nodes return all their subfragments
-    for name in fragnames:
-        task = messages_pb2.getdata_request()
-        task.filename = name
-        data_req_socket.send(task.SerializeToString())
+def __read_batch(generation_size):
+    """
+    Returns how many generations of the given size a read retrieves and decodes at once:
+    one per worker process, but no more than fit into READ_BATCH_SIZE, so the memory a
+    read needs does not grow with the number of CPU cores.
+    """
+    return max(1, min(workers.WORKERS, READ_BATCH_SIZE // max(1, generation_size)))
+#
 
-    # Receive all chunks and insert them into the symbols array
-    symbols = []
-    for _ in range(len(fragnames)):
-        result = response_socket.recv_multipart()
-        for i in range(1, len(result)):
-            symbols.append({"data": bytearray(result[i])})
-    print("All coded fragments received successfully")
 
-    #Reconstruct the original file data
-    file_data = decode_file(symbols)
+def stream_file(coded_fragments, max_erasures, file_size,
+                data_req_socket, response_socket, generations=1, subfragments_per_node=None,
+                coefficient_format='raw', systematic=False, density=1.0, field=8,
+                stale_chunks=()):
+    """
+    Generator version of get_file: yields the data of each generation as soon as it is
+    decoded, so only the generations that are retrieved at once (see __read_batch) are
+    held in memory. The parameters are the same as those of get_file.
 
-    return file_data[:file_size]
+    :return: Generator of the decoded data of each generation, without the padding
+    :raises TimeoutError: if the file could not be decoded within READ_TIMEOUT
+    :raises FileNotFoundError: if too few chunks of a generation are up to date
+    """
+    symbols_num = None
+    if subfragments_per_node is not None:
+        symbols_num = (STORAGE_NODES_NUM - max_erasures) * subfragments_per_node
+    fragnames = __select_fragments(coded_fragments, max_erasures, systematic)
+
+    remaining = file_size
+    # All generations but the last one have the same size
+    batch = __read_batch(math.ceil(file_size / max(1, generations)))
+    for first in range(0, generations, batch):
+        requests = {generation: (0, 0, 0)
+                    for generation in range(first, min(first + batch, generations))}
+        decoded = __get_generations(coded_fragments, fragnames, requests, symbols_num,
+                                    coefficient_format, density, field, data_req_socket,
+                                    response_socket, stale_chunks)
+        for generation in requests:
+            generation_data = decoded.pop(generation)
+            yield bytes(memoryview(generation_data)[:remaining])
+            remaining -= min(remaining, len(generation_data))
+#
+
+
+def get_file_range(coded_fragments, max_erasures, subfragments_per_node, file_size,
+                   symbol_size, start, end, data_req_socket, response_socket, generations=1,
+                   coefficient_format='raw', systematic=False, density=1.0, field=8,
+                   stale_chunks=()):
+    """
+    Implements retrieving a byte range of a file that is stored with RLNC erasure coding.
+    Only the generations that overlap the range are retrieved, and the nodes only send
+    the coefficients and the columns of their subfragments that hold the range (see
+    symbol_range_parts), which are decoded on their own. Missing fragments are handled
+    like in get_file.
+
+    :param coded_fragments: Names of the coded fragments
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param subfragments_per_node: How many subfragments are stored per fragment on a node
+    :param file_size: The original data size.
+    :param symbol_size: The size of the symbols
+    :param start: First byte of the range
+    :param end: End of the range (exclusive)
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param generations: How many generations the file was cut to
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param systematic: Whether the file was stored with the systematic layout
+    :param density: Fraction of non-zero coefficients the file was stored with
+    :param field: Number of bits of the field elements the file was stored with
+    :param stale_chunks: Names of the chunks that may have missed an update, which are
+                         not read
+    :return: The requested bytes of the file
+    :raises TimeoutError: if the range could not be decoded within READ_TIMEOUT
+    :raises FileNotFoundError: if too few chunks of a generation are up to date
+    """
+    file_data = bytearray()
+    for data in stream_file_range(coded_fragments, max_erasures, subfragments_per_node,
+                                  file_size, symbol_size, start, end, data_req_socket,
+                                  response_socket, generations, coefficient_format,
+                                  systematic, density, field, stale_chunks):
+        file_data += data
+
+    return file_data
+#
+
+
+def stream_file_range(coded_fragments, max_erasures, subfragments_per_node, file_size,
+                      symbol_size, start, end, data_req_socket, response_socket,
+                      generations=1, coefficient_format='raw', systematic=False,
+                      density=1.0, field=8, stale_chunks=()):
+    """
+    Generator version of get_file_range: yields the part of the range in each generation
+    as soon as it is decoded. The parameters are the same as those of get_file_range.
+
+    :return: Generator of the requested bytes of each generation that overlaps the range
+    :raises TimeoutError: if the range could not be decoded within READ_TIMEOUT
+    :raises FileNotFoundError: if too few chunks of a generation are up to date
+    """
+    assert(0 <= start <= end <= file_size)
+    symbols_num = (STORAGE_NODES_NUM - max_erasures) * subfragments_per_node
+    generation_size = symbols_num * symbol_size
+    header = header_size(coefficient_format, symbols_num, field)
+    element_size = gf.ELEMENT_TYPES[field].itemsize
+
+    if start == end:
+        return
+    fragnames = __select_fragments(coded_fragments, max_erasures, systematic)
+
+    first_generation, end_generation = start // generation_size, math.ceil(end / generation_size)
+    batch = __read_batch(generation_size)
+    for first in range(first_generation, end_generation, batch):
+        # A generation is read in two passes if its part of the range is split into the
+        # end of one source symbol and the beginning of the next one
+        requests = [{}, {}]
+        parts = {}
+        for generation in range(first, min(first + batch, end_generation)):
+            # The part of the range that falls into this generation
+            generation_start = max(start - generation*generation_size, 0)
+            generation_end = min(end - generation*generation_size, generation_size)
+
+            # The source symbols that hold this part of the range, and their columns
+            parts[generation] = symbol_range_parts(generation_start, generation_end,
+                                                   symbol_size)
+            for index, (_, _, _, _, columns) in enumerate(parts[generation]):
+                # Whole field elements
+                columns = (columns[0] // element_size * element_size,
+                           -(-columns[1] // element_size) * element_size)
+                # Request the coefficients and the columns of every subfragment
+                requests[index][generation] = (header, header + columns[0],
+                                               columns[1] - columns[0])
+
+        decoded = [__get_generations(coded_fragments, fragnames, pass_requests, symbols_num,
+                                     coefficient_format, density, field, data_req_socket,
+                                     response_socket, stale_chunks)
+                   for pass_requests in requests if pass_requests]
+
+        for generation, generation_parts in parts.items():
+            for index, (part_start, part_end, first_row, last_row, _) \
+                    in enumerate(generation_parts):
+                # The decoded columns of each source symbol, one after the other
+                _, column, width = requests[index][generation]
+                column -= header
+                offset = first_row*symbol_size + column
+                data = decoded[index][generation][first_row*width:(last_row + 1)*width]
+                yield bytes(data[part_start - offset:part_end - offset])
+#
+
+
+def __receive_update_acks(repair_response_socket, request_id, pending):
+    """
+    Wait until the storage nodes updated every fragment. Every node acknowledges every
+    fragment of an update with the subfragments it updated, so a fragment that no node
+    stores is told apart from a slow node.
+
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param request_id: The ID the updates were sent with
+    :param pending: Counter of the updated fragment names, once for each update sent. The
+                    acknowledged updates are removed from it.
+    :raises TimeoutError: if the updates were not acknowledged within UPDATE_TIMEOUT
+    :raises FileNotFoundError: if all storage nodes answered that they don't store a
+                               fragment
+    """
+    # Number of acknowledgements without the fragment that mean that no node stores it
+    all_absent = {name: count*STORAGE_NODES_NUM for name, count in pending.items()}
+    absent = collections.Counter()
+    deadline = time.monotonic() + UPDATE_TIMEOUT/1000
+    while sum(pending.values()) > 0:
+        resp = receive_response(repair_response_socket, request_id, deadline)
+        if resp is None:
+            raise TimeoutError("%d fragment updates were not acknowledged within %d ms"
+                               % (sum(pending.values()), UPDATE_TIMEOUT))
+        ack = messages_pb2.fragment_status_response()
+        ack.ParseFromString(resp[0])
+        name = ack.fragment_name
+        if name not in all_absent:
+            print("Dropping unexpected response %s" % name)
+            continue
+        if not ack.chunks:
+            absent[name] += 1
+            if absent[name] == all_absent[name]:
+                raise FileNotFoundError("Fragment %s is not stored on any storage node"
+                                        % name)
+            continue
+        pending[name] -= 1
+#
+
+
+def update_file(coded_fragments, max_erasures, subfragments_per_node, file_size,
+                symbol_size, offset, data, data_req_socket, response_socket,
+                send_task_socket, repair_socket, repair_response_socket,
+                generations=1, generation_size=None, coefficient_format='raw',
+                systematic=False, density=1.0, field=8, stale_chunks=None):
+    """
+    Implements overwriting part of a file, or appending to it, that is stored with RLNC
+    erasure coding without encoding the file again. Like with Reed-Solomon, each
+    subfragment changes by its coefficient times the change of the original data, so only
+    the changed bytes are read and sent to the storage nodes as deltas. Appended data
+    fills the padding of the last generation; data beyond that is encoded as new
+    generations. A file that is smaller than one full generation has small symbols, so
+    when it outgrows them it is stored again (under new fragment names) with symbols at
+    least twice as large.
+    The chunks to change are checked before the first delta is sent. If some storage
+    nodes do not acknowledge the update after all, the chunks that may have missed it
+    are added to 'stale_chunks'. They are not read until they are repaired.
+
+    :param coded_fragments: Names of the coded fragments
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param subfragments_per_node: How many subfragments are stored per fragment on a node
+    :param file_size: The original data size.
+    :param symbol_size: The size of the symbols
+    :param offset: Where to write the data, at most file_size
+    :param data: The new data
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param generations: How many generations the file was cut to
+    :param generation_size: The maximum generation size the file was stored with
+                            (default: GENERATION_SIZE)
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param systematic: Whether the file was stored with the systematic layout
+    :param density: Fraction of non-zero coefficients the file was stored with
+    :param field: Number of bits of the field elements the file was stored with
+    :param stale_chunks: List of the names of the chunks that may have missed an earlier
+                         update, which are not read. If the update fails, the chunks that
+                         may have missed it are added to it.
+    :return: The fragment names, file size, number of generations and symbol size after
+             the update
+    :raises TimeoutError: if the data could not be read within READ_TIMEOUT or the update
+                          was not acknowledged within UPDATE_TIMEOUT
+    :raises FileNotFoundError: if a chunk to update is not stored on any storage node,
+                               or too few chunks of a generation are up to date
+    """
+    assert(0 <= offset <= file_size)
+    if stale_chunks is None:
+        stale_chunks = []
+    symbols_num = (STORAGE_NODES_NUM - max_erasures) * subfragments_per_node
+    if generation_size is None:
+        generation_size = GENERATION_SIZE
+    full_symbol_size = math.ceil(generation_size/symbols_num)
+    # The size of the generations of this file
+    file_generation_size = symbols_num * symbol_size
+
+    data = memoryview(data)
+    end = offset + len(data)
+    capacity = generations * file_generation_size
+
+    if end > capacity and symbol_size < full_symbol_size:
+        # The file is a single generation with small symbols: store it again with larger ones
+        file_data = get_file(coded_fragments, max_erasures, file_size,
+                             data_req_socket, response_socket, generations,
+                             subfragments_per_node, coefficient_format, systematic, density,
+                             field, stale_chunks)
+        file_data[offset:end] = data
+        symbol_size = min(max(2*symbol_size, math.ceil(end/symbols_num)), full_symbol_size)
+        symbol_size += symbol_size % gf.ELEMENT_TYPES[field].itemsize
+        coded_fragments, generations, symbol_size = store_file(
+            file_data, max_erasures, subfragments_per_node, send_task_socket,
+            response_socket, symbol_size, generation_size, coefficient_format, systematic,
+            density, field)
+        print("File stored again with symbol size %d" % symbol_size)
+        return coded_fragments, end, generations, symbol_size
+
+    # Encode the data beyond the last generation as new generations with the same
+    # geometry. They are stored first: until the file size is updated, they are not used
+    # if the update of the existing generations fails.
+    new_generations = generations
+    if end > capacity:
+        new_generations = generations + math.ceil((end - capacity) / file_generation_size)
+        __store_generations(chunks(data[capacity - offset:], file_generation_size),
+                            coded_fragments, generations, subfragments_per_node,
+                            symbols_num, symbol_size, coefficient_format, systematic,
+                            density, field, send_task_socket, response_socket)
+
+    # The part of the existing generations that changes, including their padding
+    update_end = min(end, capacity)
+    if offset < update_end:
+        # The padding is read as well: it is zero, unless an update that failed changed
+        # it on the chunks that acknowledged it
+        old_data = get_file_range(coded_fragments, max_erasures, subfragments_per_node,
+                                  capacity, symbol_size, offset, update_end,
+                                  data_req_socket, response_socket, generations,
+                                  coefficient_format, systematic, density, field,
+                                  stale_chunks)
+        delta = np.frombuffer(old_data, dtype=np.uint8) ^ \
+                np.frombuffer(data[:update_end - offset], dtype=np.uint8)
+
+        # The delta of each source symbol it touches
+        element_size = gf.ELEMENT_TYPES[field].itemsize
+        updates = []
+        position = offset
+        while position < update_end:
+            generation, generation_offset = divmod(position, file_generation_size)
+            symbol_index, symbol_offset = divmod(generation_offset, symbol_size)
+            length = min(symbol_size - symbol_offset, update_end - position)
+            symbol_delta = delta[position - offset:position - offset + length]
+            # The delta of whole field elements, the bytes around the change do not change
+            before = symbol_offset % element_size
+            after = -(symbol_offset + length) % element_size
+            symbol_delta = np.concatenate([np.zeros(before, dtype=np.uint8), symbol_delta,
+                                           np.zeros(after, dtype=np.uint8)])
+            if symbol_delta.any():
+                updates.append((generation, symbol_index, symbol_offset - before,
+                                symbol_delta.tobytes()))
+            position += length
+
+        # Make sure that every chunk of the changed generations can be updated
+        changed_chunks = [stripe_chunk_name(name, generation)
+                          for generation in sorted(set(update[0] for update in updates))
+                          for name in coded_fragments]
+        holders = chunk_status(changed_chunks, STORAGE_NODES_NUM, READ_TIMEOUT,
+                               repair_socket, repair_response_socket)
+        for name in changed_chunks:
+            if name not in holders:
+                raise FileNotFoundError("Chunk %s is not stored on any storage node" % name)
+
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.UPDATE_FRAGMENT_DATA_REQ
+        header.request_id = random_string(8)
+
+        # Send the delta of each source symbol to all nodes
+        pending = collections.Counter()
+        for generation, symbol_index, symbol_offset, symbol_delta in updates:
+            chunk_names = [stripe_chunk_name(name, generation) for name in coded_fragments]
+            task = messages_pb2.update_fragments_request()
+            task.fragment_names.extend(chunk_names)
+            task.symbol_count = symbols_num
+            task.symbol_index = symbol_index
+            task.offset = symbol_offset
+            task.field = field
+            if coefficient_format == 'seed':
+                task.seed_size = SEED_SIZE
+                task.density = density
+            repair_socket.send_multipart([b"all_nodes",
+                                          header.SerializeToString(),
+                                          task.SerializeToString(),
+                                          symbol_delta])
+            pending.update(chunk_names)
+
+        try:
+            __receive_update_acks(repair_response_socket, header.request_id, pending)
+        except (TimeoutError, FileNotFoundError):
+            # The chunks that were not acknowledged must not be used until they are repaired
+            stale_chunks += [name for name, count in pending.items()
+                             if count > 0 and name not in stale_chunks]
+            raise
+        print("Updated %d bytes" % (update_end - offset))
+
+    return coded_fragments, max(file_size, end), new_generations, symbol_size
 #
 
 
@@ -206,10 +1287,17 @@ def __store_repair_fragments(missing_fragments, partially_missing_fragments,
     :param subfragments_per_node: number of subfragments per fragment
     :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
     :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
-    :return: the number of repaired subfragments
+    :return: the number of repaired subfragments that the nodes acknowledged within
+             READ_TIMEOUT
     '''
 
     number_of_repaired_subfragments = 0
+    # Number of subfragments sent in each fragment, until the node acknowledges them
+    sent = {}
+    acknowledged = 0
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
+    header.request_id = random_string(8)
 
     # 1. Full missing fragments (arbitrary choice to have this first as all repair packets
     # are functionally equivalent)
@@ -217,9 +1305,6 @@ def __store_repair_fragments(missing_fragments, partially_missing_fragments,
         task = messages_pb2.storedata_request()
         task.filename = fragment["name"]
 
-        header = messages_pb2.header()
-        header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
-
         frames = [fragment["node_id"].encode('UTF-8'), #Use the node_id as the topic
                   header.SerializeToString(),
                   task.SerializeToString()]
@@ -229,38 +1314,526 @@ def __store_repair_fragments(missing_fragments, partially_missing_fragments,
             frames.append(bytearray(repair_symbols[i]))
 
         number_of_repaired_subfragments += subfragments_per_node
+        sent[fragment["name"]] = subfragments_per_node
+        repair_socket.send_multipart(frames)
+
+    # Wait until we receive a response for every fragment
+    deadline = time.monotonic() + READ_TIMEOUT/1000
+    for task_nbr in range(len(missing_fragments)):
+        resp = receive_response(repair_response_socket, header.request_id, deadline)
+        if resp is None:
+            print("%d repaired fragments were not acknowledged within %d ms"
+                  % (len(missing_fragments) - task_nbr, READ_TIMEOUT))
+            break
+        print('Repaired fully missing fragment: %s' % resp[0].decode('utf-8'))
+        acknowledged += sent.pop(resp[0].decode('utf-8'), 0)
+
+    # 2. Partially missing fragments
+    for fragment in partially_missing_fragments:
+        task = messages_pb2.storedata_request()
+        task.filename = fragment["name"]
+
+        frames = [fragment["node_id"].encode('UTF-8'), #Use the node_id as the topic
+                  header.SerializeToString(),
+                  task.SerializeToString()]
+
+        for i in range(number_of_repaired_subfragments,
+                       number_of_repaired_subfragments + fragment["subfragments_lost"]):
+            frames.append(bytearray(repair_symbols[i]))
+
+        number_of_repaired_subfragments += fragment["subfragments_lost"]
+        sent[fragment["name"]] = fragment["subfragments_lost"]
         repair_socket.send_multipart(frames)
 
-        # Wait until we receive a response for every fragment
-        for task_nbr in range(len(missing_fragments)):
-            resp = repair_response_socket.recv_string()
-            print('Repaired fully missing fragment: %s' % resp)
+    # Wait until we receive a response for every fragment
+    deadline = time.monotonic() + READ_TIMEOUT/1000
+    for task_nbr in range(len(partially_missing_fragments)):
+        resp = receive_response(repair_response_socket, header.request_id, deadline)
+        if resp is None:
+            print("%d repaired fragments were not acknowledged within %d ms"
+                  % (len(partially_missing_fragments) - task_nbr, READ_TIMEOUT))
+            break
+        print('Repaired partially missing fragment: %s' % resp[0].decode('utf-8'))
+        acknowledged += sent.pop(resp[0].decode('utf-8'), 0)
+
+    return acknowledged
+#
 
-        # 2. Partially missing fragments
-        for fragment in partially_missing_fragments:
-            task = messages_pb2.storedata_request()
-            task.filename = fragment["name"]
 
-            header = messages_pb2.header()
-            header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
+def __repair_request_counts(holders, total, per_node=0):
+    """
+    Work out how many recoded symbols to request from each node for a repair: 'total'
+    spread as evenly as possible, and at least 'per_node' from each. A node cannot send
+    more independent symbols than it has subfragments.
+
+    :param holders: List of the remaining fragments, dicts with the "count" of
+                    subfragments the node holds
+    :param total: The number of recoded symbols to request in total
+    :param per_node: The number of recoded symbols to request from each node at least
+    :return: List with the number of recoded symbols to request for each fragment
+    """
+    counts = [min(holder["count"], per_node) for holder in holders]
+    while sum(counts) < total:
+        # One more from each node that has more, until there are enough
+        growing = [i for i, holder in enumerate(holders) if counts[i] < holder["count"]]
+        if not growing:
+            break
+        for i in growing[:total - sum(counts)]:
+            counts[i] += 1
+    return counts
+#
 
-            frames = [fragment["node_id"].encode('UTF-8'), #Use the node_id as the topic
-                      header.SerializeToString(),
-                      task.SerializeToString()]
 
-            for i in range(number_of_repaired_subfragments,
-                           number_of_repaired_subfragments + fragment["subfragments_lost"]):
-                frames.append(bytearray(repair_symbols[i]))
+def __get_recoded_symbols(holders, counts, symbol_count, coefficient_format, density, field,
+                          repair_socket, repair_response_socket):
+    """
+    Request recoded symbols of the remaining fragments of a generation from the nodes
+    that hold them.
+
+    :param holders: List of the remaining fragments, dicts with the "name" and "node_id"
+    :param counts: The number of recoded symbols to request for each fragment
+    :param symbol_count: Number of source symbols per generation
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param density: Fraction of non-zero coefficients the file was stored with
+    :param field: Number of bits of the field elements the file was stored with
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :return: List of the recoded symbols, in the 'raw' format
+    :raises TimeoutError: if a node did not answer within READ_TIMEOUT
+    """
+    request_id = random_string(8)
+    requests = 0
+    for holder, count in zip(holders, counts):
+        if count == 0:
+            continue
+        task = messages_pb2.recode_fragments_request()
+        task.fragment_name = holder["name"]
+        task.symbol_count = symbol_count
+        task.output_fragment_count = count
+        task.field = field
+        if coefficient_format == 'seed':
+            task.seed_size = SEED_SIZE
+            task.density = density
 
-            number_of_repaired_subfragments += fragment["subfragments_lost"]
-            repair_socket.send_multipart(frames)
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.RECODE_FRAGMENTS_REQ
+        header.request_id = request_id
+
+        repair_socket.send_multipart([holder["node_id"].encode('UTF-8'),
+                                      header.SerializeToString(),
+                                      task.SerializeToString()])
+        requests += 1
+
+    # Wait until we receive a response from each node that was asked
+    recoded_symbols = []
+    deadline = time.monotonic() + READ_TIMEOUT/1000
+    for task_nbr in range(requests):
+        response = receive_response(repair_response_socket, request_id, deadline)
+        if response is None:
+            raise TimeoutError("%d of %d nodes did not send recoded symbols within %d ms"
+                               % (requests - task_nbr, requests, READ_TIMEOUT))
+        for i in range(len(response)):
+            recoded_symbols.append(bytearray(response[i]))
+    return recoded_symbols
+#
 
-        # Wait until we receive a response for every fragment
-        for task_nbr in range(len(partially_missing_fragments)):
-            resp = repair_response_socket.recv_string()
-            print('Repaired partially missing fragment: %s' % resp)
 
-    return number_of_repaired_subfragments
+def __get_repair_coefficients(holders, symbol_count, coefficient_format, density, field,
+                              repair_socket, repair_response_socket):
+    """
+    Retrieve the coefficient vectors of the remaining subfragments of a generation. Only
+    the headers are sent, not the symbol data.
+
+    :param holders: List of the remaining fragments, dicts with the "name" and "node_id"
+    :param symbol_count: Number of source symbols per generation
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param density: Fraction of non-zero coefficients the file was stored with
+    :param field: Number of bits of the field elements the file was stored with
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :return: Dict of fragment name -> list of coefficient vectors, without the fragments
+             whose node did not answer within READ_TIMEOUT
+    """
+    request_id = random_string(8)
+    for holder in holders:
+        task = messages_pb2.getdata_request()
+        task.filename = holder["name"]
+        task.length = header_size(coefficient_format, symbol_count, field)
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.FRAGMENT_DATA_REQ
+        header.request_id = request_id
+        repair_socket.send_multipart([holder["node_id"].encode('UTF-8'),
+                                      header.SerializeToString(),
+                                      task.SerializeToString()])
+
+    coefficients = {}
+    deadline = time.monotonic() + READ_TIMEOUT/1000
+    for task_nbr in range(len(holders)):
+        result = receive_response(repair_response_socket, request_id, deadline)
+        if result is None:
+            print("%d nodes did not send their coefficients within %d ms"
+                  % (len(holders) - task_nbr, READ_TIMEOUT))
+            break
+        if coefficient_format == 'seed':
+            coefficients[result[0].decode('utf-8')] = [
+                seed_coefficients(int.from_bytes(header, 'big'), symbol_count, density, field)
+                for header in result[1:]]
+        else:
+            coefficients[result[0].decode('utf-8')] = [bytes(header) for header in result[1:]]
+    return coefficients
+#
+
+
+def __repaired_fragments(remaining, missing_fragments, partially_missing_fragments,
+                         vectors, subfragments_per_node):
+    """
+    Returns the coefficient vectors of the fragments of a generation after a repair.
+
+    :param remaining: Dict of fragment name -> coefficient vectors of the remaining
+                      subfragments, see __get_repair_coefficients
+    :param missing_fragments: Fragments that are completely missing
+    :param partially_missing_fragments: Fragments with missing subfragments
+    :param vectors: Coefficient vectors of the new subfragments, in the order
+                    __store_repair_fragments sends them
+    :param subfragments_per_node: number of subfragments per fragment
+    :return: List with a list of coefficient vectors for each fragment
+    """
+    fragments = {name: list(fragment_vectors) for name, fragment_vectors in remaining.items()}
+    new_fragments = []
+    i = 0
+    for fragment in missing_fragments:
+        new_fragments.append(vectors[i:i + subfragments_per_node])
+        i += subfragments_per_node
+    for fragment in partially_missing_fragments:
+        fragments[fragment["name"]] += vectors[i:i + fragment["subfragments_lost"]]
+        i += fragment["subfragments_lost"]
+    return list(fragments.values()) + new_fragments
+#
+
+
+def __independent_fragments(fragments, nodes_needed, symbols, field=8, rank=None):
+    """
+    Check that the subfragments of any 'nodes_needed' fragments can decode a generation.
+
+    :param fragments: List with a list of coefficient vectors for each fragment
+    :param nodes_needed: Number of fragments that must be able to decode the generation
+    :param symbols: Number of source symbols per generation
+    :param field: Number of bits of the field elements
+    :param rank: The rank they must have (default: symbols). The steps of a stream cover
+                 more source symbols than they have coded symbols, see repair_generation.
+    :return: True if their coefficient vectors span the generation
+    """
+    if rank is None:
+        rank = symbols
+    for combination in itertools.combinations(fragments, nodes_needed):
+        matrix = __coefficient_matrix([vector for vectors in combination for vector in vectors],
+                                      symbols, field)
+        if len(gf.independent_rows(matrix, field)) < rank:
+            return False
+    return True
+#
+
+
+def __coefficient_matrix(vectors, symbols, field=8):
+    """
+    Stack coefficient vectors to a (len(vectors) x symbols) matrix of field elements.
+    """
+    return np.frombuffer(b''.join(bytes(vector) for vector in vectors),
+                         dtype=gf.ELEMENT_TYPES[field]).reshape(len(vectors), symbols)
+#
+
+
+def __combine_repair_symbols(symbols, symbols_num, coefficients, field=8):
+    """
+    Create new subfragments with the given coefficients from recoded symbols. Recoded
+    symbols have arbitrary coefficient vectors, so instead of recoding once more, each new
+    symbol is computed directly: with the coefficients C and data D of 'symbols_num'
+    independent received symbols, the symbol with the coefficients v is (v * C^-1) * D.
+    This gives new subfragments in the 'seed' format, and restores the uncoded source
+    symbols of systematic files.
+
+    :param symbols: Received symbols in the 'raw' format
+    :param symbols_num: Number of source symbols per generation
+    :param coefficients: List of (header, coefficient vector) tuples of the new symbols
+    :param field: Number of bits of the field elements
+    :return: The new symbols, each starting with its header
+    :raises ValueError: if the received symbols do not span the generation
+    """
+    element_type = gf.ELEMENT_TYPES[field]
+    received = np.array([np.frombuffer(symbol, dtype=element_type, count=symbols_num)
+                         for symbol in symbols])
+    rows = gf.independent_rows(received, field)[:symbols_num]
+    if len(rows) < symbols_num:
+        raise ValueError("Only %d of the %d received symbols are linearly independent"
+                         % (len(rows), symbols_num))
+    inverse = gf.invert_matrix(received[rows], field)
+    symbol_data = np.array([np.frombuffer(symbols[row], dtype=np.uint8,
+                                          offset=header_size('raw', symbols_num, field))
+                            for row in rows])
+
+    new_coefficients = np.array([np.frombuffer(vector, dtype=element_type)
+                                 for _, vector in coefficients])
+    # The product of the two coefficient matrices, computed on their bytes
+    combined = gf.matmul(new_coefficients, inverse.view(np.uint8), field=field)
+    new_data = workers.matmul(combined.view(element_type), symbol_data, field=field)
+    return [bytes(header) + data.tobytes() for (header, _), data in zip(coefficients, new_data)]
+#
+
+
+def repair_generation(coded_fragments, max_erasures, subfragments_per_node,
+                      coefficient_format, systematic, density, field,
+                      repair_socket, repair_response_socket, window=1):
+    """
+    Check the subfragments of one generation of a file and repair the missing ones.
+    The steps of sliding-window streams (see rlnc_stream) are repaired the same way: the
+    coded symbols of a step cover the source symbols of 'window' steps, but only span as
+    many of them as a generation has, and recoding them keeps them in the same space.
+
+    :param coded_fragments: The chunk names of the generation, one per node
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param subfragments_per_node: How many subfragments are stored per fragment on a node
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param systematic: Whether the file was stored with the systematic layout
+    :param density: Fraction of non-zero coefficients the file was stored with
+    :param field: Number of bits of the field elements the file was stored with
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param window: Number of steps the coded symbols of a stream step cover (1: a
+                   generation). Only the 'raw' format without the systematic layout
+                   can be repaired with a window.
+    :return: the number of missing subfragments, the number of repaired subfragments
+    """
+    # The rank of the coded symbols of a generation (or step), and the length of their
+    # coefficient vectors
+    rank = (STORAGE_NODES_NUM - max_erasures) * subfragments_per_node
+    symbol_count = rank * window
+    repaired_subfragment_count = 0
+    # Missing subfragments that cannot be repaired because their node did not answer
+    unrepaired = 0
+
+    '''
+    Iterate over each node's coded subfragments to check what is missing.
+    Because this is a distributed system where the central Controller has no knowledge
+    of what is stored on each Strorage node, we build several lists and sets to get an
+    accurate picture. Through these lists and sets we determine:
+    - which nodes respond to our queries
+    - which nodes have a partially missing fragment (and how many subfragments are missing)
+    - which nodes have fully lost their fragment
+    This information will be key in determining where and how many repaired subfragments
+    to send later.
+    '''
+    nodes = set() # list of all storage nodes
+    nodes_with_fragment = set() # list of storage nodes with at least partial fragments
+    missing_fragments = [] # list of coded fragments that are fully missing
+    partially_missing_fragments = [] # list of coded fragments that are partially missing
+    existing_fragments = [] # list of coded fragments that are at least in part intact
+    fragment_holders = [] # list of the nodes that hold them, with their subfragment count
+    missing_subfragment_count = 0
+
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.FRAGMENT_STATUS_REQ
+    header.request_id = random_string(8)
+    for fragment in coded_fragments:
+        task = messages_pb2.fragment_status_request()
+        task.fragment_name = fragment
+        repair_socket.send_multipart([b"all_nodes",
+                                      header.SerializeToString(),
+                                      task.SerializeToString()])
+
+    # Wait until we receive a response from each node. Nodes that do not answer within
+    # READ_TIMEOUT are treated as nodes without the fragments.
+    responses = {fragment: [] for fragment in coded_fragments}
+    answers = 0
+    deadline = time.monotonic() + READ_TIMEOUT/1000
+    while answers < len(coded_fragments) * STORAGE_NODES_NUM:
+        resp = receive_response(repair_response_socket, header.request_id, deadline)
+        if resp is None:
+            print("%d fragment status requests were not answered within %d ms"
+                  % (len(coded_fragments) * STORAGE_NODES_NUM - answers, READ_TIMEOUT))
+            break
+        response = messages_pb2.fragment_status_response()
+        response.ParseFromString(resp[0])
+        answers += 1
+        if response.fragment_name in responses:
+            responses[response.fragment_name].append(response)
+
+    for fragment in coded_fragments:
+        fragment_found = False 
+
+        for response in responses[fragment]:
+            nodes.add(response.node_id) # Build a set of nodes
+            if response.is_present == True:
+                nodes_with_fragment.add(response.node_id)
+                existing_fragments.append(fragment)
+                fragment_holders.append({"name": fragment,
+                                         "node_id": response.node_id,
+                                         "count": response.count})
+                fragment_found = True
+
+                # Check for partially missing fragments
+                if response.count < subfragments_per_node:
+                    subfragments_lost = subfragments_per_node - response.count
+                    print("Partial (%s of %s) RLNC fragments lost for %s from node %s"
+                          % (subfragments_lost, subfragments_per_node, fragment, response.node_id))
+                    #Register it as a partial fragment loss
+                    partially_missing_fragments.append({"name": fragment,
+                                                        "subfragments_lost": subfragments_lost,
+                                                        "node_id": response.node_id})
+                    missing_subfragment_count += subfragments_lost
+                else:
+                    print("Fragment %s OK" % fragment)
+
+        # If neither node responded with a positive message, the fragment is fully missing
+        if fragment_found == False:
+            print("RLNC all parts of fragment %s missing" % fragment)
+            #Register it as a full lost fragment, we cannot yet determine which node had it
+            missing_fragments.append({"name": fragment,
+                                      "node_id": "?"})
+            missing_subfragment_count += subfragments_per_node
+
+    # We can now determine which nodes had a full missing fragment by subtracting the two
+    # sets from eachother.
+    nodes_without_fragment = list(nodes.difference(nodes_with_fragment))
+    if len(nodes_without_fragment) < len(missing_fragments):
+        # The fragments of the nodes that did not answer cannot be stored elsewhere
+        print("Only %d storage nodes are available for %d lost fragments. Unable to "
+              "repair file." % (len(nodes_without_fragment), len(missing_fragments)))
+        return missing_subfragment_count, 0
+
+    # Assign each full missing fragment to a node that has not fragments stored on it
+    for fragment, node in zip(missing_fragments, nodes_without_fragment):
+        fragment["node_id"] = node
+
+    # Perform the actual repair, if necessary
+    if missing_subfragment_count > 0:
+        # Check that enough fragments still remain to be able to reconstruct the data
+        if missing_subfragment_count > max_erasures * subfragments_per_node:
+            print("Too many lost fragments: %s. Unable to repair file. " % missing_subfragment_count)
+            return missing_subfragment_count, 0
+
+        nodes_needed = STORAGE_NODES_NUM - max_erasures
+        exact = coefficient_format == 'seed' or systematic
+        assert(window == 1 or not exact)
+        # Like when storing, the new subfragments must leave any nodes_needed fragments
+        # able to decode the generation. To check that, only the headers of the remaining
+        # subfragments are retrieved.
+        remaining = __get_repair_coefficients(fragment_holders, symbol_count,
+                                              coefficient_format, density, field,
+                                              repair_socket, repair_response_socket)
+        # The subfragments of the nodes that did not answer are counted as missing, but
+        # they cannot be repaired: nothing can be stored on these nodes
+        unreachable = [holder for holder in fragment_holders if holder["name"] not in remaining]
+        if unreachable:
+            lost = sum(fragment["subfragments_lost"] for fragment in partially_missing_fragments
+                       if fragment["name"] not in remaining)
+            unrepaired = sum(holder["count"] for holder in unreachable) + lost
+            missing_subfragment_count -= lost
+            fragment_holders = [holder for holder in fragment_holders
+                                if holder["name"] in remaining]
+            partially_missing_fragments = [fragment for fragment in partially_missing_fragments
+                                           if fragment["name"] in remaining]
+            if len(fragment_holders) < nodes_needed or missing_subfragment_count == 0:
+                print("Only %d nodes with fragments answered. Unable to repair file."
+                      % len(fragment_holders))
+                return missing_subfragment_count + unrepaired, 0
+
+        if exact:
+            # The new subfragments need coefficients that recoding cannot produce: seeds,
+            # or the unit vectors of the lost uncoded subfragments. They are created in
+            # the same order as __store_repair_fragments sends them, random coefficients
+            # are drawn again until they are independent of the remaining ones.
+            for draw in range(REPAIR_RECODE_DRAWS):
+                coefficients = []
+                for fragment in missing_fragments:
+                    first_symbol = coded_fragments.index(fragment["name"]) * subfragments_per_node
+                    for j in range(subfragments_per_node):
+                        source_symbol = first_symbol + j \
+                                        if systematic and first_symbol < symbol_count else None
+                        coefficients.append(__draw_coefficients(symbol_count, coefficient_format,
+                                                                source_symbol, density, field))
+                for fragment in partially_missing_fragments:
+                    # It is not known which subfragments were lost, these get coded ones
+                    coefficients += [__draw_coefficients(symbol_count, coefficient_format,
+                                                         density=density, field=field)
+                                     for j in range(fragment["subfragments_lost"])]
+                if __independent_fragments(
+                        __repaired_fragments(remaining, missing_fragments,
+                                             partially_missing_fragments,
+                                             [vector for _, vector in coefficients],
+                                             subfragments_per_node),
+                        nodes_needed, symbol_count, field):
+                    break
+                print("Repair coefficient vectors are not linearly independent, "
+                      "drawing new ones")
+            else:
+                print("No repair coefficients independent of the remaining subfragments "
+                      "found. Unable to repair generation %s." % coded_fragments[0])
+                return missing_subfragment_count + unrepaired, 0
+
+            # Arbitrary coefficients are computed from a decodable set of recoded symbols,
+            # so the nodes together send as many as the generation has source symbols
+            request_counts = __repair_request_counts(fragment_holders, symbol_count)
+        else:
+            # A new subfragment needs a random part of each remaining fragment that it could
+            # otherwise not stand in for. Like in regenerating codes, with d nodes left
+            # each sends missing/(d - nodes_needed + 1) recoded symbols instead of all
+            # it has, so the repair traffic grows with the number of lost subfragments.
+            request_counts = __repair_request_counts(
+                fragment_holders, missing_subfragment_count,
+                -(-missing_subfragment_count // (len(fragment_holders) - nodes_needed + 1)))
+
+        # At most one retry, with all subfragments of the remaining fragments
+        for attempt in range(2):
+            try:
+                recoded_symbols = __get_recoded_symbols(fragment_holders, request_counts,
+                                                        symbol_count, coefficient_format,
+                                                        density, field, repair_socket,
+                                                        repair_response_socket)
+            except TimeoutError as e:
+                print("%s. Unable to repair generation %s." % (e, coded_fragments[0]))
+                return missing_subfragment_count + unrepaired, 0
+            if exact:
+                try:
+                    repair_symbols = __combine_repair_symbols(recoded_symbols, symbol_count,
+                                                              coefficients, field)
+                    break
+                except ValueError as e:
+                    print("%s, requesting all subfragments" % e)
+            else:
+                # Recreate sufficient repair symbols by recoding over the retrieved symbols
+                for draw in range(REPAIR_RECODE_DRAWS):
+                    repair_symbols = recode(recoded_symbols, symbol_count,
+                                            missing_subfragment_count, field)
+                    vectors = [bytes(symbol[:header_size('raw', symbol_count, field)])
+                               for symbol in repair_symbols]
+                    if __independent_fragments(
+                            __repaired_fragments(remaining, missing_fragments,
+                                                 partially_missing_fragments, vectors,
+                                                 subfragments_per_node),
+                            nodes_needed, symbol_count, field, rank):
+                        break
+                else:
+                    repair_symbols = None
+                if repair_symbols is not None:
+                    break
+                print("Recoded symbols are not linearly independent of the remaining ones, "
+                      "requesting all subfragments")
+            # Unlucky recoding on the nodes, or a combination of losses that needs more
+            request_counts = [holder["count"] for holder in fragment_holders]
+        else:
+            # The losses are spread so that the remaining subfragments lack full rank
+            print("The remaining subfragments cannot repair generation %s. Unable to "
+                  "repair file." % coded_fragments[0])
+            return missing_subfragment_count + unrepaired, 0
+        print("Retrieved %s recoded symbols from Storage nodes. Created %s new recoded symbols"
+              % (len(recoded_symbols), len(repair_symbols)))
+
+        # Send the repair symbols to the storage nodes based on the lists we previously built
+        repaired_subfragment_count = __store_repair_fragments(missing_fragments, partially_missing_fragments,
+                                                              repair_symbols, subfragments_per_node,
+                                                              repair_socket, repair_response_socket)
+
+    return missing_subfragment_count + unrepaired, repaired_subfragment_count
 #
 
 
@@ -273,6 +1846,9 @@ def start_repair_process(files, repair_socket, repair_response_socket):
     Based on how many subfragments are missing, it instructs the storage nodes to send over
     a certain number of recoded subfragments. It then recodes over these creating as many
     subfragments as were missing, sending the appropriate number to each of the nodes.
+    Files with several generations are checked and repaired generation by generation.
+    Chunks that may have missed an update are deleted first, so that they are repaired
+    like lost ones; the storage details of these files are updated in place.
 
     :param files: List of files to be checked
     :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
@@ -290,127 +1866,39 @@ def start_repair_process(files, repair_socket, repair_response_socket):
         storage_details = json.loads(file["storage_details"])
         max_erasures = storage_details["max_erasures"]
         subfragments_per_node = storage_details["subfragments_per_node"]
-        symbol_count = (STORAGE_NODES_NUM - max_erasures) * subfragments_per_node
-
-        '''
-        Iterate over each node's coded subfragments to check what is missing.
-        Because this is a distributed system where the central Controller has no knowledge
-        of what is stored on each Strorage node, we build several lists and sets to get an
-        accurate picture. Through these lists and sets we determine:
-        - which nodes respond to our queries
-        - which nodes have a partially missing fragment (and how many subfragments are missing)
-        - which nodes have fully lost their fragment
-        This information will be key in determining where and how many repaired subfragments
-        to send later.
-        '''
-        nodes = set() # list of all storage nodes
-        nodes_with_fragment = set() # list of storage nodes with at least partial fragments
         coded_fragments = storage_details["coded_fragments"] # list of all coded fragments
-        missing_fragments = [] # list of coded fragments that are fully missing
-        partially_missing_fragments = [] # list of coded fragments that are partially missing
-        existing_fragments = [] # list of coded fragments that are at least in part intact
-        missing_subfragment_count = 0
 
-        for fragment in coded_fragments:
-            fragment_found = False 
-
-            task = messages_pb2.fragment_status_request()
-            task.fragment_name = fragment
-            header = messages_pb2.header()
-            header.request_type = messages_pb2.FRAGMENT_STATUS_REQ
-
-            repair_socket.send_multipart([b"all_nodes",
-                                          header.SerializeToString(),
-                                          task.SerializeToString()])
-
-            # Wait until we receive a response from each node
-            for task_nbr in range(STORAGE_NODES_NUM):
-                msg = repair_response_socket.recv()
-                response = messages_pb2.fragment_status_response()
-                response.ParseFromString(msg)
-                
-                nodes.add(response.node_id) # Build a set of nodes
-                if response.is_present == True:
-                    nodes_with_fragment.add(response.node_id)
-                    existing_fragments.append(fragment)
-                    fragment_found = True
-
-                    # Check for partially missing fragments
-                    if response.count < subfragments_per_node:
-                        subfragments_lost = subfragments_per_node - response.count
-                        print("Partial (%s of %s) RLNC fragments lost for %s from node %s"
-                              % (subfragments_lost, subfragments_per_node, fragment, response.node_id))
-                        #Register it as a partial fragment loss
-                        partially_missing_fragments.append({"name": fragment,
-                                                            "subfragments_lost": subfragments_lost,
-                                                            "node_id": response.node_id})
-                        missing_subfragment_count += subfragments_lost
-                    else:
-                        print("Fragment %s OK" % fragment)
-
-            # If neither node responded with a positive message, the fragment is fully missing
-            if fragment_found == False:
-                print("RLNC all parts of fragment %s missing" % fragment)
-                #Register it as a full lost fragment, we cannot yet determine which node had it
-                missing_fragments.append({"name": fragment,
-                                          "node_id": "?"})
-                missing_subfragment_count += subfragments_per_node
-
-        # We can now determine which nodes had a full missing fragment by subtracting the two
-        # sets from eachother.
-        nodes_without_fragment = list(nodes.difference(nodes_with_fragment))
-        assert(len(nodes_without_fragment) == len(missing_fragments))
-
-        # Assign each full missing fragment to a node that has not fragments stored on it
-        i = 0
-        for node in nodes_without_fragment:
-            missing_fragments[i]["node_id"] = node
-            i += 1
-
-
-        # Perform the actual repair, if necessary
-        if missing_subfragment_count > 0:
-            # Check that enough fragments still remain to be able to reconstruct the data
-            if missing_subfragment_count > max_erasures * subfragments_per_node:
-                print("Too many lost fragments: %s. Unable to repair file. " % missing_subfragment_count)
-                continue # Move onto the next file
-
-            #Retrieve sufficient fragments and recode
-            for fragment in coded_fragments:
-                task = messages_pb2.recode_fragments_request()
-                task.fragment_name = fragment
-                task.symbol_count = symbol_count
-                # Request as many fragments as the node originally had stored.
-                # Quite wasteful, surely we can do better
-                task.output_fragment_count = subfragments_per_node
-
-                header = messages_pb2.header()
-                header.request_type = messages_pb2.RECODE_FRAGMENTS_REQ
-                
-                repair_socket.send_multipart([b"all_nodes",
-                                              header.SerializeToString(),
-                                              task.SerializeToString()])
-
-            # Wait until we receive a response from each node that has at least one subfragment
-            recoded_symbols = []
-            for task_nbr in range(len(nodes_with_fragment)):
-                response = repair_response_socket.recv_multipart()
-                for i in range(len(response)):
-                    recoded_symbols.append(bytearray(response[i]))
-
-
-            # Recreate sufficient repair symbols by recoding over the retrieved symbols again
-            repair_symbols = recode(recoded_symbols, symbol_count, missing_subfragment_count)
-            print("Retrieved %s recoded symbols from Storage nodes. Created %s new recoded symbols"
-                  % (len(recoded_symbols), len(repair_symbols)))
-
-            # Send the repair symbols to the storage nodes based on the lists we previously built
-            repaired_subfragment_count = __store_repair_fragments(missing_fragments, partially_missing_fragments,
-                                                                  repair_symbols, subfragments_per_node,
-                                                                  repair_socket, repair_response_socket)
-
-        # Add the per-file counters to the total tally
-        total_missing_subfragment_count += missing_subfragment_count
-        total_repaired_subfragment_count += repaired_subfragment_count
+        # Files stored before generations, seeds, the systematic layout, sparse codes and
+        # other fields were introduced consist of a single generation of dense coded
+        # subfragments with raw GF(2^8) coefficients
+        generations = storage_details.get("generations", 1)
+        coefficient_format = storage_details.get("coefficient_format", "raw")
+        systematic = storage_details.get("systematic", False)
+        density = storage_details.get("density", 1.0)
+        field = storage_details.get("field", 8)
+
+        stale_chunks = set(storage_details.get("stale_chunks", []))
+
+        for generation in range(generations):
+            chunk_names = [stripe_chunk_name(name, generation) for name in coded_fragments]
+            if stale_chunks.intersection(chunk_names):
+                delete_stale_chunks(chunk_names, stale_chunks, max_erasures,
+                                    STORAGE_NODES_NUM, READ_TIMEOUT,
+                                    repair_socket, repair_response_socket)
+            missing, repaired = repair_generation(chunk_names, max_erasures,
+                                                  subfragments_per_node, coefficient_format,
+                                                  systematic, density, field,
+                                                  repair_socket, repair_response_socket)
+
+            # Add the per-generation counters to the total tally
+            total_missing_subfragment_count += missing
+            total_repaired_subfragment_count += repaired
+
+        if "stale_chunks" in storage_details:
+            # Stale chunks that were deleted are repaired now, or counted as missing
+            storage_details["stale_chunks"] = sorted(stale_chunks)
+            if not stale_chunks:
+                del storage_details["stale_chunks"]
+            file["storage_details"] = json.dumps(storage_details)
 
     return total_missing_subfragment_count, total_repaired_subfragment_count
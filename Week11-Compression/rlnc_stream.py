@@ -0,0 +1,763 @@
+"""
+Aarhus University - Distributed Storage course - Lab 11
+
+Sliding-window RLNC for append-only streams
+
+The stream is cut into steps of (4 - max_erasures) * subfragments_per_node source symbols.
+As soon as data of a step arrives, every storage node receives subfragments_per_node coded
+symbols of it, so the data is protected right away. Unlike a generation, a coded symbol
+does not only combine the source symbols of its own step, but those of the last 'window'
+steps: the coding window slides over the stream, and the coded symbols of later steps
+can stand in for lost symbols of earlier ones.
+Data that is appended to a step that already has coded symbols is sent to the nodes as a
+delta (see rlnc.update_file), the rest of the stream is never encoded again.
+
+Every step can be decoded from any 4 - max_erasures nodes once the steps before it are
+decoded, so a reader can decode any prefix of the stream up to the size that was
+committed, that is acknowledged by the nodes. Lost coded symbols of a step are repaired
+by recoding the remaining ones of the step, see start_repair_process.
+"""
+import math
+import random
+import collections
+import itertools
+import time
+import json
+from utils import random_string, stripe_chunk_name, receive_response, read_chunks, \
+    slice_chunks, chunk_status, delete_stale_chunks
+import messages_pb2
+
+import numpy as np
+import gf
+import workers
+import rlnc
+
+STORAGE_NODES_NUM = rlnc.STORAGE_NODES_NUM
+
+# Default size of the source symbols. Small symbols protect small appends with little
+# overhead, but the coefficients take a larger share of the stored data.
+SYMBOL_SIZE = 4096
+
+# Default number of steps that one coded symbol covers
+WINDOW_STEPS = 4
+
+# How many steps are requested from the storage nodes ahead of the first step that is
+# not decoded yet
+READ_AHEAD_STEPS = 16
+
+# How much data store_stream reads and appends at once (rounded down to whole steps)
+APPEND_CHUNK_SIZE = 4*1024*1024
+
+
+def __step_symbols(max_erasures, subfragments_per_node):
+    """
+    Returns the number of source symbols per step.
+    """
+    assert(0 <= max_erasures < STORAGE_NODES_NUM)
+    assert(subfragments_per_node > 0)
+    return (STORAGE_NODES_NUM - max_erasures) * subfragments_per_node
+#
+
+
+def __generate_coefficients(symbols, window_symbols, subfragments_per_node,
+                            coefficient_format, field):
+    """
+    Draw the coefficients of the coded symbols of a new step for every storage node,
+    again until the symbols of any 'symbols/subfragments_per_node' nodes can decode the
+    step once the steps before it are known, that is until their coefficients of the
+    source symbols of the step are linearly independent.
+
+    :param symbols: Number of source symbols per step
+    :param window_symbols: Number of source symbols a coded symbol covers
+    :param subfragments_per_node: How many coded symbols of a step go to one node
+    :param coefficient_format: 'raw' or 'seed', see rlnc.COEFFICIENT_FORMATS
+    :param field: Number of bits of the field elements
+    :return: List with a list of (header, coefficient vector) tuples for each node
+    """
+    nodes_needed = symbols // subfragments_per_node
+    element_type = gf.ELEMENT_TYPES[field]
+    while True:
+        coefficients = []
+        for node in range(STORAGE_NODES_NUM):
+            vectors = []
+            for j in range(subfragments_per_node):
+                seed = random.randrange(rlnc.SYSTEMATIC_SEEDS, 1 << (8*rlnc.SEED_SIZE))
+                vector = rlnc.seed_coefficients(seed, window_symbols, field=field)
+                header = seed.to_bytes(rlnc.SEED_SIZE, 'big') \
+                         if coefficient_format == 'seed' else vector
+                vectors.append((header, vector))
+            coefficients.append(vectors)
+
+        independent = True
+        for combination in itertools.combinations(range(STORAGE_NODES_NUM), nodes_needed):
+            matrix = np.array([np.frombuffer(vector, dtype=element_type)[-symbols:]
+                               for node in combination for _, vector in coefficients[node]])
+            if len(gf.independent_rows(matrix, field)) < symbols:
+                independent = False
+                break
+        if independent:
+            return coefficients
+        print("Coefficient vectors are not linearly independent, drawing new ones")
+#
+
+
+def __store_step(fragment_names, step, window_data, symbols, subfragments_per_node,
+                 symbol_size, coefficient_format, field, request_id, send_task_socket):
+    """
+    Encode a step with the window that ends with it and send its coded symbols to the
+    storage nodes.
+
+    :param fragment_names: Names of the fragments of the stream, one per node
+    :param step: Index of the step
+    :param window_data: The source data of the window, the step is at its end
+    :param symbols: Number of source symbols per step
+    :param subfragments_per_node: How many coded symbols of a step go to one node
+    :param symbol_size: Size of one source symbol
+    :param coefficient_format: 'raw' or 'seed', see rlnc.COEFFICIENT_FORMATS
+    :param field: Number of bits of the field elements
+    :param request_id: The ID the nodes acknowledge the chunks with
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :return: The names of the chunks that were sent
+    """
+    window_symbols = len(window_data) // symbol_size
+    node_coefficients = __generate_coefficients(symbols, window_symbols,
+                                                subfragments_per_node, coefficient_format,
+                                                field)
+    element_type = gf.ELEMENT_TYPES[field]
+    matrix = np.array([np.frombuffer(vector, dtype=element_type)
+                       for node in node_coefficients for _, vector in node])
+    coded = iter(workers.matmul(matrix, np.frombuffer(window_data, dtype=np.uint8)
+                                .reshape(window_symbols, symbol_size), field=field))
+
+    chunk_names = []
+    for name, coefficient_vectors in zip(fragment_names, node_coefficients):
+        task = messages_pb2.storedata_request()
+        task.filename = stripe_chunk_name(name, step)
+        task.request_id = request_id
+        chunk_names.append(task.filename)
+        frames = [task.SerializeToString()]
+        for header, _ in coefficient_vectors:
+            frames.append(bytes(header) + next(coded).tobytes())
+        send_task_socket.send_multipart(frames)
+    return chunk_names
+#
+
+
+def __receive_store_acks(response_socket, request_id, pending):
+    """
+    Wait until the storage nodes acknowledged every stored chunk.
+
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param request_id: The ID the chunks were sent with
+    :param pending: Set of the chunk names that were sent but not acknowledged yet
+    """
+    while pending:
+        resp = receive_response(response_socket, request_id)
+        name = resp[0].decode('utf-8')
+        if len(resp) > 1 or name not in pending:
+            print("Dropping unexpected response %s" % name)
+            continue
+        pending.remove(name)
+        print('Received: %s' % name)
+#
+
+
+def __send_step_update(fragment_names, step, window_symbols, symbol_index, offset, delta,
+                       coefficient_format, field, request_id, repair_socket):
+    """
+    Send the change of a source symbol of a step to all storage nodes, which add it
+    (times their coefficient of the symbol) to the coded symbols of the step.
+
+    :param symbol_index: Index of the source symbol in the window
+    :param offset: Offset of the change in the source symbol
+    :param delta: The change, a uint8 array
+    :param request_id: The ID the nodes acknowledge the update with
+    :return: The names of the chunks that are updated
+    """
+    chunk_names = [stripe_chunk_name(name, step) for name in fragment_names]
+    task = messages_pb2.update_fragments_request()
+    task.fragment_names.extend(chunk_names)
+    task.symbol_count = window_symbols
+    task.symbol_index = symbol_index
+    task.offset = offset
+    task.field = field
+    if coefficient_format == 'seed':
+        task.seed_size = rlnc.SEED_SIZE
+
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.UPDATE_FRAGMENT_DATA_REQ
+    header.request_id = request_id
+    repair_socket.send_multipart([b"all_nodes",
+                                  header.SerializeToString(),
+                                  task.SerializeToString(),
+                                  delta.tobytes()])
+    return chunk_names
+#
+
+
+def __receive_update_acks(repair_response_socket, request_id, pending):
+    """
+    Wait until the storage nodes acknowledged every updated fragment, see rlnc.update_file.
+
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param request_id: The ID the updates were sent with
+    :param pending: Counter of the fragment names that are not acknowledged yet
+    :raises TimeoutError: if the updates were not acknowledged within rlnc.UPDATE_TIMEOUT
+    :raises FileNotFoundError: if all storage nodes answered that they don't store a
+                               fragment
+    """
+    # Number of acknowledgements without the fragment that mean that no node stores it
+    all_absent = {name: count*STORAGE_NODES_NUM for name, count in pending.items()}
+    absent = collections.Counter()
+    deadline = time.monotonic() + rlnc.UPDATE_TIMEOUT/1000
+    while sum(pending.values()) > 0:
+        resp = receive_response(repair_response_socket, request_id, deadline)
+        if resp is None:
+            raise TimeoutError("%d fragment updates were not acknowledged within %d ms"
+                               % (sum(pending.values()), rlnc.UPDATE_TIMEOUT))
+        ack = messages_pb2.fragment_status_response()
+        ack.ParseFromString(resp[0])
+        name = ack.fragment_name
+        if name not in all_absent:
+            print("Dropping unexpected response %s" % name)
+            continue
+        if not ack.chunks:
+            absent[name] += 1
+            if absent[name] == all_absent[name]:
+                raise FileNotFoundError("Fragment %s is not stored on any storage node"
+                                        % name)
+            continue
+        pending[name] -= 1
+#
+
+
+def append_file(coded_fragments, max_erasures, subfragments_per_node, symbol_size, window,
+                stream_size, window_data, data, send_task_socket, response_socket,
+                repair_socket, repair_response_socket, coefficient_format='raw', field=8,
+                stale_chunks=None):
+    """
+    Append data to a stream. Data that falls into the last step of the stream is sent to
+    the storage nodes as a delta of its coded symbols, the following steps are encoded
+    with the window that ends with them. When the function returns, the storage nodes
+    have acknowledged all of it: the stream can be read up to the new size.
+    Like in rlnc.update_file, the new steps are stored first and the chunks of the last
+    step are checked before its delta is sent. If some storage nodes do not acknowledge
+    the delta after all, the chunks that may have missed it are added to 'stale_chunks'.
+
+    :param coded_fragments: Names of the fragments of the stream, one per node
+    :param max_erasures: How many storage node failures the stream survives
+    :param subfragments_per_node: How many coded symbols of a step go to one node
+    :param symbol_size: Size of the source symbols
+    :param window: Number of steps a coded symbol covers
+    :param stream_size: The size of the stream before the append
+    :param window_data: The source data of the last 'window' steps of the stream, see
+                        read_window (None: the stream is empty)
+    :param data: The data to append
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param repair_socket: A ZMQ PUB socket to send updates to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param field: Number of bits of the field elements
+    :param stale_chunks: List of the names of the chunks that may have missed an earlier
+                         append. If the delta is not acknowledged, the chunks that may
+                         have missed it are added to it.
+    :return: The new size of the stream and the source data of its last 'window' steps
+    :raises TimeoutError: if the delta was not acknowledged within rlnc.UPDATE_TIMEOUT
+    :raises FileNotFoundError: if a chunk of the last step is not stored on any storage
+                               node
+    """
+    if stale_chunks is None:
+        stale_chunks = []
+    symbols = __step_symbols(max_erasures, subfragments_per_node)
+    step_size = symbols * symbol_size
+    window_symbols = window * symbols
+    element_size = gf.ELEMENT_TYPES[field].itemsize
+    assert(symbol_size % element_size == 0)
+    if window_data is None:
+        window_data = bytearray(window * step_size)
+    assert(len(window_data) == window * step_size)
+
+    data = memoryview(data)
+    position = stream_size
+    # The step at the end of the window
+    last_step = math.ceil(stream_size / step_size) - 1
+
+    # The storage nodes send the request ID back with their acknowledgements
+    request_id = random_string(8)
+
+    # 1. The part of the data that fills the last step
+    updates = []
+    end = min(stream_size + len(data), (last_step + 1) * step_size)
+    while position < end:
+        step_offset = position - last_step * step_size
+        symbol_index, symbol_offset = divmod(step_offset, symbol_size)
+        length = min(symbol_size - symbol_offset, end - position)
+        window_offset = (window - 1) * step_size + step_offset
+
+        # The change of the padding of the step, which is zero unless an append that
+        # failed changed it on the nodes that acknowledged it, extended to whole field
+        # elements
+        start = symbol_offset // element_size * element_size
+        stop = -(-(symbol_offset + length) // element_size) * element_size
+        delta = np.zeros(stop - start, dtype=np.uint8)
+        delta[symbol_offset - start:symbol_offset - start + length] = \
+            np.frombuffer(window_data, dtype=np.uint8, count=length, offset=window_offset) ^ \
+            np.frombuffer(data, dtype=np.uint8, count=length, offset=position - stream_size)
+        window_data[window_offset:window_offset + length] = \
+            data[position - stream_size:position - stream_size + length]
+        if delta.any():
+            updates.append(((window - 1) * symbols + symbol_index, start, delta))
+        position += length
+
+    # Make sure that every chunk of the last step can be updated
+    if updates:
+        chunk_names = [stripe_chunk_name(name, last_step) for name in coded_fragments]
+        holders = chunk_status(chunk_names, STORAGE_NODES_NUM, rlnc.READ_TIMEOUT,
+                               repair_socket, repair_response_socket)
+        for name in chunk_names:
+            if name not in holders:
+                raise FileNotFoundError("Chunk %s is not stored on any storage node" % name)
+
+    # 2. New steps, each encoded as soon as its data is in the window. They are stored
+    # first: until the stream size is updated, they are not read if the delta fails.
+    new_window_data = window_data
+    new_step = last_step
+    stored = set()
+    while position < stream_size + len(data):
+        new_step += 1
+        length = min(step_size, stream_size + len(data) - position)
+        new_window_data = new_window_data[step_size:] + \
+                          data[position - stream_size:position - stream_size + length] + \
+                          bytearray(step_size - length)
+        stored.update(__store_step(coded_fragments, new_step, new_window_data, symbols,
+                                   subfragments_per_node, symbol_size, coefficient_format,
+                                   field, request_id, send_task_socket))
+        position += length
+        # Keep the number of steps in flight bounded
+        if len(stored) >= STORAGE_NODES_NUM * rlnc.MAX_GENERATIONS_IN_FLIGHT:
+            __receive_store_acks(response_socket, request_id, stored)
+    __receive_store_acks(response_socket, request_id, stored)
+
+    # 3. The delta of the last step
+    pending = collections.Counter()
+    for symbol_index, start, delta in updates:
+        pending.update(__send_step_update(coded_fragments, last_step, window_symbols,
+                                          symbol_index, start, delta, coefficient_format,
+                                          field, request_id, repair_socket))
+    try:
+        __receive_update_acks(repair_response_socket, request_id, pending)
+    except (TimeoutError, FileNotFoundError):
+        # The chunks that were not acknowledged must not be read
+        stale_chunks += [name for name, count in pending.items()
+                         if count > 0 and name not in stale_chunks]
+        raise
+
+    return position, new_window_data
+#
+
+
+def store_file(file_data, max_erasures, subfragments_per_node, send_task_socket,
+               response_socket, repair_socket, repair_response_socket,
+               symbol_size=SYMBOL_SIZE, window=WINDOW_STEPS, coefficient_format='raw',
+               field=8):
+    """
+    Start a new stream with the given data, which may be empty. More data is added
+    with append_file.
+
+    :param file_data: The first data of the stream
+    :param max_erasures: How many storage node failures should the stream survive
+    :param subfragments_per_node: How many coded symbols of a step go to one node
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param repair_socket: A ZMQ PUB socket to send updates to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param symbol_size: The size of the source symbols (default: SYMBOL_SIZE)
+    :param window: Number of steps a coded symbol covers (default: WINDOW_STEPS)
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param field: Number of bits of the field elements, one of rlnc.FIELDS
+    :return: A list of the fragment names and the source data of the last 'window' steps
+    """
+    assert(window > 0)
+    assert(coefficient_format in rlnc.COEFFICIENT_FORMATS)
+    assert(field in rlnc.FIELDS)
+    fragment_names = [random_string(8) for _ in range(STORAGE_NODES_NUM)]
+    _, window_data = append_file(fragment_names, max_erasures, subfragments_per_node,
+                                 symbol_size, window, 0, None, file_data, send_task_socket,
+                                 response_socket, repair_socket, repair_response_socket,
+                                 coefficient_format, field)
+    return fragment_names, window_data
+#
+
+
+def store_stream(stream, max_erasures, subfragments_per_node, send_task_socket,
+                 response_socket, repair_socket, repair_response_socket,
+                 symbol_size=SYMBOL_SIZE, window=WINDOW_STEPS, coefficient_format='raw',
+                 field=8):
+    """
+    Start a new stream with the data read from a file object. The data is appended in
+    chunks of whole steps as it is read, so only one chunk of it is held in memory.
+
+    :param stream: A binary file object to read the first data of the stream from
+    :param max_erasures: How many storage node failures should the stream survive
+    :param subfragments_per_node: How many coded symbols of a step go to one node
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param repair_socket: A ZMQ PUB socket to send updates to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param symbol_size: The size of the source symbols (default: SYMBOL_SIZE)
+    :param window: Number of steps a coded symbol covers (default: WINDOW_STEPS)
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param field: Number of bits of the field elements, one of rlnc.FIELDS
+    :return: A list of the fragment names and the source data of the last 'window' steps
+    """
+    fragment_names, window_data = store_file(bytearray(), max_erasures,
+                                             subfragments_per_node, send_task_socket,
+                                             response_socket, repair_socket,
+                                             repair_response_socket, symbol_size, window,
+                                             coefficient_format, field)
+    # Whole steps, so no appended chunk has to update the coded symbols of the last one
+    step_size = __step_symbols(max_erasures, subfragments_per_node) * symbol_size
+    chunk_size = max(1, APPEND_CHUNK_SIZE // step_size) * step_size
+
+    stream_size = 0
+    for chunk in read_chunks(stream, chunk_size):
+        stream_size, window_data = append_file(fragment_names, max_erasures,
+                                               subfragments_per_node, symbol_size, window,
+                                               stream_size, window_data, chunk,
+                                               send_task_socket, response_socket,
+                                               repair_socket, repair_response_socket,
+                                               coefficient_format, field)
+    return fragment_names, window_data
+#
+
+
+def __solve_steps(received, decoded, first_step, last_step, symbols, window_symbols,
+                  field, first_row=0):
+    """
+    Decode the steps from 'first_step' on, as far as the received coded symbols allow.
+    Usually each step is decoded from its own coded symbols, after the symbols of the
+    decoded steps before it in their window are subtracted. If a step lacks symbols, it
+    is decoded together with the following steps, whose windows cover it as well.
+
+    :param received: Dict of step -> list of (coefficient vector, data) of its coded
+                     symbols that were received
+    :param decoded: (rows x symbol_size) uint8 array with the decoded source symbols
+    :param first_step: The first step that is not decoded yet
+    :param last_step: The last step to decode
+    :param symbols: Number of source symbols per step
+    :param window_symbols: Number of source symbols a coded symbol covers
+    :param field: Number of bits of the field elements
+    :param first_row: Index of the source symbol in the first row of 'decoded'. The rows
+                      must cover the window before first_step and the steps up to
+                      last_step.
+    :return: The first step that is still not decoded
+    """
+    element_type = gf.ELEMENT_TYPES[field]
+    end_step = first_step
+    while end_step <= last_step:
+        known = first_step * symbols
+        rows = [(step, vector, data) for step in range(first_step, end_step + 1)
+                for vector, data in received.get(step, [])]
+        unknown = (end_step + 1) * symbols - known
+        end_step += 1
+        if len(rows) < unknown:
+            continue
+
+        matrix = np.zeros((len(rows), unknown), dtype=element_type)
+        data = np.array([row_data for _, _, row_data in rows])
+        for i, (step, vector, _) in enumerate(rows):
+            # The source symbol of the first coefficient of the vector
+            window_start = (step + 1) * symbols - window_symbols
+            split = known - window_start
+            if split > 0:
+                # Subtract the decoded source symbols
+                columns = slice(max(0, -window_start), split)
+                start = window_start + columns.start
+                data[i] ^= gf.matmul(vector[None, columns],
+                                     decoded[start - first_row:known - first_row],
+                                     field=field)[0]
+            matrix[i, max(0, -split):max(0, -split) + len(vector) - max(split, 0)] = \
+                vector[max(split, 0):]
+
+        independent = gf.independent_rows(matrix, field)
+        if len(independent) < unknown:
+            continue
+        rows = independent[:unknown]
+        inverse = gf.invert_matrix(matrix[rows], field)
+        decoded[known - first_row:known - first_row + unknown] = \
+            workers.matmul(inverse, data[rows], field=field)
+        # Go on with the next steps
+        first_step = end_step
+    return first_step
+#
+
+
+def get_file(coded_fragments, max_erasures, subfragments_per_node, symbol_size, window,
+             size, data_req_socket, response_socket, coefficient_format='raw', field=8,
+             stale_chunks=()):
+    """
+    Read the first 'size' bytes of a stream, at most the committed size. The steps are
+    requested from 4 - max_erasures nodes READ_AHEAD_STEPS at a time and decoded in order
+    as they arrive; if no step is decoded for rlnc.RANK_STALL_TIMEOUT, the steps are
+    requested from the other nodes as well. Chunks that may have missed an append are
+    never read.
+
+    :param coded_fragments: Names of the fragments of the stream
+    :param max_erasures: Max erasures setting that was used when storing the stream
+    :param subfragments_per_node: How many coded symbols of a step go to one node
+    :param symbol_size: Size of the source symbols
+    :param window: Number of steps a coded symbol covers
+    :param size: How many bytes to read from the beginning of the stream
+    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param coefficient_format: How the coefficients are stored, 'raw' or 'seed'
+    :param field: Number of bits of the field elements
+    :param stale_chunks: Names of the chunks that may have missed an append
+    :return: The decoded data
+    :raises TimeoutError: if the data could not be decoded within rlnc.READ_TIMEOUT
+    :raises FileNotFoundError: if too few chunks of a step are up to date
+    """
+    stream_data = bytearray()
+    for data in stream_file(coded_fragments, max_erasures, subfragments_per_node,
+                            symbol_size, window, size, data_req_socket, response_socket,
+                            coefficient_format, field, stale_chunks):
+        stream_data += data
+    return stream_data
+#
+
+
+def stream_file(coded_fragments, max_erasures, subfragments_per_node, symbol_size, window,
+                size, data_req_socket, response_socket, coefficient_format='raw', field=8,
+                stale_chunks=()):
+    """
+    Generator version of get_file: yields the data of the steps as soon as they are
+    decoded. Only the steps that are requested and the window before them are held in
+    memory. The parameters are the same as those of get_file.
+
+    :return: Generator of the decoded data, without the padding of the last step
+    :raises TimeoutError: if a step could not be decoded within rlnc.READ_TIMEOUT
+    :raises FileNotFoundError: if too few chunks of a step are up to date
+    """
+    symbols = __step_symbols(max_erasures, subfragments_per_node)
+    step_size = symbols * symbol_size
+    window_symbols = window * symbols
+    # Seeds are expanded to the coefficient vectors when the symbols arrive
+    header = rlnc.header_size('raw', window_symbols, field)
+    element_type = gf.ELEMENT_TYPES[field]
+    steps = math.ceil(size / step_size)
+    # The decoded source symbols of the window before the first step that is not decoded
+    # yet, and of the steps that are requested ahead of it
+    decoded = np.zeros(((window - 1 + READ_AHEAD_STEPS) * symbols, symbol_size),
+                       dtype=np.uint8)
+    # The step in the first row of 'decoded'
+    first_decoded_step = 1 - window
+
+    # Responses to earlier reads are told apart by the request ID
+    request_id = random_string(8)
+    fragnames = random.sample(list(coded_fragments), STORAGE_NODES_NUM - max_erasures)
+    stale_chunks = set(stale_chunks)
+    requested = {}
+    chunk_steps = {}
+
+    def usable(step, names):
+        # The fragments whose chunk of the step is up to date
+        return [name for name in names if stripe_chunk_name(name, step) not in stale_chunks]
+
+    def send_requests(step, names):
+        for name in names:
+            task = messages_pb2.getdata_request()
+            task.filename = stripe_chunk_name(name, step)
+            task.request_id = request_id
+            data_req_socket.send(task.SerializeToString())
+            chunk_steps[task.filename] = step
+        requested.setdefault(step, set()).update(names)
+
+    received = {}
+    first_step = 0
+    # Each step must be decoded within READ_TIMEOUT, the time the consumer takes to read
+    # the data that was yielded does not count
+    step_deadline = time.monotonic() + rlnc.READ_TIMEOUT/1000
+    stall_deadline = time.monotonic() + rlnc.RANK_STALL_TIMEOUT/1000
+    while first_step < steps:
+        for step in range(first_step, min(first_step + READ_AHEAD_STEPS, steps)):
+            if step not in requested:
+                # Replace the fragments with stale chunks with other ones
+                names = usable(step, fragnames)
+                others = [name for name in usable(step, coded_fragments)
+                          if name not in names]
+                if len(names) + len(others) < len(fragnames):
+                    raise FileNotFoundError("Only %d of the %d fragments of step %d needed "
+                                            "are up to date"
+                                            % (len(names) + len(others), len(fragnames), step))
+                send_requests(step, names + others[:len(fragnames) - len(names)])
+
+        if time.monotonic() >= step_deadline:
+            raise TimeoutError("Step %d of %d could not be decoded within %d ms"
+                               % (first_step, steps, rlnc.READ_TIMEOUT))
+        result = receive_response(response_socket, request_id,
+                                  min(stall_deadline, step_deadline))
+        if result is None:
+            if time.monotonic() >= stall_deadline:
+                # Some nodes are slow, down or lost coded symbols
+                for step in range(first_step, min(first_step + READ_AHEAD_STEPS, steps)):
+                    remaining = [name for name in usable(step, coded_fragments)
+                                 if name not in requested[step]]
+                    if remaining:
+                        print("Step %d stalled, requesting %d more fragments"
+                              % (step, len(remaining)))
+                        send_requests(step, remaining)
+                stall_deadline = time.monotonic() + rlnc.RANK_STALL_TIMEOUT/1000
+            continue
+
+        # Responses contain the chunk name and then the coded symbols
+        name = result[0].decode('utf-8')
+        if len(result) < 2 or name not in chunk_steps:
+            print("Dropping unexpected response %s" % name)
+            continue
+        step = chunk_steps[name]
+        if step < first_step:
+            # The step was decoded without this fragment
+            continue
+        for symbol in result[1:]:
+            if coefficient_format == 'seed':
+                symbol = rlnc.expand_coefficients(symbol, window_symbols, field=field)
+            received.setdefault(step, []).append(
+                (np.frombuffer(symbol, dtype=element_type, count=window_symbols),
+                 np.frombuffer(symbol, dtype=np.uint8, offset=header)))
+
+        solved = __solve_steps(received, decoded, first_step,
+                               min(first_step + READ_AHEAD_STEPS, steps) - 1, symbols,
+                               window_symbols, field, first_decoded_step * symbols)
+        if solved > first_step:
+            for old_step in range(first_step, solved):
+                received.pop(old_step, None)
+            # Send on the new steps, without the padding at the end of the stream
+            rows = decoded[(first_step - first_decoded_step) * symbols:
+                           (solved - first_decoded_step) * symbols]
+            yield rows.reshape(-1)[:size - first_step * step_size].tobytes()
+            # Keep only the window before the next step
+            shift = (solved - window + 1 - first_decoded_step) * symbols
+            decoded[:len(decoded) - shift] = decoded[shift:]
+            first_decoded_step = solved - window + 1
+            first_step = solved
+            step_deadline = time.monotonic() + rlnc.READ_TIMEOUT/1000
+            stall_deadline = time.monotonic() + rlnc.RANK_STALL_TIMEOUT/1000
+    print("Decoded %d steps of the stream" % steps)
+#
+
+
+
+def stream_file_range(coded_fragments, max_erasures, subfragments_per_node, symbol_size,
+                      window, start, end, data_req_socket, response_socket,
+                      coefficient_format='raw', field=8, stale_chunks=()):
+    """
+    Generator that reads the bytes from 'start' to 'end' of a stream. The steps of a
+    sliding window code cannot be decoded on their own, so the steps before the range
+    are decoded as well, but only the range is sent on. The other parameters are the
+    same as those of get_file.
+
+    :param start: First byte of the range
+    :param end: End of the range (exclusive), at most the committed size
+    :return: Generator of the decoded data of the range
+    :raises TimeoutError: if the data could not be decoded within rlnc.READ_TIMEOUT
+    :raises FileNotFoundError: if too few chunks of a step are up to date
+    """
+    assert(0 <= start <= end)
+    return slice_chunks(stream_file(coded_fragments, max_erasures, subfragments_per_node,
+                                    symbol_size, window, end, data_req_socket,
+                                    response_socket, coefficient_format, field,
+                                    stale_chunks),
+                        start, end)
+#
+
+def read_window(coded_fragments, max_erasures, subfragments_per_node, symbol_size, window,
+                stream_size, data_req_socket, response_socket, coefficient_format='raw',
+                field=8, stale_chunks=()):
+    """
+    Returns the source data of the last 'window' steps of a stream, which append_file
+    needs to encode new steps, for example after a restart of the controller. The steps
+    of a sliding window code cannot be decoded on their own, so the whole stream is read.
+    The padding of the last step is read as well: an append that failed may have changed
+    it on the nodes that acknowledged it.
+
+    :return: The source data of the last 'window' steps, including the padding
+    """
+    step_size = __step_symbols(max_erasures, subfragments_per_node) * symbol_size
+    steps = math.ceil(stream_size / step_size)
+    stream_data = get_file(coded_fragments, max_erasures, subfragments_per_node,
+                           symbol_size, window, steps * step_size, data_req_socket,
+                           response_socket, coefficient_format, field, stale_chunks)
+    stream_data = bytearray(window * step_size) + stream_data
+    return stream_data[len(stream_data) - window * step_size:]
+#
+
+
+def start_repair_process(files, repair_socket, repair_response_socket):
+    """
+    Implements the repair process for streams, see rlnc.start_repair_process. The steps
+    are checked and repaired one after the other like generations, by recoding the
+    remaining coded symbols of each step (see rlnc.repair_generation). Chunks that may
+    have missed an append are deleted first, so that they are repaired like lost ones;
+    the storage details of these streams are updated in place.
+    Recoded symbols have arbitrary coefficients, which cannot be stored as seeds: the
+    lost and stale chunks of streams stored in the 'seed' format are only counted as
+    missing.
+
+    :param files: List of streams to be checked, with their committed size
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :return: the number of missing subfragments, the number of repaired subfragments
+    """
+    total_missing_subfragment_count = 0
+    total_repaired_subfragment_count = 0
+
+    for file in files:
+        print("Checking stream with id: %s" % file["id"])
+        storage_details = json.loads(file["storage_details"])
+        max_erasures = storage_details["max_erasures"]
+        subfragments_per_node = storage_details["subfragments_per_node"]
+        coded_fragments = storage_details["coded_fragments"]
+        step_size = __step_symbols(max_erasures, subfragments_per_node) * \
+                    storage_details["symbol_size"]
+        steps = math.ceil(file["size"] / step_size)
+
+        stale_chunks = set(storage_details.get("stale_chunks", []))
+
+        if storage_details["coefficient_format"] != 'raw':
+            chunk_names = [stripe_chunk_name(name, step)
+                           for step in range(steps) for name in coded_fragments]
+            # Chunks on nodes that do not answer are lost as well
+            holders = chunk_status(chunk_names, STORAGE_NODES_NUM, rlnc.READ_TIMEOUT,
+                                   repair_socket, repair_response_socket, partial=True)
+            lost = [name for name in chunk_names if name not in holders or name in stale_chunks]
+            if lost:
+                print("Stream %s has %d lost or stale chunks, streams in the '%s' format "
+                      "cannot be repaired"
+                      % (file["id"], len(lost), storage_details["coefficient_format"]))
+                total_missing_subfragment_count += len(lost) * subfragments_per_node
+            continue
+
+        for step in range(steps):
+            chunk_names = [stripe_chunk_name(name, step) for name in coded_fragments]
+            if stale_chunks.intersection(chunk_names):
+                delete_stale_chunks(chunk_names, stale_chunks, max_erasures,
+                                    STORAGE_NODES_NUM, rlnc.READ_TIMEOUT,
+                                    repair_socket, repair_response_socket)
+            missing, repaired = rlnc.repair_generation(chunk_names, max_erasures,
+                                                       subfragments_per_node, 'raw', False,
+                                                       1.0, storage_details["field"],
+                                                       repair_socket, repair_response_socket,
+                                                       storage_details["window"])
+            total_missing_subfragment_count += missing
+            total_repaired_subfragment_count += repaired
+
+        if "stale_chunks" in storage_details:
+            # Stale chunks that were deleted are repaired now, or counted as missing
+            storage_details["stale_chunks"] = sorted(stale_chunks)
+            if not stale_chunks:
+                del storage_details["stale_chunks"]
+            file["storage_details"] = json.dumps(storage_details)
+
+    return total_missing_subfragment_count, total_repaired_subfragment_count
+#
@@ -5,6 +5,9 @@ import io
 import boto3
 from botocore.exceptions import ClientError
 
+# Size of the parts that stream_file downloads at once
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+
 def s3_list_buckets(region):
     """
     Retrieve the list of existing buckets
@@ -53,7 +56,7 @@ def s3_upload_object(data, bucket_name, object_key, content_type):
     """
     Upload a new Object to an S3 bucket
 
-    :param data: The object data
+    :param data: The object data, or a binary file object to read it from
     :param object_key: S3 object key.
     :param bucket: Bucket to upload to
     :param content_type: MIME type of the object data 
@@ -61,8 +64,10 @@ def s3_upload_object(data, bucket_name, object_key, content_type):
     """
     try:
         s3_client = boto3.client('s3')
+        # upload_fileobj reads file objects in parts, it does not need all data at once
+        file_object = data if hasattr(data, 'read') else io.BytesIO(data)
         response = s3_client.upload_fileobj(
-            io.BytesIO(data),
+            file_object,
             bucket_name, object_key, 
             ExtraArgs={'ContentType': content_type})
         return True
@@ -98,8 +103,21 @@ def store_file(data, region, content_type):
     :para content_type: The MIME type of the file, will be set as the Content-Type metadata field of the S3 object
     :return: The bucket name and random generated object key that identifies the uploaded file   
     """
+    return store_stream(data, len(data), region, content_type)
+#
+
+def store_stream(stream, size, region, content_type):
+    """
+    Upload the file to AWS S3, to the given region, reading it from a file object
+
+    :param stream: A binary file object to read the file contents from, or the contents
+    :param size: The size of the file
+    :param region: S3 Region code (e.g. us-east-2), must be one of the valid codes listed at https://docs.aws.amazon.com/general/latest/gr/s3.html
+    :para content_type: The MIME type of the file, will be set as the Content-Type metadata field of the S3 object
+    :return: The bucket name and random generated object key that identifies the uploaded file   
+    """
 
-    if len(data) > 5*1E9:
+    if size > 5*1E9:
         # We will use the simple upload endpoint that supports data below 5 GB. 
         # Above it we'd have to use the more complicated multipart upload, which 
         # we do not implement now.
@@ -128,7 +146,7 @@ def store_file(data, region, content_type):
     object_key = utils.random_string(20).lower()
 
     # Upload the data 
-    if not s3_upload_object(data, bucket_name, object_key, content_type):
+    if not s3_upload_object(stream, bucket_name, object_key, content_type):
         return False
 
     return bucket_name, object_key
@@ -148,3 +166,37 @@ def get_file(region, bucket_name, object_key):
     data = s3_download_object(region, bucket_name, object_key)
     return data
 #
+
+def stream_file(region, bucket_name, object_key):
+    """
+    Download a file stored in S3 in parts
+
+    :param region: AWS region code where the bucket is located
+    :param bucket_name: The bucket name where the file is stored
+    :param object_key: Key of the object within the bucket that stores the file contents
+    :return: Generator of the parts of the file contents, as they are downloaded
+    """
+    s3_client = boto3.client('s3', region)
+    s3_response_object = s3_client.get_object(Bucket=bucket_name, Key=object_key)
+    return s3_response_object['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE)
+#
+
+def stream_file_range(region, bucket_name, object_key, start, end):
+    """
+    Download a byte range of a file stored in S3 in parts, with a ranged GET request
+
+    :param region: AWS region code where the bucket is located
+    :param bucket_name: The bucket name where the file is stored
+    :param object_key: Key of the object within the bucket that stores the file contents
+    :param start: First byte of the range
+    :param end: End of the range (exclusive)
+    :return: Generator of the parts of the range, as they are downloaded
+    """
+    if start == end:
+        # HTTP ranges can't be empty
+        return iter(())
+    s3_client = boto3.client('s3', region)
+    s3_response_object = s3_client.get_object(Bucket=bucket_name, Key=object_key,
+                                              Range="bytes={}-{}".format(start, end - 1))
+    return s3_response_object['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE)
+#
@@ -5,6 +5,7 @@ Storage Node
 """
 import zmq
 import messages_pb2
+import gf
 
 import sys
 import os
@@ -86,6 +87,22 @@ repair_sender = context.socket(zmq.PUSH)
 repair_sender.connect(repair_sender_address)
 
 
+def send_response(socket, frames, request_id):
+    """
+    Send a response to the controller. If the request had an ID, the response starts
+    with an extra frame with it, so the controller can route the response to the request
+    that is waiting for it.
+
+    :param socket: The socket to send the response on
+    :param frames: The frames of the response
+    :param request_id: The request ID of the request (or an empty string)
+    """
+    if request_id:
+        frames = [bytes(request_id, 'utf-8')] + frames
+    socket.send_multipart(frames)
+#
+
+
 # Use a Poller to monitor three sockets at the same time
 poller = zmq.Poller()
 poller.register(receiver, zmq.POLLIN)
@@ -122,7 +139,7 @@ while True:
             print("Chunk saved to %s" % chunk_local_path)
 
         # Send response (just the file name)
-        sender.send_string(task.filename)
+        send_response(sender, [bytes(task.filename, 'utf-8')], task.request_id)
         
 
     if subscriber in socks:
@@ -144,16 +161,19 @@ while True:
             try:
                 with open(data_folder+'/'+filename+"."+str(i), "rb") as in_file:
                     print("Found chunk %s, sending it back" % filename)
-                    # Add chunk as a new frame
-                    frames.append(in_file.read())
+                    # Add chunk as a new frame, or only the requested byte range of it
+                    # (optionally behind the beginning of the chunk)
+                    prefix = in_file.read(task.prefix_length)
+                    in_file.seek(task.offset)
+                    frames.append(prefix + in_file.read(task.length or -1))
 
             except FileNotFoundError:
-                # This is OK here
-                break
+                # This is OK here, partially lost RLNC fragments can have gaps
+                pass
 
         #Only send a result if at least one chunk was found
         if(len(frames)>1):
-            sender.send_multipart(frames)
+            send_response(sender, frames, task.request_id)
 
     if repair_subscriber in socks:
         # Incoming message on the 'repair_subscriber' socket
@@ -195,14 +215,14 @@ while True:
             response.node_id = node_id
             response.count = chunk_count
 
-            repair_sender.send(response.SerializeToString())
+            send_response(repair_sender, [response.SerializeToString()], header.request_id)
 
         elif header.request_type == messages_pb2.FRAGMENT_DATA_REQ:
             # Fragment data request - same implementation as serving normal data
             # requests, except for the different socket the response is sent on
             # and the incoming request's format.
-            # This is currently only used by Reed-Solomon, which stores a single
-            # chunk per storage node.
+            # Reed-Solomon repairs retrieve whole chunks with it, RLNC repairs only the
+            # coefficient headers of the subfragments.
             task = messages_pb2.getdata_request()
             task.ParseFromString(msg[2])
 
@@ -217,16 +237,19 @@ while True:
                 try:
                     with open(data_folder+'/'+filename+"."+str(i), "rb") as in_file:
                         print("Found chunk %s, sending it back" % filename)
-                        # Add chunk as a new frame
-                        frames.append(in_file.read())
+                        # Add chunk as a new frame, or only the requested byte range of it
+                        # (optionally behind the beginning of the chunk)
+                        prefix = in_file.read(task.prefix_length)
+                        in_file.seek(task.offset)
+                        frames.append(prefix + in_file.read(task.length or -1))
 
                 except FileNotFoundError:
-                    # This is OK here
-                    break
+                    # This is OK here, partially lost RLNC fragments can have gaps
+                    pass
 
             #Only send a result if at least one chunk was found
             if(len(frames)>1):
-                repair_sender.send_multipart(frames)
+                send_response(repair_sender, frames, header.request_id)
 
         elif header.request_type == messages_pb2.RECODE_FRAGMENTS_REQ:
             # Recode fragment data request, specific to RLNC repairs
@@ -235,6 +258,8 @@ while True:
             fragment_name = task.fragment_name
             symbol_count = task.symbol_count
             output_fragment_count = task.output_fragment_count
+            # Requests from before other fields were introduced are for GF(2^8)
+            field = task.field or 8
             print("Recoded fragment request: %s" % fragment_name)
 
             # Try to load the requested files from the local file system
@@ -253,9 +278,89 @@ while True:
             #If at least one fragment is found, recode and send the result
             if fragment_count > 0:
                 import rlnc
-                recoded_symbols = rlnc.recode(fragments, symbol_count, output_fragment_count)
+                if task.seed_size:
+                    # The recoder needs the coefficient vectors themselves
+                    fragments = [rlnc.expand_coefficients(fragment, symbol_count,
+                                                           task.density, field)
+                                 for fragment in fragments]
+                recoded_symbols = rlnc.recode(fragments, symbol_count, output_fragment_count,
+                                              field)
                 print("Fragment found, sending requested recoded symbols")
-                repair_sender.send_multipart(recoded_symbols)
+                send_response(repair_sender, recoded_symbols, header.request_id)
+
+        elif header.request_type == messages_pb2.UPDATE_FRAGMENT_DATA_REQ:
+            # Update request: part of the original data changed, apply the change to the
+            # coded chunks stored here
+            task = messages_pb2.update_fragments_request()
+            task.ParseFromString(msg[2])
+            delta = msg[3]
+            field = task.field or 8
+            element_size = gf.ELEMENT_TYPES[field].itemsize
+
+            for fragment_name in task.fragment_names:
+                chunks_updated = []
+                for i in range(0, MAX_CHUNKS_PER_FILE):
+                    chunk_local_path = data_folder+'/'+fragment_name+"."+str(i)
+                    try:
+                        with open(chunk_local_path, "r+b") as chunk_file:
+                            # The coefficient of the changed source symbol in this chunk
+                            if task.seed_size:
+                                import rlnc
+                                seed = int.from_bytes(chunk_file.read(task.seed_size), 'big')
+                                coefficients = rlnc.seed_coefficients(
+                                    seed, task.symbol_count, task.density, field)
+                                position = task.seed_size + task.offset
+                            else:
+                                coefficients = chunk_file.read(task.symbol_count*element_size)
+                                position = task.symbol_count*element_size + task.offset
+                            coefficient = int.from_bytes(
+                                coefficients[task.symbol_index*element_size:
+                                             (task.symbol_index + 1)*element_size], 'little')
+                            chunk_file.seek(position)
+                            data = chunk_file.read(len(delta))
+                            chunk_file.seek(position)
+                            chunk_file.write(gf.add_scaled(data, delta, coefficient, field))
+                    except FileNotFoundError:
+                        # This is OK here, partially lost RLNC fragments can have gaps
+                        continue
+                    chunks_updated.append(i)
+
+                # Acknowledge every fragment with the chunks that were updated here, so
+                # the controller can tell a fragment that no node stores from a slow node
+                print("Updated %d chunks of %s" % (len(chunks_updated), fragment_name))
+                response = messages_pb2.fragment_status_response()
+                response.fragment_name = fragment_name
+                response.is_present = len(chunks_updated) > 0
+                response.node_id = node_id
+                response.count = len(chunks_updated)
+                response.chunks.extend(chunks_updated)
+                send_response(repair_sender, [response.SerializeToString()],
+                              header.request_id)
+
+        elif header.request_type == messages_pb2.DELETE_FRAGMENT_DATA_REQ:
+            # Delete request: remove all chunks of a fragment that must not be used any more
+            task = messages_pb2.fragment_status_request()
+            task.ParseFromString(msg[2])
+            chunk_name = task.fragment_name
+            chunks_deleted = []
+
+            for i in range(0, MAX_CHUNKS_PER_FILE):
+                try:
+                    os.remove(data_folder+'/'+chunk_name+"."+str(i))
+                except FileNotFoundError:
+                    # This is OK here, partially lost RLNC fragments can have gaps
+                    continue
+                chunks_deleted.append(i)
+
+            # Acknowledge with the chunks that were deleted
+            print("Deleted %d chunks of %s" % (len(chunks_deleted), chunk_name))
+            response = messages_pb2.fragment_status_response()
+            response.fragment_name = chunk_name
+            response.is_present = False
+            response.node_id = node_id
+            response.count = len(chunks_deleted)
+            response.chunks.extend(chunks_deleted)
+            send_response(repair_sender, [response.SerializeToString()], header.request_id)
 
         elif header.request_type == messages_pb2.STORE_FRAGMENT_DATA_REQ:
             #Fragment store request
@@ -283,7 +388,7 @@ while True:
                     break
 
             # Send response (just the file name)
-            repair_sender.send_string(task.filename)
+            send_response(repair_sender, [bytes(task.filename, 'utf-8')], header.request_id)
 
         else:
             print("Message type not supported")
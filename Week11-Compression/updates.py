@@ -0,0 +1,189 @@
+import json
+import math
+import logging
+
+import utils
+
+# Updates of stored files, shared by the Flask (rest-server.py) and asyncio
+# (async-rest-server.py) controllers. The Flask controller calls update_file and
+# delete_old_chunks directly, the asyncio controller runs them with async_storage.run.
+
+
+def update_file(f, storage_details, offset, data, stale_chunks, window_data,
+                data_req_socket, response_socket, send_task_socket, repair_socket,
+                repair_response_socket):
+    """
+    Overwrite part of a file or append to it with its storage mode. Only the erasure
+    coded storage modes support updates, streams can only be appended to (the caller
+    checks that the offset is the size of the stream).
+
+    :param f: The file record from the database, as a dictionary
+    :param storage_details: The parsed storage details of the file, updated in place
+    :param offset: Where the data is written, at most the size of the file
+    :param data: The new data
+    :param stale_chunks: List of the names of the chunks that may have missed an update,
+                         the chunks that miss this update are added to it
+    :param window_data: The source data of the coding window of a stream, None if it
+                        must be read back from the storage nodes
+    :param data_req_socket: A ZMQ PUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param repair_socket: A ZMQ PUB socket for repair requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket where the storage nodes respond
+                                   to repair requests
+    :return: (new size of the file, the chunks to delete if the file was stored again
+             under new fragment names with the number of storage nodes and how long to
+             wait for them or None, the new window data of a stream), or None if the
+             storage mode does not support updates
+    :raises TimeoutError: if the storage nodes did not answer in time
+    :raises FileNotFoundError: if lost fragments must be repaired first
+    """
+    old_chunks = None
+
+    if f['storage_mode'] == 'erasure_coding_rs':
+        import reedsolomon
+
+        coded_fragments = storage_details['coded_fragments']
+        max_erasures = storage_details['max_erasures']
+        symbol_size = storage_details.get(
+            'symbol_size', math.ceil(f['size']/(len(coded_fragments) - max_erasures)))
+
+        coded_fragments, size, stripes, symbol_size = reedsolomon.update_file(
+            coded_fragments,
+            max_erasures,
+            f['size'],
+            symbol_size,
+            offset,
+            data,
+            data_req_socket,
+            response_socket,
+            send_task_socket,
+            repair_socket,
+            repair_response_socket,
+            storage_details.get('systematic', False),
+            storage_details.get('stripes', 1),
+            stale_chunks
+        )
+        if coded_fragments != storage_details['coded_fragments']:
+            old_chunks = ([utils.stripe_chunk_name(name, stripe)
+                           for stripe in range(storage_details.get('stripes', 1))
+                           for name in storage_details['coded_fragments']],
+                          reedsolomon.STORAGE_NODES_NUM, reedsolomon.READ_TIMEOUT)
+            # The new fragments are all up to date
+            storage_details.pop('stale_chunks', None)
+        storage_details.update({
+            "coded_fragments": coded_fragments,
+            "stripes": stripes,
+            "symbol_size": symbol_size
+        })
+
+    elif f['storage_mode'] == 'erasure_coding_rlnc':
+        import rlnc
+
+        coded_fragments = storage_details['coded_fragments']
+        max_erasures = storage_details['max_erasures']
+        subfragments_per_node = storage_details['subfragments_per_node']
+        symbols_num = (rlnc.STORAGE_NODES_NUM - max_erasures) * subfragments_per_node
+        symbol_size = storage_details.get('symbol_size', math.ceil(f['size']/symbols_num))
+
+        coded_fragments, size, generations, symbol_size = rlnc.update_file(
+            coded_fragments,
+            max_erasures,
+            subfragments_per_node,
+            f['size'],
+            symbol_size,
+            offset,
+            data,
+            data_req_socket,
+            response_socket,
+            send_task_socket,
+            repair_socket,
+            repair_response_socket,
+            storage_details.get('generations', 1),
+            storage_details.get('generation_size'),
+            storage_details.get('coefficient_format', 'raw'),
+            storage_details.get('systematic', False),
+            storage_details.get('density', 1.0),
+            storage_details.get('field', 8),
+            stale_chunks
+        )
+        if coded_fragments != storage_details['coded_fragments']:
+            old_chunks = ([utils.stripe_chunk_name(name, generation)
+                           for generation in range(storage_details.get('generations', 1))
+                           for name in storage_details['coded_fragments']],
+                          rlnc.STORAGE_NODES_NUM, rlnc.READ_TIMEOUT)
+            # The new fragments are all up to date
+            storage_details.pop('stale_chunks', None)
+        storage_details.update({
+            "coded_fragments": coded_fragments,
+            "generations": generations,
+            "symbol_size": symbol_size
+        })
+
+    elif f['storage_mode'] == 'erasure_coding_rlnc_stream':
+        import rlnc_stream
+
+        stream = [
+            storage_details['coded_fragments'],
+            storage_details['max_erasures'],
+            storage_details['subfragments_per_node'],
+            storage_details['symbol_size'],
+            storage_details['window']
+        ]
+        if window_data is None:
+            window_data = rlnc_stream.read_window(
+                *stream, f['size'], data_req_socket, response_socket,
+                storage_details['coefficient_format'], storage_details['field'],
+                stale_chunks)
+
+        size, window_data = rlnc_stream.append_file(
+            *stream,
+            f['size'],
+            window_data,
+            data,
+            send_task_socket,
+            response_socket,
+            repair_socket,
+            repair_response_socket,
+            storage_details['coefficient_format'],
+            storage_details['field'],
+            stale_chunks
+        )
+
+    else:
+        return None
+
+    return size, old_chunks, window_data
+#
+
+
+def mark_stale_chunks(db, file_id, storage_details, stale_chunks):
+    """
+    Record the chunks that may have missed an update, so that the repair replaces them.
+    """
+    new_chunks = set(stale_chunks).difference(storage_details.get('stale_chunks', []))
+    if not new_chunks:
+        return
+    logging.error("File %d has %d new stale chunks" % (file_id, len(new_chunks)))
+    storage_details['stale_chunks'] = sorted(
+        new_chunks.union(storage_details.get('stale_chunks', [])))
+    db.execute(
+        "UPDATE `file` SET `storage_details`=? WHERE `id`=?",
+        (json.dumps(storage_details), file_id)
+    )
+    db.commit()
+#
+
+
+def delete_old_chunks(file_id, chunk_names, nodes_num, timeout, repair_socket,
+                      repair_response_socket):
+    """
+    Delete the chunks of a file that was stored again under new fragment names. The ones
+    that are left behind only take up space, the file does not use them any more.
+    """
+    undeleted = utils.delete_chunks(chunk_names, nodes_num, timeout,
+                                    repair_socket, repair_response_socket)
+    if undeleted:
+        logging.error("File %d has %d old chunks that were not deleted"
+                      % (file_id, len(undeleted)))
+#
@@ -1,19 +1,42 @@
 import random
 import string
+import collections
 import os
 import sqlite3
+import threading
+import time
 
-from flask import g
+from flask import g, has_app_context
+
+import messages_pb2
 
 SQL_DB_FILENAME = "files.db"
 
+# DB connections of the threads that use the DB outside of a Flask app context, e.g. the
+# asyncio controller and its worker threads
+__thread_db = threading.local()
+
+def __connect_db():
+    db = sqlite3.connect(
+        SQL_DB_FILENAME,
+        detect_types=sqlite3.PARSE_DECLTYPES
+    )
+    db.row_factory = sqlite3.Row
+    return db
+#
+
 def get_db():
+    """
+    Returns the DB connection of the Flask app context, or of the current thread if
+    there is no app context. The connection of a thread stays open.
+    """
+    if not has_app_context():
+        if not hasattr(__thread_db, 'db'):
+            __thread_db.db = __connect_db()
+        return __thread_db.db
+
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            SQL_DB_FILENAME,
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = __connect_db()
 
     return g.db
 #
@@ -49,6 +72,37 @@ def init_db():
         db.close()
 #
 
+class FormError(ValueError):
+    """
+    An invalid field of a request form. The controllers answer it with 400 Bad Request.
+    """
+#
+
+def form_number(form, name, default, low=None, high=None, convert=int):
+    """
+    Parse a numeric field of a request form (everything is a string in a form) and check
+    that it is in range.
+
+    :param form: The request form
+    :param name: Name of the field
+    :param default: The value if the field is missing
+    :param low: The smallest valid value (default: no limit, only without 'high')
+    :param high: The largest valid value (default: no limit)
+    :param convert: The type of the value, int or float
+    :return: The value of the field
+    :raises FormError: if the value is not a number or not in range
+    """
+    try:
+        value = convert(form.get(name, default))
+    except (TypeError, ValueError):
+        raise FormError("{} must be a number: {}".format(name, form.get(name)))
+    if high is None and low is not None and not value >= low:
+        raise FormError("{} must be at least {}: {}".format(name, low, value))
+    if high is not None and not low <= value <= high:
+        raise FormError("{} must be between {} and {}: {}".format(name, low, high, value))
+    return value
+#
+
 def random_string(length=8):
     """
     Returns a random alphanumeric string of the given length. 
@@ -102,4 +156,264 @@ def chunks(l, n):
         ...
     """
     for i in range(0, len(l), n):
-        yield l[i:i + n]
\ No newline at end of file
+        yield l[i:i + n]
+#
+
+def read_chunk(stream, n):
+    """
+    Read n bytes from a file object, fewer only at the end of the file. Unlike
+    stream.read(n), this does not return early when the data arrives in smaller pieces.
+
+    :param stream: A binary file object, e.g. an uploaded file
+    :param n: The number of bytes to read
+    :return: A bytearray with the data
+    """
+    chunk = bytearray()
+    while len(chunk) < n:
+        data = stream.read(n - len(chunk))
+        if not data:
+            break
+        chunk += data
+    return chunk
+#
+
+def read_chunks(stream, n):
+    """
+    Yield successive n-sized chunks read from a file object, the last one may be shorter.
+    Usage:
+    for chunk in read_chunks(uploaded_file, 4096):
+        ...
+    """
+    while True:
+        chunk = read_chunk(stream, n)
+        if chunk:
+            yield chunk
+        if len(chunk) < n:
+            return
+#
+
+def slice_chunks(chunks, start, end):
+    """
+    Yield the part of a sequence of chunks between two positions of the data they make
+    up, e.g. a byte range of a file that is retrieved in chunks. The chunks after the
+    end are not consumed.
+
+    :param chunks: Iterable of bytes-like chunks
+    :param start: First position
+    :param end: End position (exclusive)
+    :return: Generator of the parts of the chunks in the range
+    """
+    position = 0
+    for chunk in chunks:
+        chunk_start, chunk_end = max(start - position, 0), min(end - position, len(chunk))
+        position += len(chunk)
+        if chunk_start < chunk_end:
+            yield chunk[chunk_start:chunk_end]
+        if position >= end:
+            return
+#
+
+def symbol_range_parts(start, end, symbol_size):
+    """
+    Split a byte range of consecutive source symbols into parts whose columns can be
+    requested with one range of each symbol. Every column of a coded symbol depends only
+    on the same column of the source symbols, so a part that lies within one symbol only
+    needs those columns. A range that covers the end of one symbol and the beginning of
+    the next one is split in two when the two column ranges don't overlap, otherwise it
+    needs the whole symbols.
+
+    :param start: First byte of the range
+    :param end: End of the range (exclusive), start < end
+    :param symbol_size: The size of the symbols
+    :return: List of (start, end, first symbol, last symbol, (first column, end column))
+    """
+    first_row, last_row = start // symbol_size, (end - 1) // symbol_size
+    first_column, end_column = start % symbol_size, (end - 1) % symbol_size + 1
+    if first_row == last_row:
+        return [(start, end, first_row, last_row, (first_column, end_column))]
+    if last_row == first_row + 1 and end_column <= first_column:
+        # Less than a whole symbol of columns: the end of one symbol and the beginning
+        # of the next one
+        boundary = last_row * symbol_size
+        return [(start, boundary, first_row, first_row, (first_column, symbol_size)),
+                (boundary, end, last_row, last_row, (0, end_column))]
+    return [(start, end, first_row, last_row, (0, symbol_size))]
+#
+
+def stripe_chunk_name(name, stripe):
+    """
+    Returns the name under which a stripe of a fragment is stored on the storage nodes.
+    The first stripe is stored under the fragment name itself, so files that consist of
+    a single stripe (including all files stored before striping) keep their chunk names.
+
+    :param name: The fragment name
+    :param stripe: Index of the stripe
+    :return: The chunk name of the stripe
+    """
+    if stripe == 0:
+        return name
+    return "{}_{}".format(name, stripe)
+#
+
+def receive_response(response_socket, request_id, deadline=None):
+    """
+    Receive the next response to a request from the storage nodes. The nodes send the
+    request ID back in the first frame of every response, responses to other requests
+    (e.g. late responses to an earlier request) are dropped.
+
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param request_id: The ID the request was sent with
+    :param deadline: Give up at this time.monotonic() time (default: wait forever)
+    :return: The frames of the response behind the request ID, or None if the deadline
+             passed
+    """
+    while True:
+        if deadline is not None:
+            timeout = max(0, int((deadline - time.monotonic())*1000))
+            if not response_socket.poll(timeout):
+                return None
+        frames = response_socket.recv_multipart()
+        if frames[0].decode('utf-8', 'replace') == request_id:
+            return frames[1:]
+        print("Dropping response to another request %s" % frames[0].decode('utf-8', 'replace'))
+#
+
+
+def chunk_status(chunk_names, nodes_num, timeout, repair_socket, repair_response_socket,
+                 partial=False):
+    """
+    Ask the storage nodes which of them store the given chunks.
+
+    :param chunk_names: Names of the chunks to check
+    :param nodes_num: Number of storage nodes that answer
+    :param timeout: How long to wait for the answers, in milliseconds
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param partial: Return the chunks found within the timeout instead of raising, the
+                    ones on nodes that did not answer are treated as not stored
+    :return: Dictionary of the ID of the node that stores each chunk that is stored
+    :raises TimeoutError: if the nodes did not answer within the timeout
+    """
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.FRAGMENT_STATUS_REQ
+    header.request_id = random_string(8)
+    for name in chunk_names:
+        task = messages_pb2.fragment_status_request()
+        task.fragment_name = name
+        repair_socket.send_multipart([b"all_nodes",
+                                      header.SerializeToString(),
+                                      task.SerializeToString()])
+
+    # A chunk is checked when a node stores it or every node answered that it doesn't
+    holders = {}
+    absent = collections.Counter()
+    unchecked = set(chunk_names)
+    deadline = time.monotonic() + timeout/1000
+    while unchecked:
+        resp = receive_response(repair_response_socket, header.request_id, deadline)
+        if resp is None:
+            if partial:
+                break
+            raise TimeoutError("The storage nodes of %d chunks did not answer within %d ms"
+                               % (len(unchecked), timeout))
+        response = messages_pb2.fragment_status_response()
+        response.ParseFromString(resp[0])
+        name = response.fragment_name
+        if name not in unchecked:
+            continue
+        if response.is_present:
+            holders[name] = response.node_id
+            unchecked.remove(name)
+            continue
+        absent[name] += 1
+        if absent[name] == nodes_num:
+            unchecked.remove(name)
+    return holders
+#
+
+
+def delete_chunks(chunk_names, nodes_num, timeout, repair_socket, repair_response_socket,
+                  holders=None):
+    """
+    Delete chunks from the storage nodes.
+
+    :param chunk_names: Names of the chunks to delete
+    :param nodes_num: Number of storage nodes that answer
+    :param timeout: How long to wait for the acknowledgements, in milliseconds
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param holders: Dictionary of the ID of the node that stores each chunk (default:
+                    ask every node to delete every chunk)
+    :return: Set of the names of the chunks whose deletion was not acknowledged
+    """
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.DELETE_FRAGMENT_DATA_REQ
+    header.request_id = random_string(8)
+    for name in chunk_names:
+        task = messages_pb2.fragment_status_request()
+        task.fragment_name = name
+        # Use the node_id as the topic
+        topic = holders[name].encode('UTF-8') if holders is not None else b"all_nodes"
+        repair_socket.send_multipart([topic,
+                                      header.SerializeToString(),
+                                      task.SerializeToString()])
+
+    # Every node that received a deletion acknowledges it
+    pending = collections.Counter({name: 1 if holders is not None else nodes_num
+                                   for name in chunk_names})
+    deadline = time.monotonic() + timeout/1000
+    while sum(pending.values()) > 0:
+        resp = receive_response(repair_response_socket, header.request_id, deadline)
+        if resp is None:
+            break
+        ack = messages_pb2.fragment_status_response()
+        ack.ParseFromString(resp[0])
+        if pending[ack.fragment_name] > 0:
+            pending[ack.fragment_name] -= 1
+        if ack.count > 0:
+            print("Deleted %d chunks of %s" % (ack.count, ack.fragment_name))
+    return set(name for name, count in pending.items() if count > 0)
+#
+
+
+def delete_stale_chunks(chunk_names, stale_chunks, max_erasures, nodes_num, timeout,
+                        repair_socket, repair_response_socket):
+    """
+    Delete the chunks of a stripe (or generation) that may have missed an update, so
+    that they are repaired like lost ones. This is only done if the stripe can still be
+    repaired without them.
+
+    :param chunk_names: Names of the chunks of the stripe, one for each fragment
+    :param stale_chunks: Set of the names of the chunks that may have missed an update,
+                         the ones that are not stored any more are removed from it
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param nodes_num: Number of storage nodes that answer
+    :param timeout: How long to wait for the storage nodes, in milliseconds
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :return: Whether no stale chunks are left in the stripe
+    """
+    try:
+        holders = chunk_status(chunk_names, nodes_num, timeout,
+                               repair_socket, repair_response_socket)
+    except TimeoutError as e:
+        print("Unable to delete stale chunks: %s" % e)
+        return False
+    stale = [name for name in chunk_names if name in stale_chunks and name in holders]
+    lost = len(chunk_names) - len(holders)
+    if lost + len(stale) > max_erasures:
+        print("Too many stale and lost fragments: %d. Unable to repair file."
+              % (lost + len(stale)))
+        return False
+
+    # Stale chunks that are not stored any more are repaired like lost ones
+    stale_chunks.difference_update(set(chunk_names).difference(stale))
+    undeleted = delete_chunks(stale, nodes_num, timeout, repair_socket,
+                              repair_response_socket, holders)
+    stale_chunks.difference_update(set(stale).difference(undeleted))
+    if undeleted:
+        print("Unable to delete stale chunks: %d deletions were not acknowledged "
+              "within %d ms" % (len(undeleted), timeout))
+        return False
+    return True
+#
@@ -0,0 +1,224 @@
+import os
+import atexit
+import threading
+import concurrent.futures
+from multiprocessing import shared_memory
+
+import numpy as np
+import gf
+
+# Process pool that runs the erasure coding matrix multiplications on all CPU cores.
+# Every column of a product only depends on the same column of the input, so a large
+# multiplication is split into blocks of columns that the worker processes compute
+# independently. The input and output are passed in shared memory, so the symbol data
+# is not pickled and copied through pipes between the processes. Arrays that are
+# allocated with empty() already live in shared memory, so they are not copied at all.
+
+# Number of worker processes (1: multiply in the calling process)
+WORKERS = int(os.environ.get('CODING_WORKERS', os.cpu_count() or 1))
+
+# Products with less input data than this are computed in the calling process, for
+# them handing the work to other processes costs more than it saves
+PARALLEL_THRESHOLD = 1024*1024
+
+__pool = None
+# The asyncio controller runs code in several threads at once
+__pool_lock = threading.Lock()
+
+
+def __get_pool():
+    """
+    Returns the process pool, starting it with WORKERS processes on first use.
+    """
+    global __pool
+    with __pool_lock:
+        if __pool is None:
+            __pool = concurrent.futures.ProcessPoolExecutor(max_workers=WORKERS)
+        return __pool
+#
+
+
+def shutdown():
+    """
+    Stop the worker processes. The pool is started again (with the current number of
+    WORKERS) when it is needed next.
+    """
+    global __pool
+    with __pool_lock:
+        if __pool is not None:
+            __pool.shutdown()
+            __pool = None
+#
+
+atexit.register(shutdown)
+
+
+class __Block:
+    """
+    A block of shared memory that arrays can be created on. The arrays refer to it as
+    their base, so it is released when the last array that uses it is gone.
+    """
+    def __init__(self, shape):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))))
+        self.address = np.frombuffer(self.shm.buf, dtype=np.uint8).ctypes.data
+        self.__array_interface__ = {"shape": tuple(shape), "typestr": "|u1",
+                                    "data": (self.address, False), "version": 3}
+
+    def __del__(self):
+        self.shm.close()
+        self.shm.unlink()
+#
+
+
+def __shared_empty(shape):
+    """
+    Allocate an uninitialized uint8 array in a new shared memory block.
+    """
+    return np.asarray(__Block(shape))
+#
+
+
+def empty(shape):
+    """
+    Allocate an uninitialized uint8 array for the input or output of matmul. If it is
+    large enough to be multiplied by the worker processes, it is allocated in shared
+    memory, so the workers read or write it (and its slices) in place instead of a copy.
+
+    :param shape: Shape of the array
+    :return: The array
+    """
+    if WORKERS <= 1 or np.prod(shape) < PARALLEL_THRESHOLD:
+        return np.empty(shape, dtype=np.uint8)
+    return __shared_empty(shape)
+#
+
+
+def __location(array):
+    """
+    Returns where an array lies in shared memory: the (block name, offset, strides) the
+    worker processes need to access it in place, or None if it was not allocated there.
+    """
+    block = array
+    while isinstance(block, np.ndarray):
+        block = block.base
+    if not isinstance(block, __Block) or array.dtype != np.uint8 or \
+            min(array.strides, default=0) < 0:
+        return None
+    return block.shm.name, array.ctypes.data - block.address, array.strides
+#
+
+
+def __attach(block, location, shape):
+    """
+    Worker process: the array at a location in a shared memory block.
+    """
+    _, offset, strides = location
+    return np.ndarray(shape, dtype=np.uint8, buffer=block.buf, offset=offset,
+                      strides=strides)
+#
+
+
+def __matmul_columns(matrix, data_location, data_shape, out_location, out_shape, start,
+                     end, field):
+    """
+    Worker process task: multiply one block of columns of the data in shared memory
+    and write the result to the output in shared memory.
+    """
+    # The worker processes share the resource tracker of the controller process, which
+    # unlinks the blocks if the controller dies
+    data_shm = shared_memory.SharedMemory(name=data_location[0])
+    out_shm = shared_memory.SharedMemory(name=out_location[0])
+    try:
+        data = __attach(data_shm, data_location, data_shape)
+        out = __attach(out_shm, out_location, out_shape)
+        gf.matmul(matrix, data[:, start:end], out=out[:, start:end], field=field)
+        del data, out
+    finally:
+        data_shm.close()
+        out_shm.close()
+#
+
+
+def matmul(matrix, data, out=None, field=8):
+    """
+    Same as gf.matmul, computed by the worker processes if the data is large enough.
+
+    :param matrix: (rows x k) coefficient matrix
+    :param data: (k x length) uint8 array with the input rows
+    :param out: Optional (rows x length) uint8 array to write the result into
+    :param field: Number of bits of the field elements
+    :return: (rows x length) uint8 array with the output rows
+    """
+    return matmul_many([(matrix, data, out)], field)[0]
+#
+
+
+def matmul_many(products, field=8):
+    """
+    Compute several independent products at once, e.g. the decoding of several RLNC
+    generations. The column blocks of all products are handed to the worker processes
+    together, so small products are computed in parallel with each other and large ones
+    are split across the workers like in matmul.
+    Inputs and outputs that were allocated with empty() are used in place, others are
+    copied to and from shared memory. Outputs that are not given are allocated with
+    empty().
+
+    :param products: List of (matrix, data, out) tuples with the arguments of matmul,
+                     out may be None
+    :param field: Number of bits of the field elements of all products
+    :return: List of the (rows x length) uint8 output arrays, in the same order
+    """
+    products = [(np.asarray(matrix, dtype=gf.ELEMENT_TYPES[field]),
+                 np.asarray(data, dtype=np.uint8), out)
+                for matrix, data, out in products]
+    total_size = sum(data.size for _, data, _ in products)
+    if WORKERS <= 1 or total_size < PARALLEL_THRESHOLD:
+        return [gf.matmul(matrix, data, out=out, field=field) for matrix, data, out in products]
+
+    # About one block of columns per worker in total, each a multiple of the block size
+    # of gf.matmul (which is even, so no GF(2^16) element is split between blocks)
+    total_length = sum(data.shape[1] for _, data, _ in products)
+    block = gf.BLOCK_SIZE * max(1, -(-total_length // (WORKERS * gf.BLOCK_SIZE)))
+
+    outputs = []
+    # Copies of the inputs in shared memory, which must outlive the tasks
+    inputs = []
+    # Outputs that are not in shared memory, and the shared arrays they are copied from
+    copies = []
+    tasks = []
+    try:
+        for matrix, data, out in products:
+            rows, length = matrix.shape[0], data.shape[1]
+            if out is None:
+                out = __shared_empty((rows, length))
+            outputs.append(out)
+
+            data_location = __location(data)
+            if data_location is None:
+                shared_data = __shared_empty(data.shape)
+                shared_data[:] = data
+                inputs.append(shared_data)
+                data = shared_data
+                data_location = __location(data)
+            out_location = __location(out)
+            if out_location is None:
+                shared_out = __shared_empty(out.shape)
+                copies.append((out, shared_out))
+                out_location = __location(shared_out)
+
+            tasks += [__get_pool().submit(__matmul_columns, matrix,
+                                          data_location, data.shape, out_location,
+                                          (rows, length), start, min(start + block, length),
+                                          field)
+                      for start in range(0, length, block)]
+
+        for task in tasks:
+            task.result()
+
+        for out, shared_out in copies:
+            out[:] = shared_out
+    finally:
+        # Wait for all tasks before the blocks are released, also if one failed
+        concurrent.futures.wait(tasks)
+    return outputs
+#